@@ -16,7 +16,7 @@ import traceback
 import zlib
 import mimetypes
 
-from flask import Blueprint, jsonify, render_template, request, redirect, url_for, flash, current_app, abort, send_file, g, session
+from flask import Blueprint, jsonify, render_template, request, redirect, url_for, flash, current_app, abort, send_file, g, session, Response
 from werkzeug import secure_filename
 from werkzeug.datastructures import MultiDict
 
@@ -32,6 +32,7 @@ from foofind.utils.translations import unfix_lang_values
 from foofind.utils.fooprint import ManagedSelect
 from foofind.utils.flaskutils import send_gridfs_file
 from foofind.utils.downloader import get_file_metadata
+from foofind.utils.pagecache import hit_rates
 from foofind.services import *
 from foofind.forms.admin import *
 from foofind.utils.pogit import pomanager
@@ -1179,6 +1180,66 @@ def servers():
         alternatives=server_list,
         page=page)
 
+@admin.route('/<lang>/admin/profiler')
+@admin_required
+def profiler_stats():
+    '''
+    Estadísticas del profiler de peticiones
+    '''
+    minutes = request.args.get("minutes", 60, int)
+    start = time.time()-minutes*60
+    stats, last_date, workers = profiler.get_data(start)
+
+    graphs = []
+    for number, (name, kind, keys) in sorted(current_app.config["PROFILER_GRAPHS"].iteritems()):
+        rows = [(key, stats[key]) for key in keys if key in stats]
+        if rows:
+            graphs.append((name, kind, rows))
+
+    return render_template('admin/profiler.html',
+        page_title=_('admin_profiler'),
+        title=admin_title('admin_profiler'),
+        minutes=minutes,
+        workers=workers,
+        last_date=datetime.datetime.fromtimestamp(last_date) if graphs else None,
+        graphs=graphs,
+        page_cache_rates=hit_rates(stats, current_app.config["SAFE_ROBOT_USER_AGENTS"]))
+
+@admin.route('/<lang>/admin/sampler')
+@admin_required
+def sampler_reports():
+    '''
+    Informes de muestreo de pilas de los procesos web y de los servicios de búsqueda
+    '''
+    try:
+        service_reports = sorted(searchd.sphinx.get_service_sampler_reports().iteritems())
+    except BaseException as e:
+        logging.exception("Error getting search services sampler reports.")
+        service_reports = ()
+
+    return render_template('admin/sampler.html',
+        page_title=_('admin_sampler'),
+        title=admin_title('admin_sampler'),
+        reports=feedbackdb.get_sampler_reports(),
+        service_reports=service_reports,
+        datetime=datetime.datetime)
+
+@admin.route('/<lang>/admin/sampler/<report_id>.folded')
+@admin.route('/<lang>/admin/sampler/service/<int:part>.folded')
+@admin_required
+def sampler_report(report_id=None, part=None):
+    '''
+    Pilas colapsadas de un informe de muestreo, para flamegraph.pl
+    '''
+    if part is None:
+        report = feedbackdb.get_sampler_report(report_id)
+    else:
+        report = searchd.sphinx.get_service_sampler_reports((part,)).get(part)
+    if not report:
+        abort(404)
+    return Response(report["stacks"], mimetype="text/plain",
+                    headers={"Content-Disposition": "attachment; filename=%s.folded" % report["_worker"].replace(":", "-")})
+
 # Parsers para diccionario de parsers (data_to_form, form_to_data [, data_to_json [, json_to_data]])
 db_types = {
     int : (
@@ -4,10 +4,13 @@
 """
 
 import zlib
-from flask import Blueprint, abort, request, render_template, current_app, jsonify, url_for, g
+from hashlib import md5
+from flask import Blueprint, abort, request, render_template, current_app, jsonify, url_for, g, Response, stream_with_context, json
+from werkzeug.http import is_resource_modified
 from foofind.utils import mid2url, url2mid, u, logging
 from foofind.services import *
-from foofind.blueprints.files import secure_fill_data, get_file_metadata, DatabaseError, FileNotExist, FileRemoved, FileUnknownBlock
+from foofind.blueprints.files import get_file_metadata, DatabaseError, FileNotExist, FileRemoved, FileUnknownBlock
+from foofind.blueprints.files.fill_data import secure_fill_api_data
 
 
 
@@ -19,56 +22,144 @@ def file_embed_link(data, size="m"):
     '''
     return url_for( "api.api_embed", _external=True, embed_size=size, fileid=mid2url(data["file"]["_id"]), nameid=data["view"]["fnid"])
 
+def api_search(query):
+    '''
+    Obtiene los ids de los resultados de una búsqueda de la API y si son
+    definitivos, o si la búsqueda aún no ha terminado en todas las partes.
+    '''
+    s = searchd.search(query, request.args, start=True, group=True, no_group=True)
+    ids = list(s.get_results((1.4, 0.1), last_items=[], min_results=100, max_results=100, extra_browse=0))
+    return ids, bool(s.get_stats()["s"])
+
+def api_files(query, files):
+    '''
+    Generador con los datos de los ficheros de la API, rellenados según se van enviando.
+    '''
+    for f in files:
+        f = secure_fill_api_data(f,text=query)
+        if f:
+            yield f
+
+def api_version(version, ids=()):
+    '''
+    Calcula la versión de una respuesta de la API, que solo cambia si cambia
+    la petición, sus resultados o el índice.
+
+    @type version: str
+    @param version: versión de la API
+
+    @type ids: list
+    @param ids: resultados de la búsqueda
+
+    @rtype str
+    @return etag de la respuesta
+    '''
+    generation = searchd.get_reindex_generation()
+    return md5("\x00".join([version, u(request.url).encode("utf-8"), repr(generation)]+[str(fid[0]) for fid in ids])).hexdigest()
+
+def api_response(content, mimetype, etag=None):
+    '''
+    Respuesta de la API que se envía según se genera. Con versión, lleva
+    cabeceras de validación y responde 304 sin generar el contenido si el
+    cliente ya tiene esa versión. No se indica fecha de modificación, ya que
+    los resultados pueden cambiar sin que cambie el índice: solo el etag
+    refleja los resultados enviados.
+
+    @type content: function
+    @param content: función que devuelve el iterable con el contenido
+
+    @type mimetype: str
+    @param mimetype: tipo de la respuesta
+
+    @type etag: str
+    @param etag: etag de la respuesta, o None si no se puede validar, como
+                 cuando los resultados aún no son definitivos
+    '''
+    if etag is None:
+        return Response(stream_with_context(content()), mimetype=mimetype)
+
+    if is_resource_modified(request.environ, etag):
+        response = Response(stream_with_context(content()), mimetype=mimetype)
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config["API_CACHE_MAX_AGE"]
+    return response
+
 @api.route("/api")
 @api.route("/api/")
 @api.route("/api/1")
 def api_v1():
     method = request.args.get("method", None)
-    results = ()
-    success = False
+    ids = ()
+    success = complete = False
     try:
         if method == "getSearch":
             query = request.args["q"]
-            s = searchd.search(query, request.args, start=True, group=True, no_group=True)
-            ids = list(s.get_results((1.4, 0.1), last_items=[], min_results=100, max_results=100, extra_browse=0))
-            stats = s.get_stats()
-            results = enumerate(filter(None, [secure_fill_data(f,text=query) for f in filesdb.get_files(ids,True)]))
+            ids, complete = api_search(query)
             success = True
     except BaseException as e:
         logging.debug(e)
 
-    return render_template("api/v1.xml",
-        api_method=method,
-        results=results,
-        success = success
-        )
+    def content():
+        results = ()
+        ok = success
+        try:
+            if ids:
+                # se obtienen los ficheros antes de empezar a enviar para poder informar de errores
+                results = enumerate(api_files(query, list(filesdb.get_files(ids,True,projection="search"))))
+        except BaseException as e:
+            logging.debug(e)
+            ok = False
+
+        context = {"api_method": method, "results": results, "success": ok}
+        current_app.update_template_context(context)
+        stream = current_app.jinja_env.get_template("api/v1.xml").stream(context)
+        stream.enable_buffering(50)
+        return stream
+
+    return api_response(content, "text/html", api_version("1", ids) if success and complete else None)
 
 _api_v2_md_parser = {
     "created": str,
     }
+def api_v2_file(f):
+    '''
+    Resultado de la API 2 para un fichero.
+    '''
+    return {
+        "size": f["file"]["z"] if "z" in f["file"] else 0,
+        "type": f["view"]["file_type"],
+        "link": url_for("files.download", file_id=f["view"]["url"], file_name=f["view"]["qfn"]+".htm", _external=True),
+        "metadata": {k: (_api_v2_md_parser[k](v) if k in _api_v2_md_parser else v)
+            for k, v in f["view"]["md"].iteritems()},
+        }
+
+def api_v2_stream(method, success, results):
+    '''
+    Serializa la respuesta de la API 2 fichero a fichero.
+    '''
+    yield '{"method": %s, "success": %s, "result": ' % (json.dumps(method), json.dumps(success))
+    if results is None:
+        yield "null"
+    else:
+        separator = "["
+        for f in results:
+            yield separator + json.dumps(api_v2_file(f))
+            separator = ", "
+        yield "[]" if separator=="[" else "]"
+    yield "}"
+
 @api.route("/api/2")
 def api_v2():
     method = request.args.get("method", None)
-    success = True
-    result = None
     if method == "search":
         query = request.args["q"]
-        s = searchd.search(query, request.args, start=True, group=True, no_group=True)
-        ids = list(s.get_results((1.4, 0.1), last_items=[], min_results=100, max_results=100, extra_browse=0))
-        stats = s.get_stats()
-        result = [{
-            "size": f["file"]["z"] if "z" in f["file"] else 0,
-            "type": f["view"]["file_type"],
-            "link": url_for("files.download", file_id=f["view"]["url"], file_name=f["view"]["qfn"]+".htm", _external=True),
-            "metadata": {k: (_api_v2_md_parser[k](v) if k in _api_v2_md_parser else v)
-                for k, v in f["view"]["md"].iteritems()},
-            } for f in filter(None, [secure_fill_data(f,text=query) for f in filesdb.get_files(ids,True)])]
-        success = True
-    return jsonify(
-        method = method,
-        success = success,
-        result = result
-        )
+        ids, complete = api_search(query)
+        return api_response(lambda: api_v2_stream(method, True, api_files(query, list(filesdb.get_files(ids,True,projection="search")))),
+                            "application/json", api_version("2", ids) if complete else None)
+    return api_response(lambda: api_v2_stream(method, True, None), "application/json")
 
 @api.route("/api/embed/<embed_size>/<fileid>/<nameid>")
 @cache.cached(
@@ -3,11 +3,11 @@
 
 import json
 import os.path
-import mimetypes
 import requests
-from flask import g, render_template, current_app, request, send_file, jsonify, url_for, abort, redirect, make_response
+from flask import g, render_template, current_app, request, jsonify, url_for, abort, redirect, make_response
 from flask.ext.babelex import gettext as _
 from foofind.utils.downloader import downloader_url
+from foofind.utils.flaskutils import send_local_file
 from foofind.utils.fooprint import Fooprint
 from foofind.utils import logging
 
@@ -164,7 +164,11 @@ def update():
     # Messages
     response["messages"] = []
 
-    return jsonify(response)
+    # las comprobaciones repetidas sin cambios se responden sin cuerpo
+    response = jsonify(response)
+    response.add_etag()
+    response.make_conditional(request)
+    return response
 
 @downloader.route("/<lang>/downloader/foofind_download_manager_proxy.exe")
 @downloader.route("/<lang>/downloader/<build>/foofind_download_manager_proxy.exe")
@@ -202,7 +206,7 @@ def send_instfile(instfile, build):
         else:
             abort(404)
 
-    return send_file(os.path.join(g.downloader_properties["common"]["base_path"], path), mimetypes.guess_type(path)[0])
+    return send_local_file(g.downloader_properties["common"]["base_path"], path)
 
 
 # Old URLs
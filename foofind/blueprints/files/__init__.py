@@ -16,6 +16,7 @@ import newrelic.agent
 
 from foofind.blueprints.files.fill_data import secure_fill_data, get_file_metadata, init_data, choose_filename
 from foofind.blueprints.files.helpers import *
+from foofind.blueprints.files.related import RelatedFiles
 from foofind.services import *
 from foofind.forms.files import SearchForm, CommentForm
 from foofind.utils import url2mid, mid2bin, mid2hex, mid2url, bin2hex, u, canonical_url, logging, is_valid_url_fileid
@@ -178,15 +179,26 @@ def search(query=None,filters=None,file_id=None,file_name=None):
         flash(static_download["error"][1])
         abort(static_download["error"][0])
     elif not full_browser: #busqueda estatica para browsers "incompletos"
-        wait_time = 400 if dict_filters else 800 if file_id is None else 400
-        async_time = (wait_time*2 if dict_filters else wait_time) + 200
-        results=search_files(query, dict_filters, 50, 50, static_download, query_time=wait_time, extra_wait_time=200, async=async_time, max_extra_searches=1 if search_bot else 4)
+        if "related" in static_download: # pagina de descarga: relacionados ya calculados
+            results=related_results(static_download["file_data"], static_download["related"])
+        else:
+            wait_time = 400 if dict_filters else 800 if file_id is None else 400
+            async_time = (wait_time*2 if dict_filters else wait_time) + 200
+            results=search_files(query, dict_filters, 50, 50, static_download, query_time=wait_time, extra_wait_time=200, async=async_time, max_extra_searches=1 if search_bot else 4)
         # cambia la busqueda canonica
         canonical_query = results["canonical_query"]
-        if search_bot:
+        if search_bot and static_download.get("related", True) is not None: # sin relacionados calculados no hay busqueda que contar
             # si la busqueda devuelve resultados pero mongo no los da, tambien cuenta como "not results".
             searchd.log_bot_event(search_bot, (results["total_found"]>0 or results["sure"]) and not (len(results["files"])==0 and results["total_found"]>0 ))
 
+        # las páginas sin relacionados o con resultados aún no definitivos no se guardan para los robots
+        if "related" in static_download:
+            complete = static_download["related"] is not None and static_download["related"].get("complete", True)
+        else:
+            complete = results["sure"] and results["done"]
+        if not complete:
+            page_cache.skip()
+
         static_results=results["files"], False
         total_found=results["total_found"]
         sure = True
@@ -347,7 +359,34 @@ def search_files(query,filters,min_results=0,max_results=30,download=None,last_i
     else:
         total_found = max(result["total_found"], len(files))
 
-    # completa la descripcion de la pagina
+    complete_page_description(files)
+
+    profiler.checkpoint(profiler_data,opening=["visited"])
+    save_visited(files)
+    profiler.checkpoint(profiler_data,closing=["visited"])
+
+    # accesos a memcached realizados en la petición hasta ahora
+    profiler_data.update(cache.request_stats())
+    profiler.save_data(profiler_data)
+
+    return {
+        "files_ids":[f["file"]["id"] for f in files],
+        "files":files,
+        "result_number":render_template('files/results_number.html',results=result,search=query,sure=stats["s"], total_found=total_found),
+        "total_found":total_found,
+        "page":sum(stats["li"]),
+        "last_items":b64encode(pack("%dh"%len(stats["li"]), *stats["li"]), "-_"),
+        "sure":stats["s"],
+        "wait":stats["w"],
+        "canonical_query": stats["ct"],
+        "end": stats["end"],
+        "done": stats["done"]
+    }
+
+def complete_page_description(files):
+    '''
+    Completa la descripcion de la pagina con datos de los primeros ficheros
+    '''
     if files:
         # Descripcion inicial
         page_description = g.page_description + ". "
@@ -385,25 +424,6 @@ def search_files(query,filters,min_results=0,max_results=30,download=None,last_i
             page_description+="."
         g.page_description = page_description
 
-    profiler.checkpoint(profiler_data,opening=["visited"])
-    save_visited(files)
-    profiler.checkpoint(profiler_data,closing=["visited"])
-
-    profiler.save_data(profiler_data)
-
-    return {
-        "files_ids":[f["file"]["id"] for f in files],
-        "files":files,
-        "result_number":render_template('files/results_number.html',results=result,search=query,sure=stats["s"], total_found=total_found),
-        "total_found":total_found,
-        "page":sum(stats["li"]),
-        "last_items":b64encode(pack("%dh"%len(stats["li"]), *stats["li"]), "-_"),
-        "sure":stats["s"],
-        "wait":stats["w"],
-        "canonical_query": stats["ct"],
-        "end": stats["end"]
-    }
-
 def download_search(file_data, file_text, fallback):
     '''
     Intenta buscar una cadena a buscar cuando viene download
@@ -477,6 +497,11 @@ def download_file(file_id,file_name=None):
             abort(404)
 
         if file_id:
+            # claves de memcached de la página, que se piden en un solo acceso
+            # junto con la entidad del fichero al rellenar sus datos
+            usersdb.declare_file_page_state(file_id, current_user, g.lang)
+            if g.args.get("q", None) is None:
+                related_files.declare(file_id)
             try:
                 file_data=get_file_metadata(file_id, file_name)
             except DatabaseError:
@@ -509,14 +534,8 @@ def download_file(file_id,file_name=None):
             g.title)
         g.page_description = u"%s %s"%(_(file_data['view']['action']).capitalize(), seoize_text(title," ",True))
 
-        #si el usuario esta logueado se comprueba si ha votado el archivo para el idioma activo y si ha marcado el archivo como favorito
-        vote=None
-        favorite = False
-        if current_user.is_authenticated():
-            vote=usersdb.get_file_vote(file_id,current_user,g.lang)
-            favorite=any(file_id==favorite["id"] for favorite in usersdb.get_fav_files(current_user))
-
         #formulario para enviar comentarios
+        has_comments = "cs" in file_data["file"]
         form = CommentForm(request.form)
         if request.method=='POST' and current_user.is_authenticated() and (current_user.type is None or current_user.type==0) and form.validate():
             usersdb.set_file_comment(file_id,current_user,g.lang,form.t.data)
@@ -524,23 +543,66 @@ def download_file(file_id,file_name=None):
             flash("comment_published_succesfully")
             #actualizar el fichero con la suma de los comentarios por idioma
             filesdb.update_file({"_id":file_id,"cs":usersdb.get_file_comments_sum(file_id),"s":file_data["file"]["s"]},direct_connection=True)
+            has_comments = True
+
+        #si el usuario esta logueado, su voto para el idioma activo y si ha marcado el archivo como favorito, y los comentarios si los tiene
+        state=usersdb.get_file_page_state(file_id,current_user,g.lang,has_comments)
+        vote=state["vote"]
+        favorite=state["favorite"]
 
-        #si tiene comentarios se guarda el número del comentario, el usuario que lo ha escrito, el comentario en si y los votos que tiene
-        comments=[]
-        if "cs" in file_data["file"]:
-            comments=[(i,usersdb.find_userid(comment["_id"].split("_")[0]),comment,comment_votes(file_id,comment)) for i,comment in enumerate(usersdb.get_file_comments(file_id,g.lang),1)]
+        #se guarda el número del comentario, el usuario que lo ha escrito, el comentario en si y los votos que tiene
+        comments=[(i,author,comment,comment_votes(file_id,comment)) for i,(comment,author) in enumerate(state["comments"],1)]
 
         # en la pagina de download se intentan obtener palabras para buscar si no las hay
-        if g.args.get("q", None) is None:
-            query = download_search(file_data, file_name, "foofind")
+        download_page = g.args.get("q", None) is None
+        if download_page:
+            related = related_files.get(file_data, file_name)
+            query = related["q"] if related else download_search(file_data, file_name, "foofind")
             if query:
                 g.args["q"] = query.replace(":","")
 
-        return {
+        download = {
             "html":render_template('files/download.html',file=file_data,vote={"k":0} if vote is None else vote,favorite=favorite,form=form,comments=comments),
             "play":file_data["view"]["play"] if "play" in file_data["view"] else "",
             "file_data":file_data,
         }
+        if download_page:
+            download["related"] = related
+        return download
+
+def related_search(file_data, file_name):
+    '''
+    Busca los ficheros relacionados de la pagina de download, sin incluir el propio fichero
+    '''
+    query = download_search(file_data, file_name, "foofind")
+    results = search_files(query.replace(":",""), {}, 50, 50)
+    return {
+        "q": query,
+        "files": [f for f in results["files"] if f["file"]["_id"]!=file_data["file"]["_id"]],
+        "total_found": results["total_found"],
+        "sure": results["sure"],
+        "complete": results["sure"] and results["done"],
+        "canonical_query": results["canonical_query"]
+    }
+
+related_files = RelatedFiles(related_search)
+
+def related_results(file_data, related):
+    '''
+    Resultados de la pagina de download a partir de sus relacionados ya calculados
+    '''
+    file_data["search"] = (mid2hex(file_data["file"]["_id"]), -1, -1, -1)
+    files = [file_data]
+    if related:
+        files.extend(related["files"])
+    complete_page_description(files)
+
+    return {
+        "files": files,
+        "total_found": related["total_found"] if related else 0,
+        "sure": related["sure"] if related else False,
+        "canonical_query": related["canonical_query"] if related else None
+    }
 
 @files.route('/<lang>/download/<file_id>',methods=['GET','POST'])
 @files.route('/<lang>/download/<file_id>/<path:file_name>',methods=['GET','POST'])
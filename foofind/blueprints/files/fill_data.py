@@ -18,6 +18,9 @@ from foofind.utils.splitter import slugify
 from foofind.utils.seo import seoize_text
 from foofind.utils.html import clean_html
 
+# campos de fichero que necesita fill_data para mostrar resultados de búsqueda
+filesdb.add_projection("search", ("bl", "fn", "src", "md", "z", "ct", "i", "se", "vs"))
+
 def init_data(file_data, ntts=[]):
     '''
     Inicializa el diccionario de datos del archivo
@@ -35,7 +38,7 @@ def init_data(file_data, ntts=[]):
 
     return {"file":file_data,"view":{}}
 
-def choose_filename(f,text_cache=None):
+def choose_filename(f,text_cache=None,highlight_text=True):
     '''
     Elige el archivo correcto
     '''
@@ -124,7 +127,7 @@ def choose_filename(f,text_cache=None):
     g.keywords.update(set(keyword for keyword in nfilename.split(" ") if len(keyword)>1))
 
     #nombre del archivo con las palabras que coinciden con la busqueda resaltadas
-    if text_cache:
+    if text_cache and highlight_text:
         f['view']['fnh'], f['view']['fnhs'] = highlight(text_cache[2],filename,True)
     else:
         f['view']['fnh'] = filename #esto es solo para download que nunca tiene text
@@ -305,6 +308,23 @@ def build_source_links(f):
             elif not 'urls' in info:
                 del(f['view']['sources'][src])
 
+def has_source_links(f):
+    '''
+    Comprueba, sin construirlos, si el fichero tiene algún origen con el
+    que build_source_links crearía un enlace.
+    '''
+    for src in f['file']['src'].itervalues():
+        if not src.get('bl',None) in (0, None):
+            continue
+        source_data=g.sources[src["t"]] if "t" in src and src["t"] in g.sources else None
+        if source_data is None or "crbl" in source_data and int(source_data["crbl"])==1:
+            continue
+        # los mismos tipos de origen que tienen peso de enlace en build_source_links
+        if "w" in source_data["g"] or "f" in source_data["g"] or "s" in source_data["g"] or "t" in source_data["g"] \
+            or source_data["d"] in ("BitTorrentHash", "Gnutella", "eD2k"):
+            return True
+    return False
+
 def choose_file_type(f):
     '''
     Elige el tipo de archivo
@@ -392,7 +412,7 @@ def get_float(adict, key):
     return None
 
 
-def format_metadata(f,text_cache, search_text_shown=False):
+def format_metadata(f,text_cache, search_text_shown=False, highlight_text=True):
     '''
     Formatea los metadatos de los archivos
     '''
@@ -631,7 +651,7 @@ def format_metadata(f,text_cache, search_text_shown=False):
                 view_md[metadata]=value
 
                 # resaltar contenidos que coinciden con la busqueda, para textos no muy largos
-                if len(value)<500:
+                if highlight_text and len(value)<500:
                     view_mdh[metadata]=highlight(text,value) if text and len(text)<100 else value
             elif isinstance(value, float): #no hay ningun metadato tipo float
                 view_md[metadata]=str(int(value))
@@ -731,6 +751,48 @@ def secure_fill_data(file_data,text=None, ntts={}):
         logging.exception("Fill_data error on file %s: %s"%(str(file_data["_id"]),repr(e)))
         return None
 
+def fill_api_data(file_data, text=None):
+    '''
+    Añade solo los datos que devuelve la API: tipo, nombre para el enlace de
+    descarga y metadatos. No construye enlaces de origenes, embeds ni
+    imágenes, ni resalta el texto buscado, pero descarta los mismos
+    ficheros que fill_data.
+
+    @type file_data: dict
+    @param file_data: documento del fichero
+
+    @type text: unicode
+    @param text: texto buscado
+
+    @rtype dict o None
+    @return datos del fichero, o None si no tiene nombre con el que enlazarlo
+    '''
+    if text:
+        slug_text = slugify(text)
+        text = (text, slug_text, frozenset(slug_text.split(" ")))
+
+    fetch_global_data()
+    f=init_data(file_data)
+
+    choose_file_type(f)
+    search_text_shown = choose_filename(f,text,False)
+    if not "qfn" in f["view"]:
+        return None
+    if not has_source_links(f):
+        raise FileNoSources
+    format_metadata(f,text, search_text_shown, False)
+    return f
+
+def secure_fill_api_data(file_data,text=None):
+    '''
+    Maneja errores en fill_api_data
+    '''
+    try:
+        return fill_api_data(file_data,text)
+    except BaseException as e:
+        logging.exception("Fill_api_data error on file %s: %s"%(str(file_data["_id"]),repr(e)))
+        return None
+
 def get_file_metadata(file_id, file_name=None):
     '''
     Obtiene el fichero de base de datos y rellena sus metadatos.
@@ -252,7 +252,7 @@ def get_files(ids, sphinx_search=None):
 
     '''
     toblock = []
-    for f in filesdb.get_files(ids, servers_known = True, bl = None):
+    for f in filesdb.get_files(ids, servers_known = True, bl = None, projection = "search"):
         if f["bl"] == 0 or f["bl"] is None:
             yield f
         else:
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+    Ficheros relacionados de la página de descarga, calculados en segundo plano.
+"""
+from time import time
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+from flask import g, request
+
+from foofind.services import cache, searchd
+from foofind.utils import mid2hex, logging
+
+class RelatedFiles(object):
+    '''
+    Caché de los ficheros relacionados de cada fichero en cada idioma.
+
+    La búsqueda de relacionados de una página de descarga es la misma para
+    todas las visitas en el mismo idioma, así que se calcula una sola vez,
+    fuera de las peticiones, y se guarda en memcached con el texto buscado,
+    los ficheros ya rellenados y los datos de la búsqueda. Cada entrada
+    lleva la fecha de la última reindexación: tras reindexar se sigue
+    sirviendo la entrada anterior mientras se calcula la nueva, y sin
+    entrada la página se sirve sin relacionados. Las entradas cuya búsqueda
+    no era definitiva, porque alguna parte no había respondido o tenía
+    avisos, también se recalculan, pasado un intervalo.
+    '''
+    def __init__(self, compute):
+        '''
+        @type compute: function
+        @param compute: función que recibe los datos del fichero y su nombre y
+                        devuelve la entrada, en el contexto de una petición
+        '''
+        self.compute = compute
+        self.app = None
+        self.pool = None
+        self.pending = set()
+        self.lock = Lock()
+        self.timeout = self.lock_timeout = self.retry_interval = self.workers = self.max_pending = 0
+
+    def init_app(self, app):
+        '''
+        Inicializa la caché con la configuración de la aplicación.
+
+        @param app: Aplicación de Flask.
+        '''
+        self.app = app
+        self.timeout = app.config["RELATED_FILES_CACHE_TIMEOUT"]
+        self.lock_timeout = app.config["RELATED_FILES_LOCK_TIMEOUT"]
+        self.retry_interval = app.config["RELATED_FILES_RETRY_INTERVAL"]
+        self.workers = app.config["RELATED_FILES_WORKERS"]
+        self.max_pending = app.config["RELATED_FILES_MAX_PENDING"]
+
+    def key(self, file_id):
+        '''
+        Clave de caché de los relacionados de un fichero en el idioma de la petición.
+        '''
+        return "related/%s/%s" % (mid2hex(file_id), g.lang)
+
+    def declare(self, file_id):
+        '''
+        Declara la entrada de un fichero, para que se pida a memcached junto
+        con las demás claves de la página.
+
+        @type file_id: ObjectId
+        @param file_id: id del fichero
+        '''
+        cache.declare(self.key(file_id))
+
+    def get(self, file_data, file_name):
+        '''
+        Obtiene los ficheros relacionados de un fichero en el idioma de la
+        petición. Si no están calculados, son de una reindexación anterior o
+        su búsqueda no era definitiva, pide que se calculen.
+
+        @type file_data: dict
+        @param file_data: datos del fichero, tal como los devuelve fill_data
+
+        @type file_name: unicode
+        @param file_name: nombre del fichero en la url
+
+        @rtype dict o None
+        @return entrada con el texto buscado ("q"), los ficheros ("files") y los
+                datos de la búsqueda, o None si aún no se ha calculado
+        '''
+        key = self.key(file_data["file"]["_id"])
+        entry = cache.get(key)
+        generation = searchd.get_reindex_generation()
+        if entry is None or entry["gen"]!=generation or not entry.get("complete", True) and time()-entry.get("time", 0)>self.retry_interval:
+            self.schedule(key, generation, file_data, file_name)
+        return entry
+
+    def schedule(self, key, generation, file_data, file_name):
+        '''
+        Encarga el cálculo de una entrada, si no está ya encargado.
+        '''
+        with self.lock:
+            if not self.app or key in self.pending or len(self.pending)>=self.max_pending:
+                return
+            self.pending.add(key)
+            if not self.pool:
+                self.pool = ThreadPool(processes=self.workers)
+
+        # datos de la petición necesarios para rellenar los ficheros en este idioma
+        context = {name: value for name, value in g.__dict__.iteritems() if not name.startswith("cache_")}
+        self.pool.apply_async(self._compute, (key, generation, file_data, file_name, request.path, request.url_root, context))
+
+    def _compute(self, key, generation, file_data, file_name, path, url_root, context):
+        '''
+        Calcula una entrada en un contexto de petición equivalente al original.
+        '''
+        locked = False
+        try:
+            # evita que otros procesos calculen la misma entrada a la vez
+            locked = cache.add(key+"/lock", 1, self.lock_timeout)
+            if not locked:
+                return
+
+            with self.app.test_request_context(path, base_url=url_root):
+                g.__dict__.update(context)
+                g.args = dict(context.get("args", {}))
+                g.keywords = set()
+                entry = self.compute(file_data, file_name)
+                entry["gen"] = generation
+                entry["time"] = time()
+                cache.set(key, entry, timeout=self.timeout)
+        except BaseException as e:
+            logging.exception("Error computing related files.")
+        finally:
+            if locked:
+                cache.delete(key+"/lock")
+            with self.lock:
+                self.pending.discard(key)
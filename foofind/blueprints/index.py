@@ -5,9 +5,6 @@
 import os
 import urllib
 import datetime
-import httplib
-import time
-import threading
 from urlparse import urlparse
 from werkzeug import url_unquote
 from flask import Blueprint, render_template, redirect, url_for, g, make_response, current_app, request, send_from_directory, abort, get_flashed_messages, session
@@ -23,30 +20,6 @@ from foofind.utils.fooprint import Fooprint
 
 index = Fooprint('index', __name__, template_folder="template", dup_on_startswith="/<lang>")
 
-def gensitemap(server, urlformat):
-    '''
-    Crea la ruta del índice de sitemap para el servidor de archivos dado.
-    Se conecta a los índices de segundo nivel y obtiene su fecha de modificación.
-
-    @type server: dict-like
-    @param server: Documento del servidor tal cual viene de MongoDB
-
-    @rtype tuple (str, datetime) o None
-    @return tupla con la url y su fecha de modificación, o None si no se puede
-            obtener la url.
-    '''
-    url = urlformat % int(server["_id"])
-    domain = urlparse(url)[1]
-    con = httplib.HTTPConnection(domain)
-    con.request("HEAD", url)
-    response = con.getresponse()
-
-    if response.status == 200:
-        mtime = time.mktime(time.strptime(response.getheader("last-Modified"), "%a, %d %b %Y %H:%M:%S %Z"))
-        return (url, datetime.datetime.fromtimestamp(mtime))
-
-    return None
-
 # contenidos de la raiz del sitio
 @index.route('/favicon.ico')
 def favicon():
@@ -73,30 +46,28 @@ def baidu():
 def yandex():
     return ''
 
-@cache.cached(
-    timeout=86400, # Un día
-    unless=lambda:True
-    )
 @index.route('/sitemap.xml')
 def sitemap():
-    urlformat = current_app.config["FILES_SITEMAP_URL"].get(g.domain, None)
-    rules = []
-    if urlformat:
-        servers = filesdb.get_servers()
-        threads = [
-            threading.Thread(
-                target = lambda x: rules.append( gensitemap(x, urlformat ) ),
-                args = ( server, ) )
-            for server in servers ]
-        for t in threads:
-            t.start()
-        for t in threads:
-            if t.is_alive():
-                t.join()
-        if None in rules:
-            rules = [rule for rule in rules if rule!=None]
-            logging.error("Hay sitemaps no disponibles", extra={"servers":servers, "rules":rules})
-    return render_template('sitemap.xml', rules=rules)
+    '''
+    Sirve el índice de sitemaps generado en segundo plano.
+    '''
+    if not g.domain in current_app.config["FILES_SITEMAP_URL"]:
+        return render_template('sitemap.xml', rules=[])
+
+    snapshot = sitemaps.get(g.domain)
+    if snapshot is None: # aún no se ha generado
+        response = make_response("", 503)
+        response.headers["Retry-After"] = "60"
+        return response
+
+    xml, etag, last_modified = snapshot
+    response = make_response(xml)
+    response.mimetype = "application/xml"
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config["SITEMAP_REFRESH_INTERVAL"]
+    return response.make_conditional(request)
 
 @index.route('/<lang>/opensearch.xml')
 def opensearch():
@@ -9,6 +9,7 @@ SECRET_KEY = "supersecret"
 APPLICATION_ID = "default"
 
 SPHINX_REDIS_SERVER = ("redis.foofind.com", 6379)
+SPHINX_REDIS_SHARDS = None # lista de particiones de la cache de busquedas, cada una con sus servidores alternativos; por defecto, una con SPHINX_REDIS_SERVER
 SPHINX_CLIENT_REQUESTS_CACHE_SIZE = 10000
 SPHINX_CLIENT_REQUESTS_CACHE_TIMEOUT = 60
 
@@ -33,9 +34,44 @@ DATA_SOURCE_ENTITIES = "mongodb://mongo.foofind.com:27017"
 DATA_SOURCE_MAX_POOL_SIZE = 50
 DATA_SOURCE_FOO_THREADS = 30
 
+FEEDBACK_WRITE_QUEUE_SIZE = 10000 # documentos pendientes de escribir, el resto se descartan
+FEEDBACK_WRITE_BATCH_SIZE = 500
+FEEDBACK_WRITE_INTERVAL = 1
+FEEDBACK_FLUSH_TIMEOUT = 10 # segundos que se espera al hilo de escritura al terminar el proceso
+
 GET_FILES_TIMEOUT = 1
 GET_FILES_POOL_SIZE = 30
+GET_FILES_HEDGE_RATIO = 0.05 # consultas duplicadas permitidas por cada consulta a un servidor
+GET_FILES_HEDGE_BURST = 10
+GET_FILES_HEDGE_MIN_DELAY = 0.02 # espera mínima antes de duplicar una consulta
+GET_FILES_HEDGE_MIN_SAMPLES = 20 # latencias de un miembro necesarias para usar su percentil 95
+GET_FILES_LATENCY_WINDOW = 200 # consultas recientes de cada miembro para calcular latencias
+GET_FILES_PROBE_INTERVAL = 50 # cada cuántas consultas se prueba otro miembro de la réplica
 AUTORECONNECT_FOO_INTERVAL = 300
+LOCATION_CACHE_SIZE = 100000 # ubicaciones de ficheros en memoria del proceso
+LOCATION_CACHE_TIMEOUT = 60*60*24
+LOCATION_ABSENT_SIZE = 100000 # ids que no están en indir (filtro de Bloom)
+LOCATION_ABSENT_TIMEOUT = 60*10
+
+RELATED_FILES_CACHE_TIMEOUT = 60*60*24 # bloque de relacionados de la página de descarga
+RELATED_FILES_LOCK_TIMEOUT = 30 # tiempo máximo de cálculo de un bloque
+RELATED_FILES_RETRY_INTERVAL = 60*5 # espera para recalcular un bloque cuya búsqueda no era definitiva
+RELATED_FILES_WORKERS = 2
+RELATED_FILES_MAX_PENDING = 100 # bloques pendientes de calcular en cada proceso
+
+PAGE_CACHE_ENABLED = True # páginas completas para los robots de búsqueda
+PAGE_CACHE_ENDPOINTS = ("files.search", "files.download")
+PAGE_CACHE_SESSION_KEYS = ("_csrf_token", "_id", "lang") # datos de sesión que no impiden usar la caché
+PAGE_CACHE_TTL = 60*30 # segundos que se sirve una página sin renovarla
+PAGE_CACHE_STALE_TTL = 60*60*6 # segundos siguientes en los que se sirve mientras se renueva
+PAGE_CACHE_MAX_BYTES = 64*1024*1024 # páginas comprimidas en memoria de cada proceso
+PAGE_CACHE_MAX_ENTRY_BYTES = 256*1024
+PAGE_CACHE_COMPRESS_LEVEL = 6
+PAGE_CACHE_WORKERS = 2
+PAGE_CACHE_MAX_PENDING = 100 # páginas pendientes de renovar en cada proceso
+
+API_CACHE_MAX_AGE = 60 # los clientes de la API revalidan con If-None-Match tras este tiempo
+
 SECONDARY_ACCEPTABLE_LATENCY_MS = 50
 
 SERVICE_SPHINX = "sphinx.foofind.com"
@@ -64,6 +100,8 @@ SERVICE_TAMING_ACTIVE = True
 
 DOWNLOADER = False
 DOWNLOADER_UA = ()
+DOWNLOAD_OFFLOAD = None # "x-sendfile" o "x-accel-redirect" para delegar las descargas en el servidor frontal
+DOWNLOAD_ACCEL_PREFIX = "/internal-downloads/" # location interna de nginx para X-Accel-Redirect
 
 CACHE_SEARCHES = True
 CACHE_FILES = True
@@ -75,6 +113,11 @@ CACHE_TYPE = "memcached"
 
 STATIC_PREFIX = None
 
+TEMPLATE_BYTECODE_CACHE = True
+TEMPLATE_BYTECODE_CACHE_DIR = None # por defecto, un directorio temporal del usuario
+TEMPLATE_WARMUP = True
+TEMPLATE_FILTER_CACHE_SIZE = 10000 # 0 para desactivar la caché de filtros
+
 REMOTE_MEMCACHED_SERVERS = ()
 
 # Extracted from http://www.monperrus.net/martin/list+of+robot+user+agents (CC-SA license)
@@ -100,8 +143,19 @@ SAFE_ROBOT_USER_AGENTS = [s.strip().replace(" ","_").replace("/", "").replace(".
 ROBOT_USER_AGENTS_RATE_LIMIT = {}
 ROBOT_DEFAULT_RATE_LIMIT = 200
 USER_RATE_LIMIT = 200
-
-
+RATE_LIMIT_WINDOW = 60
+RATE_LIMIT_SYNC_INTERVAL = 0.3 # sincronización de contadores locales con memcached
+RATE_LIMIT_LEASE = 0.1 # fracción de los tokens restantes que puede consumir cada proceso entre sincronizaciones
+RATE_LIMIT_MAX_KEYS = 50000
+RATE_LIMIT_IDLE_SYNC_INTERVAL = 5 # segundos entre lecturas de las claves sin peticiones nuevas
+RATE_LIMIT_MAX_SYNC_KEYS = 1000 # claves que se envían o leen en cada sincronización
+RATE_LIMIT_STALE_SYNC = 2 # segundos sin sincronizar una clave tras los que decide la cuenta local
+
+
+PROFILER_FLUSH_INTERVAL = 60 # segundos entre resúmenes del profiler de cada proceso
+SAMPLER_INTERVAL = 0.01 # segundos entre muestras de las pilas
+SAMPLER_MAX_OVERHEAD = 0.02 # fracción máxima del tiempo dedicada a muestrear
+SAMPLER_DURATION = 60 # segundos de cada muestreo
 PROFILER_GRAPHS = { 1:("Search page", 'TIMING', ["taming","mongo","sphinx","visited","entities"]),
                     2:("Mongo master accesses", 'TIMING',["mongo%dm"%s for s in xrange(1,20)]),
                     3:("Mongo slave accesses", 'TIMING', ["mongo%ds"%s for s in xrange(1,20)]),
@@ -114,7 +168,10 @@ PROFILER_GRAPHS = { 1:("Search page", 'TIMING', ["taming","mongo","sphinx","visi
                     10:("Search waiting timeouts", 'SUM', ["sp_timeout%d"%s for s in xrange(1,20)]),
                     11:("Bots results", 'SUM', ["bot_%s"%s for s in SAFE_ROBOT_USER_AGENTS]),
                     12:("Bots not results", 'SUM', ["bot_no_%s"%s for s in SAFE_ROBOT_USER_AGENTS]),
-                    13:("Downloader", 'SUM', ["downloader_opened"])
+                    13:("Downloader", 'SUM', ["downloader_opened"]),
+                    14:("Cache accesses", 'MEAN', ["cache_gets","cache_rt"]),
+                    15:("Search publishes", 'SUM', ["sp_published","sp_avoided","sp_avoided_wakeups"]),
+                    16:("Bots page cache", 'MEAN', ["pc_bytes","pc_entries"])
                     }
 
 OAUTH_TWITTER_CALLBACK_URL = "http://foofind.com/es/user/oauth/tw/callback"
@@ -142,6 +199,10 @@ COUNT_UPDATE_INTERVAL = 300
 MAX_AUTORECONNECTIONS = 20
 FOOCONN_UPDATE_INTERVAL = 120
 CONFIG_UPDATE_INTERVAL = 60
+CONFIG_NOTIFY_CHANNEL = "config" # None para usar sólo la consulta periódica
+CONFIG_NOTIFY_REDIS_SERVER = None # por defecto, el primer servidor de SPHINX_REDIS_SERVER
+CONFIG_NOTIFY_RETRY_INTERVAL = 5
+CONFIG_NOTIFY_SAFETY_INTERVAL = 900
 UNITTEST_INTERVAL = 0
 
 CSRF_ENABLED=False #deshabilita CSRF de Flask-WTF
@@ -159,3 +220,6 @@ ADMIN_GIT_AUTHOR = "admin"
 ADMIN_GIT_EMAIL = "admin@foofind.com"
 
 FILES_SITEMAP_URL = {}
+SITEMAP_REFRESH_INTERVAL = 60*60
+SITEMAP_PROBE_TIMEOUT = 5
+SITEMAP_PROBE_THREADS = 10
@@ -14,13 +14,17 @@ from foofind.services.db.configstore import ConfigStore
 from foofind.services.db.entitiesstore import EntitiesStore
 from foofind.services.db.pluginstore import PluginStore
 from foofind.utils.profiler import Profiler
+from sphinxservice.sampler import Sampler
 from foofind.utils.event import EventManager
 from foofind.utils.taming import TamingClient
+from foofind.utils.ratelimit import RateLimiter
+from foofind.utils.sitemap import SitemapIndex
+from foofind.utils.pagecache import PageCache
 from .ip_ranges import IPRanges
 from extensions import *
 
 __all__=['filesdb', 'usersdb', 'pagesdb', 'feedbackdb', 'configdb', 'entitiesdb', 'spanish_ips',
-                'taming', 'eventmanager', 'profiler', 'searchd', 'plugindb', 'local_cache']
+                'taming', 'eventmanager', 'profiler', 'searchd', 'plugindb', 'local_cache', 'ratelimiter', 'sitemaps', 'sampler', 'page_cache']
 
 __all__.extend(extensions.__all__)
 
@@ -35,5 +39,9 @@ spanish_ips = IPRanges()
 taming = TamingClient()
 eventmanager = EventManager()
 profiler = Profiler()
+sampler = Sampler()
+ratelimiter = RateLimiter()
+sitemaps = SitemapIndex()
+page_cache = PageCache()
 searchd = Searchd()
 local_cache = {}
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from flask.ext.cache import Cache as CacheBase
+from werkzeug.contrib.cache import MemcachedCache
 from flask import g, request
 from functools import wraps
 from hashlib import md5
@@ -125,6 +126,138 @@ class Cache(CacheBase):
     def skip(self, v):
         g.cache_skip = v
 
+    def _request_batch(self):
+        '''
+        Obtiene el lote de accesos a caché de la petición actual, creándolo si
+        no existe.
+
+        @rtype tuple o None
+        @return tupla con el diccionario de valores ya obtenidos, el conjunto de
+                claves declaradas pendientes de obtener y el diccionario de
+                estadísticas; None si no hay contexto de Flask.
+        '''
+        try:
+            batch = getattr(g, "cache_batch", None)
+            if batch is None:
+                batch = g.cache_batch = ({}, set(), {"cache_gets":0, "cache_rt":0})
+            return batch
+        except RuntimeError:
+            # Sin contexto no hay petición a la que asociar el lote
+            return None
+
+    def declare(self, *keys):
+        '''
+        Declara claves que se van a consultar durante la petición actual. Se
+        obtendrán todas juntas, con un solo acceso a memcached, en la siguiente
+        llamada a get.
+
+        @param keys: claves de caché
+        '''
+        batch = self._request_batch()
+        if batch:
+            values, pending = batch[0], batch[1]
+            pending.update(key for key in keys if not key in values)
+
+    def declare_call(self, f, *args, **kwargs):
+        '''
+        Declara una llamada a una función decorada con memoize, cached o
+        fallback que se realizará durante la petición actual.
+
+        @type f: callable
+        @param f: función o método decorado
+        @param args: argumentos de la llamada
+        @param kwargs: argumentos con nombre de la llamada
+        '''
+        if getattr(f, "im_self", None) is not None:
+            args = (f.im_self,) + args
+        self.declare(f.make_cache_key(*args, **kwargs))
+
+    def request_stats(self):
+        '''
+        Devuelve las estadísticas de acceso a caché de la petición actual.
+
+        @rtype dict
+        @return diccionario con el número de consultas a caché (cache_gets) y
+                de accesos reales a memcached (cache_rt).
+        '''
+        batch = self._request_batch()
+        return batch[2].copy() if batch else {}
+
+    def get(self, key):
+        '''
+        Obtiene una clave de caché. Dentro de una petición, las claves ya
+        obtenidas se sirven sin acceder a memcached y las declaradas con
+        `declare` se obtienen junto con ésta en un solo acceso.
+
+        @type key: str
+        @param key: clave de caché
+        '''
+        batch = self._request_batch()
+        if batch is None:
+            return self.cache.get(key)
+
+        values, pending, stats = batch
+        stats["cache_gets"] += 1
+        if key in values:
+            return values[key]
+
+        stats["cache_rt"] += 1
+        if pending:
+            pending.add(key)
+            keys = list(pending)
+            pending.clear()
+            values.update(self.cache.get_dict(*keys))
+            return values.get(key)
+
+        rv = values[key] = self.cache.get(key)
+        return rv
+
+    def set(self, key, value, timeout=None):
+        '''
+        Asigna una clave de caché, actualizando el lote de la petición actual.
+
+        @type key: str
+        @param key: clave de caché
+        '''
+        batch = self._request_batch()
+        if batch:
+            batch[0][key] = value
+            batch[1].discard(key)
+        return self.cache.set(key, value, timeout=timeout)
+
+    def add(self, key, value, timeout=None):
+        '''
+        Asigna una clave de caché sólo si no existe, de forma atómica en
+        memcached. Sirve como cerrojo entre procesos.
+
+        @type key: str
+        @param key: clave de caché
+
+        @rtype bool
+        @return si se ha asignado la clave
+        '''
+        if isinstance(self.cache, MemcachedCache):
+            return bool(self.cache._client.add((self.cache.key_prefix or "")+key, value, timeout or self.cache.default_timeout))
+
+        # resto de cachés, sin operación atómica
+        if self.cache.get(key) is not None:
+            return False
+        self.cache.set(key, value, timeout=timeout)
+        return True
+
+    def delete(self, key):
+        '''
+        Borra una clave de caché, también del lote de la petición actual.
+
+        @type key: str
+        @param key: clave de caché
+        '''
+        batch = self._request_batch()
+        if batch:
+            batch[0].pop(key, None)
+            batch[1].discard(key)
+        return self.cache.delete(key)
+
     @classmethod
     def throw_fallback(cls):
         '''
@@ -390,7 +523,7 @@ class Cache(CacheBase):
                 cache_key = decorated_function.make_cache_key(*args, **kwargs)
                 try:
                     rv = f(*args, **kwargs)
-                    self.cache.set(cache_key, rv, timeout=decorated_function.cache_timeout)
+                    self.set(cache_key, rv, timeout=decorated_function.cache_timeout)
                     return rv
                 except ThrowFallback:
                     # Se ha ordenado usar el fallback
@@ -401,7 +534,7 @@ class Cache(CacheBase):
                         raise
                     self.cacheme = False
                     logging.exception(e)
-                return self.cache.get(cache_key)
+                return self.get(cache_key)
 
             def make_cache_key(*args, **kwargs):
                 if self._self_given(args, uncached_fnc):
@@ -3,8 +3,11 @@
 import pymongo
 import pymongo.errors
 import time
+import os
 import memcache
 import socket
+import redis
+from threading import Thread, Lock
 
 from foofind.utils.fooprint import ManagedSelect, ParamSelector, DecoratedView
 from foofind.utils import check_capped_collections, logging
@@ -22,6 +25,15 @@ class ConfigStore(object):
         self._actions_lt = time.time() # No se ejecutan las acciones previas al despliegue
         self._alternatives_lt = 0 # La configuración se carga en el despliegue
         self._alternatives_skip = set()
+        self._pull_lock = Lock()
+        self._last_pull = 0
+        self._notify_conn = None
+        self._notify_channel = None
+        self._notify_ready = False
+        self._listener_pid = None
+        self._notify_retry = 5
+        self._safety_interval = 900
+        self.stats = {"queries": 0, "pulls": 0, "notifications": 0, "delay": 0.}
 
     def init_app(self, app):
         '''
@@ -36,6 +48,16 @@ class ConfigStore(object):
             }
         self._appid = app.config["APPLICATION_ID"]
 
+        # canal de notificación de cambios
+        if app.config["CONFIG_NOTIFY_CHANNEL"]:
+            server = app.config["CONFIG_NOTIFY_REDIS_SERVER"] or app.config["SPHINX_REDIS_SERVER"]
+            if isinstance(server[0], (list, tuple)):
+                server = server[0]
+            self._notify_conn = redis.StrictRedis(host=server[0], port=server[1])
+            self._notify_channel = app.config["CONFIG_NOTIFY_CHANNEL"]
+            self._notify_retry = app.config["CONFIG_NOTIFY_RETRY_INTERVAL"]
+            self._safety_interval = app.config["CONFIG_NOTIFY_SAFETY_INTERVAL"]
+
         if app.config["DATA_SOURCE_CONFIG"]:
             if "DATA_SOURCE_CONFIG_RS" in app.config:
                 self.config_conn = pymongo.MongoReplicaSetClient(app.config["DATA_SOURCE_CONFIG"],
@@ -103,8 +125,89 @@ class ConfigStore(object):
         Descarga la configuración de la base de datos y
         actualiza la configuración local.
         '''
-        self.pull_actions()
-        self.pull_alternatives()
+        with self._pull_lock:
+            self._last_pull = time.time()
+            self.stats["pulls"] += 1
+            self.pull_actions()
+            self.pull_alternatives()
+
+    def poll(self):
+        '''
+        Consulta periódica de la configuración. Mientras el canal de
+        notificación está disponible los cambios se aplican al recibir su
+        aviso, y sólo se descarga la configuración cada cierto tiempo por si
+        se ha perdido algún mensaje.
+        '''
+        if self._notify_ready and time.time()-self._last_pull < self._safety_interval:
+            return
+        self.pull()
+
+    def start_listener(self):
+        '''
+        Arranca el hilo que recibe las notificaciones de cambios, si hay
+        canal de notificación configurado. Debe llamarse después de registrar
+        las acciones y en cada proceso tras el fork, ya que los hilos del
+        proceso padre no existen en los hijos.
+        '''
+        if self._notify_conn and self._listener_pid != os.getpid():
+            # el estado del canal heredado del proceso padre no vale en este proceso
+            self._notify_ready = False
+            self._listener_pid = os.getpid()
+            thread = Thread(target=self._listen, name="configstore-listener")
+            thread.daemon = True
+            thread.start()
+
+    def _listen(self):
+        '''
+        Recibe las notificaciones de cambios y descarga la parte de la
+        configuración afectada. Si se pierde la conexión se vuelve a la
+        consulta periódica hasta que se recupera.
+        '''
+        while True:
+            try:
+                pubsub = self._notify_conn.pubsub()
+                pubsub.subscribe(self._notify_channel)
+                for msg in pubsub.listen():
+                    if msg["type"] == "subscribe":
+                        self._notify_ready = True
+                        # cambios que se hayan producido sin canal
+                        self.pull()
+                    elif msg["type"] == "message":
+                        kind, sent = msg["data"].split(":", 1)
+                        with self._pull_lock:
+                            if kind == "a":
+                                self.pull_actions()
+                            else:
+                                self.pull_alternatives()
+                        self.stats["notifications"] += 1
+                        self.stats["delay"] += time.time()-float(sent)
+            except BaseException as e:
+                logging.warn("Config notification channel unavailable: %s" % repr(e))
+            self._notify_ready = False
+            time.sleep(self._notify_retry)
+
+    def _notify(self, kind):
+        '''
+        Avisa a todas las instancias de un cambio en la configuración.
+
+        @type kind: str
+        @param kind: "a" para acciones, "v" para alternativas
+        '''
+        if self._notify_conn:
+            try:
+                self._notify_conn.publish(self._notify_channel, "%s:%f" % (kind, time.time()))
+            except redis.RedisError as e:
+                logging.warn("Can't publish config notification: %s" % repr(e))
+
+    def pop_stats(self):
+        '''
+        Devuelve y reinicia los contadores de consultas a la base de datos de
+        configuración, descargas y notificaciones recibidas, con el retraso
+        medio de propagación de las notificaciones.
+        '''
+        stats, self.stats = self.stats, {"queries": 0, "pulls": 0, "notifications": 0, "delay": 0.}
+        stats["delay"] = stats["delay"]/stats["notifications"] if stats["notifications"] else 0.
+        return stats
 
     def register_action(self, actionid, fnc, *args, **kwargs):
         '''
@@ -144,6 +247,7 @@ class ConfigStore(object):
         now = time.time()
         self.config_conn.config.actions.save({"actionid":actionid, "target":target, "lt":now})
         self.config_conn.end_request()
+        self._notify("a")
 
     def action(self, actionid, *args, **kwargs):
         '''
@@ -174,6 +278,7 @@ class ConfigStore(object):
         while True:
             try:
                 # Operación atómica: obtiene y cambia timestamp para que no se repita
+                self.stats["queries"] += 1
                 action = self.config_conn.config.actions.find_and_modify(query, update={"$set":{"lt":0}})
             except pymongo.errors.AutoReconnect as e:
                 action = None
@@ -189,6 +294,7 @@ class ConfigStore(object):
         del query["actionid"]
 
         try:
+            self.stats["queries"] += 1
             for action in self.config_conn.config.actions.find(query):
                 if action["lt"] > last:
                     last = action["lt"]
@@ -221,6 +327,7 @@ class ConfigStore(object):
         '''
         last = 0
         try:
+            self.stats["queries"] += 1
             for alternative in self.config_conn.config.alternatives.find({
               "_id": { "$in": self._views.keys() },
               "lt" : { "$gt": self._alternatives_lt }
@@ -249,6 +356,7 @@ class ConfigStore(object):
         '''
         self.config_conn.config.alternatives.remove({"_id":altid})
         self.config_conn.end_request()
+        self._notify("v")
 
     def list_alternatives(self, skip=None, limit=None):
         '''
@@ -331,6 +439,7 @@ class ConfigStore(object):
             "config": config,
             "lt": now })
         self.config_conn.end_request()
+        self._notify("v")
 
     def _get_alternative_config(self, endpoint):
         config = self.config_conn.config.alternatives.find_one({"_id":endpoint})
@@ -401,3 +510,106 @@ class ConfigStore(object):
                 selección del aternativas por parámetro GET.
         '''
         return ParamSelector._param_types.keys()
+
+if __name__ == "__main__":
+    # Compara consultas a la base de datos de configuración y retraso de
+    # propagación de cambios de alternativas entre la consulta periódica y
+    # el canal de notificación, con varios workers sobre una base de datos y
+    # un redis falsos en memoria.
+    from Queue import Queue
+
+    WORKERS = 20
+    INTERVAL = 1.    # intervalo de consulta, escalado (60 s en producción)
+    DURATION = 10
+    CHANGES = 8
+
+    class FakeCollection(object):
+        def __init__(self):
+            self.docs = {}
+        def find(self, query={}):
+            ids = query.get("_id", {}).get("$in", None)
+            lt = query.get("lt", {}).get("$gt", None)
+            return [doc.copy() for doc in self.docs.values()
+                    if (ids is None or doc["_id"] in ids) and (lt is None or doc["lt"]>lt)]
+        def find_one(self, query):
+            doc = self.docs.get(query["_id"], None)
+            return doc and doc.copy()
+        def find_and_modify(self, query, update):
+            return None
+        def save(self, doc):
+            self.docs[doc.get("_id", None)] = doc
+
+    class FakeConn(object):
+        def __init__(self):
+            self.config = self
+            self.actions = FakeCollection()
+            self.alternatives = FakeCollection()
+        def end_request(self):
+            pass
+
+    class FakeRedis(object):
+        subscribers = []
+        def publish(self, channel, data):
+            for queue in self.subscribers:
+                queue.put({"type": "message", "channel": channel, "data": data})
+        def pubsub(self):
+            return self
+        def subscribe(self, channel):
+            self.queue = Queue()
+            self.subscribers.append(self.queue)
+        def listen(self):
+            yield {"type": "subscribe"}
+            while True:
+                yield self.queue.get()
+
+    class FakeSelect(object):
+        current_config = {}
+        delays = []
+        def config(self, config):
+            self.delays.append(time.time()-config["stamp"])
+
+    class FakeView(object):
+        select = FakeSelect()
+
+    def run(notify):
+        conn = FakeConn()
+        FakeRedis.subscribers = []
+        FakeSelect.delays = []
+        stores = []
+        for i in xrange(WORKERS+1):
+            store = ConfigStore()
+            store.config_conn = conn
+            store._appid = "test"
+            store._views = {"endpoint": FakeView()} if i else {}
+            store._alternatives_lt = time.time()
+            if notify:
+                store._notify_conn = FakeRedis()
+                store._notify_channel = "config"
+                store.start_listener()
+            stores.append(store)
+        admin, workers = stores[0], stores[1:]
+
+        running = [True]
+        def poller(store):
+            while running[0]:
+                time.sleep(INTERVAL)
+                store.poll()
+        threads = [Thread(target=poller, args=(store,)) for store in workers]
+        for thread in threads: thread.start()
+
+        for i in xrange(CHANGES):
+            time.sleep(float(DURATION)/CHANGES)
+            admin.update_alternative_config("endpoint", {"stamp": time.time()})
+        time.sleep(INTERVAL)
+        running[0] = False
+        for thread in threads: thread.join()
+
+        stats = [store.pop_stats() for store in workers]
+        queries = sum(s["queries"] for s in stats)
+        delays = sorted(FakeSelect.delays)
+        print "%-12s %4d queries (%5.1f per worker and interval), %3d changes applied, delay mean %6.1f ms max %6.1f ms" % (
+            "notification" if notify else "polling", queries, queries/float(WORKERS)/(DURATION/INTERVAL),
+            len(delays), sum(delays)*1000/len(delays) if delays else 0, delays[-1]*1000 if delays else 0)
+
+    run(False)
+    run(True)
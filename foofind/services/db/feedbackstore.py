@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
-import pymongo
-from foofind.utils import hex2mid, check_capped_collections
+import pymongo, atexit, os, zlib
+from bson import Binary, ObjectId
+from bson.errors import InvalidId
+from Queue import Queue, Full, Empty
+from threading import Thread, Lock, Event, current_thread
+from foofind.utils import hex2mid, check_capped_collections, logging
 from hashlib import sha256
 from datetime import datetime
 from time import time
@@ -13,7 +17,8 @@ class FeedbackStore(object):
         "visited_links":100000,
         "notify_indir":100000,
         "notify_source":100000,
-        "profiler":100000,
+        "profiler_summary":50000,
+        "sampler_reports":{"max":500, "size":64*1024*1024},
         }
     def __init__(self):
         '''
@@ -22,6 +27,19 @@ class FeedbackStore(object):
         self.feedback_conn = None
         self.initialized = False
 
+        # escritura diferida
+        self.write_queue = Queue(10000)
+        self.write_batch_size = 500
+        self.write_interval = 1
+        self.flush_timeout = 10
+        self.dropped = 0
+        self.reported_dropped = 0
+        self._writer = None
+        self._writer_pid = None
+        self._writer_lock = Lock()
+        self._stopping = Event()
+        atexit.register(self.flush)
+
     def init_app(self, app):
         '''
         Apply users database access configuration.
@@ -30,6 +48,10 @@ class FeedbackStore(object):
         '''
         if app.config["DATA_SOURCE_FEEDBACK"]:
             self.feedback_conn = pymongo.MongoClient(app.config["DATA_SOURCE_FEEDBACK"], max_pool_size=app.config["DATA_SOURCE_MAX_POOL_SIZE"], slave_okay=True)
+            self.write_queue = Queue(app.config["FEEDBACK_WRITE_QUEUE_SIZE"])
+            self.write_batch_size = app.config["FEEDBACK_WRITE_BATCH_SIZE"]
+            self.write_interval = app.config["FEEDBACK_WRITE_INTERVAL"]
+            self.flush_timeout = app.config["FEEDBACK_FLUSH_TIMEOUT"]
 
             self.init_feedback_conn()
 
@@ -49,6 +71,110 @@ class FeedbackStore(object):
         self.feedback_conn.end_request()
         self.initialized = True
 
+    def _enqueue(self, collection, docs):
+        '''
+        Encola documentos para insertarlos en segundo plano. Si la cola está
+        llena se descartan y se cuentan, sin bloquear la petición.
+
+        @type collection: str
+        @param collection: nombre de la colección de feedback
+
+        @type docs: list
+        @param docs: documentos a insertar
+        '''
+        # el hilo de escritura no sobrevive al fork de los workers
+        if self._writer_pid != os.getpid() or not self._writer.is_alive():
+            with self._writer_lock:
+                if self._writer_pid != os.getpid() or not self._writer.is_alive():
+                    self._stopping.clear()
+                    self._writer = Thread(target=self._write_loop, name="feedback_writer")
+                    self._writer.daemon = True
+                    self._writer.start()
+                    self._writer_pid = os.getpid()
+
+        for doc in docs:
+            try:
+                self.write_queue.put_nowait((collection, doc))
+            except Full:
+                self.dropped += 1
+
+    def _write_loop(self):
+        '''
+        Inserta los documentos encolados agrupados por colección, cuando se
+        alcanza el tamaño de lote o pasa el intervalo de escritura. Al pedir
+        que pare (ver flush) escribe su lote y lo que quede en la cola.
+        '''
+        while not self._stopping.is_set():
+            batch = []
+            deadline = time()+self.write_interval
+            try:
+                while len(batch)<self.write_batch_size:
+                    timeout = deadline-time()
+                    if timeout<=0:
+                        break
+                    batch.append(self.write_queue.get(True, timeout))
+            except Empty:
+                pass
+            self._write(batch)
+        self._write(self._drain())
+
+    def _drain(self):
+        '''
+        Saca de la cola todos los documentos pendientes.
+        '''
+        batch = []
+        try:
+            while True:
+                batch.append(self.write_queue.get_nowait())
+        except Empty:
+            pass
+        return batch
+
+    def _write(self, batch):
+        '''
+        Inserta un lote de documentos, con una inserción por colección.
+
+        @type batch: list
+        @param batch: lista de tuplas (colección, documento)
+        '''
+        if self.dropped != self.reported_dropped:
+            logging.warn("Feedback write queue full, %d documents dropped." % (self.dropped-self.reported_dropped))
+            self.reported_dropped = self.dropped
+
+        if not batch:
+            return
+
+        collections = {}
+        for collection, doc in batch:
+            collections.setdefault(collection, []).append(doc)
+
+        for collection, docs in collections.iteritems():
+            try:
+                # los duplicados (ids ya notificados) no deben impedir el resto de inserciones
+                self.feedback_conn.feedback[collection].insert(docs, continue_on_error=True)
+            except pymongo.errors.DuplicateKeyError:
+                pass
+            except BaseException as e:
+                logging.warn("Error writing %d documents to feedback collection %s: %s" % (len(docs), collection, repr(e)))
+        self.feedback_conn.end_request()
+
+    def flush(self):
+        '''
+        Escribe los documentos pendientes. Se ejecuta al terminar el proceso:
+        pide al hilo de escritura que termine su lote y vacíe la cola, y
+        escribe lo que quede si no lo hace a tiempo.
+        '''
+        writer = self._writer
+        if writer and self._writer_pid == os.getpid() and writer.is_alive() and writer is not current_thread():
+            self._stopping.set()
+            writer.join(self.write_interval+self.flush_timeout)
+            if writer.is_alive():
+                logging.warn("Feedback writer did not finish in %d seconds." % (self.write_interval+self.flush_timeout))
+
+        batch = self._drain()
+        if batch and self.feedback_conn:
+            self._write(batch)
+
     def create_links(self,data):
         '''
         Guarda los enlaces enviados
@@ -60,30 +186,60 @@ class FeedbackStore(object):
         '''
         Guarda un id de fichero en la tabla de errores de indir
         '''
-        self.feedback_conn.feedback.notify_indir.insert({"_id":file_id,"s":server})
-        self.feedback_conn.end_request()
+        self._enqueue("notify_indir", ({"_id":file_id,"s":server},))
 
     def notify_source_error(self, file_id, server):
         '''
         Guarda un id de fichero, y servidor, en la tabla de errores de source
         '''
-        self.feedback_conn.feedback.notify_source.insert({"_id":file_id,"s":server})
-        self.feedback_conn.end_request()
+        self._enqueue("notify_source", ({"_id":file_id,"s":server},))
 
     def visited_links(self,links):
         '''
         Guarda los enlaces visitados en la búsqueda
         '''
-        self.feedback_conn.feedback.visited_links.insert(links)
-        self.feedback_conn.end_request()
+        self._enqueue("visited_links", links)
+
+    def save_profile_summary(self, summary):
+        '''
+        Guarda el resumen de un intervalo del profiler de un proceso.
+        '''
+        self._enqueue("profiler_summary", (summary,))
 
-    def save_profile_info(self, info):
-        info["_date"] = time()
-        self.feedback_conn.feedback.profiler.insert(info)
+    def save_sampler_report(self, report):
+        '''
+        Guarda el informe de un muestreo de pilas, con las pilas comprimidas.
+        '''
+        report = dict(report, stacks=Binary(zlib.compress(report["stacks"])))
+        self._enqueue("sampler_reports", (report,))
+
+    def get_sampler_reports(self, limit=50):
+        '''
+        Obtiene los últimos informes de muestreo de pilas, sin las pilas.
+        '''
+        reports = list(self.feedback_conn.feedback.sampler_reports.find({}, {"stacks":0}).sort("$natural", -1).limit(limit))
         self.feedback_conn.end_request()
+        return reports
+
+    def get_sampler_report(self, report_id):
+        '''
+        Obtiene un informe de muestreo de pilas, o None si no existe.
+        '''
+        try:
+            report = self.feedback_conn.feedback.sampler_reports.find_one({"_id":ObjectId(report_id)})
+        except InvalidId:
+            return None
+        finally:
+            self.feedback_conn.end_request()
+        if report:
+            report["stacks"] = zlib.decompress(report["stacks"])
+        return report
 
-    def get_profile_info(self, start):
-        cursor = self.feedback_conn.feedback.profiler.find({"_date":{"$gt":start}})
+    def get_profile_summaries(self, start):
+        '''
+        Obtiene los resúmenes del profiler posteriores a una fecha.
+        '''
+        cursor = self.feedback_conn.feedback.profiler_summary.find({"_date":{"$gt":start}})
         for document in cursor:
             yield document
         self.feedback_conn.end_request()
@@ -4,11 +4,14 @@ from collections import defaultdict, OrderedDict
 from threading import Lock, Event
 from itertools import permutations
 from datetime import datetime
-from multiprocessing.pool import ThreadPool, TimeoutError
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
 
 import foofind.services
 from foofind.utils import hex2mid, u, Parallel, logging
 from foofind.utils.async import MultiAsync
+from foofind.utils.bloom import BloomFilter
+from foofind.utils.hedging import LatencyWindow, HedgeBudget
 from foofind.services.extensions import cache
 
 profiler = None
@@ -31,6 +34,30 @@ class FilesStore(object):
         self.servers_conn = {}
         self.current_server = -1
 
+        # miembros de cada servidor de ficheros: id -> [(host:puerto, conexión directa)]
+        self.servers_members = {}
+        self.members_latency = {}
+        self.members_role = {}
+        self.members_reads = defaultdict(int)
+        self.hedge_budget = HedgeBudget()
+        self.hedge_min_delay = 0.02
+        self.hedge_min_samples = 20
+        self.latency_window = 200
+        self.probe_interval = 50
+
+        # caché de ubicaciones de ficheros: id -> (servidor, id destino)
+        self.locations = OrderedDict()
+        self.locations_size = 100000
+        self.locations_timeout = 60*60*24
+        self.locations_lock = Lock()
+        self.absent = BloomFilter(100000)
+        self.absent_expiration = 0
+        self.absent_timeout = 60*10
+
+        # campos a obtener de los documentos de ficheros según su uso
+        self.projections = {"full": None}
+        self.add_projection("listing", ("bl", "fn", "src", "se", "z", "ct"))
+
     def init_app(self, app):
         '''
         Inicializa la clase con la configuración de la aplicación.
@@ -42,9 +69,20 @@ class FilesStore(object):
         self.max_autoreconnects = app.config["MAX_AUTORECONNECTIONS"]
         self.secondary_acceptable_latency_ms = app.config["SECONDARY_ACCEPTABLE_LATENCY_MS"]
 
+        self.locations_size = app.config["LOCATION_CACHE_SIZE"]
+        self.locations_timeout = app.config["LOCATION_CACHE_TIMEOUT"]
+        self.absent = BloomFilter(app.config["LOCATION_ABSENT_SIZE"])
+        self.absent_timeout = app.config["LOCATION_ABSENT_TIMEOUT"]
+
         self.thread_pool_size = app.config["GET_FILES_POOL_SIZE"]
         self.thread_pool = None
 
+        self.hedge_budget = HedgeBudget(app.config["GET_FILES_HEDGE_RATIO"], app.config["GET_FILES_HEDGE_BURST"])
+        self.hedge_min_delay = app.config["GET_FILES_HEDGE_MIN_DELAY"]
+        self.hedge_min_samples = app.config["GET_FILES_HEDGE_MIN_SAMPLES"]
+        self.latency_window = app.config["GET_FILES_LATENCY_WINDOW"]
+        self.probe_interval = app.config["GET_FILES_PROBE_INTERVAL"]
+
         self.replica_set = app.config["DATA_SOURCE_SERVER_RS"]
         self.replica_set_tag_sets = app.config.get("DATA_SOURCE_SERVER_RS_TAG_SETS",[{}])
 
@@ -63,34 +101,369 @@ class FilesStore(object):
             sid = str(server_id)
             if not sid in self.servers_conn:
                 self.servers_conn[sid] = self.server_conn if self.replica_set==server["rs"] else pymongo.MongoReplicaSetClient(hosts_or_uri="%s:%d,%s:%d"%(server["ip"], int(server["p"]), server["rip"], int(server["rp"])), replicaSet=server["rs"], max_pool_size=self.max_pool_size, socketTimeoutMS=self.get_files_timeout*1000, read_preference=pymongo.read_preferences.ReadPreference.SECONDARY_PREFERRED, secondary_acceptable_latency_ms=self.secondary_acceptable_latency_ms)
+            if not sid in self.servers_members:
+                self.servers_members[sid] = self._connect_members(sid, server)
+            self._update_members_role(sid, self.replica_set_tag_sets if self.replica_set==server["rs"] else [{}])
             if self.current_server < server_id:
                 self.current_server = server_id
 
-    def _get_server_files(self, params):
+    def _connect_members(self, sid, server):
         '''
-        Usado por el MultiAsync en get_files
+        Crea conexiones directas a cada miembro de la réplica de un servidor,
+        para poder elegir a cuál consultar según su latencia.
+
+        @type sid: str
+        @param sid: id del servidor
 
-        Recupera los datos de los ficheros con los ids dados del
-        servidor mongo indicado por sid y los devuelve a través
-        del objeto async.
+        @type server: dict
+        @param server: documento del servidor en la tabla server
+
+        @rtype list
+        @return miembros del servidor, (host:puerto, conexión)
+        '''
+        members = []
+        for host, port in ((server.get("ip"), server.get("p")), (server.get("rip"), server.get("rp"))):
+            if not host or not port:
+                continue
+            name = "%s:%d" % (host, int(port))
+            if any(name==member[0] for member in members):
+                continue
+            members.append((name, pymongo.MongoClient(host, int(port), max_pool_size=self.max_pool_size, socketTimeoutMS=self.get_files_timeout*1000, connectTimeoutMS=self.get_files_timeout*1000, read_preference=pymongo.read_preferences.ReadPreference.SECONDARY_PREFERRED, _connect=False)))
+            self.members_latency[(sid, name)] = LatencyWindow(self.latency_window)
+
+        # sin miembros conocidos se usa la conexión a la réplica
+        if not members:
+            members.append((sid, self.servers_conn[sid]))
+            self.members_latency[(sid, sid)] = LatencyWindow(self.latency_window)
+        return members
+
+    def _get_thread_pool(self):
+        '''
+        Pool de hilos para las consultas a los miembros de los servidores, creado al usarlo por primera vez.
+        '''
+        if not self.thread_pool:
+            self.thread_pool = ThreadPool(processes=self.thread_pool_size)
+        return self.thread_pool
+
+    def _update_members_role(self, sid, tag_sets):
+        '''
+        Averigua qué miembro de un servidor es el primario y qué miembros son
+        secundarios con las etiquetas pedidas, que son a los que leería la
+        conexión a la réplica. Los miembros se consultan en paralelo desde el
+        pool de hilos, sin esperar respuesta, para que un miembro caído no
+        retrase al eventmanager.
 
-        @param async: objeto async
         @type sid: str
-        @param sid: id de servidor de archivos
-        @type ids: list
-        @param ids: lista de ids a obener
-        '''
-        sid, ids, bl = params
-        data = tuple(
-            self.servers_conn[sid].foofind.foo.find(
-                {"_id": {"$in": ids}}
-                if bl is None else
-                {"_id": {"$in": ids},"bl":bl}))
-        for doc in data:
-            doc["s"] = sid
-        return data
+        @param sid: id del servidor
+
+        @type tag_sets: list
+        @param tag_sets: etiquetas aceptadas para los secundarios, como en la conexión a la réplica
+        '''
+        for name, conn in self.servers_members[sid]:
+            if name==sid:
+                self.members_role[(sid, name)] = None
+            else:
+                self._get_thread_pool().apply_async(self._update_member_role, (sid, name, conn, tag_sets))
+
+    def _update_member_role(self, sid, name, conn, tag_sets):
+        '''
+        Usado por _update_members_role para consultar el estado de un miembro desde el pool de hilos.
+        '''
+        role = None
+        try:
+            status = conn.admin.command("ismaster")
+            tags = status.get("tags", {})
+            if status.get("ismaster"):
+                role = "primary"
+            elif status.get("secondary") and any(all(tags.get(key)==value for key, value in tag_set.iteritems()) for tag_set in tag_sets):
+                role = "secondary"
+        except pymongo.errors.PyMongoError as e:
+            logging.warn("Can't get replica set status from member %s of server %s: %s" % (name, sid, repr(e)))
+        self.members_role[(sid, name)] = role
+
+    def add_projection(self, name, fields):
+        '''
+        Registra un perfil de campos para obtener ficheros.
+
+        @type name: str
+        @param name: nombre del perfil
+
+        @type fields: iterable o None
+        @param fields: campos del documento de fichero, None para obtenerlos todos
+        '''
+        self.projections[name] = None if fields is None else {field:1 for field in fields}
+
+    def _set_local_location(self, fid, location):
+        with self.locations_lock:
+            self.locations[fid] = location
+            while len(self.locations)>self.locations_size:
+                self.locations.popitem(last=False)
+
+    def set_location(self, fid, sid, target=None):
+        '''
+        Guarda en caché la ubicación de un fichero.
+
+        @type fid: ObjectId
+        @param fid: id de fichero
+
+        @type sid: str
+        @param sid: id del servidor
+
+        @type target: ObjectId o None
+        @param target: id con el que se encuentra el fichero en el servidor, si es distinto de fid
+        '''
+        location = (sid, target or fid)
+        self._set_local_location(fid, location)
+        try:
+            cache.cache.set("indir_"+str(fid), location, timeout=self.locations_timeout)
+        except BaseException as e:
+            logging.warn("Error saving file location in cache: %s" % repr(e))
+
+    def forget_location(self, fid):
+        '''
+        Elimina de la caché la ubicación de un fichero.
+
+        @type fid: ObjectId
+        @param fid: id de fichero
+        '''
+        with self.locations_lock:
+            self.locations.pop(fid, None)
+        try:
+            cache.cache.delete("indir_"+str(fid))
+        except BaseException as e:
+            logging.warn("Error removing file location from cache: %s" % repr(e))
 
-    def get_files(self, ids, servers_known = False, bl = 0):
+    def get_cached_locations(self, fids):
+        '''
+        Obtiene las ubicaciones de ficheros de la caché local y de memcached,
+        sin consultar indir.
+
+        @type fids: list
+        @param fids: ids de fichero
+
+        @rtype dict
+        @return ubicaciones encontradas, id -> (servidor, id destino)
+        '''
+        locations = {}
+        missing = []
+        for fid in fids:
+            location = self.locations.get(fid, None)
+            if location:
+                locations[fid] = location
+            else:
+                missing.append(fid)
+
+        if missing:
+            try:
+                keys = {"indir_"+str(fid):fid for fid in missing}
+                for key, location in cache.cache.get_dict(*keys).iteritems():
+                    if location:
+                        locations[keys[key]] = location
+                        self._set_local_location(keys[key], location)
+            except BaseException as e:
+                logging.warn("Error reading file locations from cache: %s" % repr(e))
+
+        return locations
+
+    def get_locations(self, fids):
+        '''
+        Averigua en qué servidor está cada fichero, consultando las cachés
+        antes que indir. Los ids que no están en indir se recuerdan en un
+        filtro de Bloom durante LOCATION_ABSENT_TIMEOUT segundos.
+
+        @type fids: list
+        @param fids: ids de fichero
+
+        @rtype dict
+        @return ubicaciones encontradas, id -> (servidor, id destino)
+        '''
+        locations = self.get_cached_locations(fids)
+
+        now = time.time()
+        if self.absent_expiration<now or self.absent.full():
+            self.absent.clear()
+            self.absent_expiration = now+self.absent_timeout
+
+        missing = [fid for fid in fids if not fid in locations and not fid.binary in self.absent]
+        if missing:
+            for ind in self.server_conn.foofind.indir.find({"_id": {"$in": missing}, "s": {"$exists": 1}}):
+                if not ind["s"]:
+                    continue
+                indserver = str(int(ind["s"])) # Bug en indir: 's' como float
+                target = ind.get("t", ind["_id"]) # si apunta a otro id, se busca ese id
+                self.set_location(ind["_id"], indserver, target)
+                locations[ind["_id"]] = (indserver, target)
+            self.server_conn.end_request()
+
+            for fid in missing:
+                if not fid in locations:
+                    self.absent.add(fid.binary)
+
+        return locations
+
+    def _choose_member(self, sid, exclude=()):
+        '''
+        Elige el miembro de un servidor al que enviar una consulta entre los
+        secundarios con las etiquetas pedidas, como haría la conexión a la
+        réplica, o si no hay ninguno, el primario y después el resto. Entre
+        ellos se sigue el orden de la tabla server salvo que otro responda más
+        rápido por más de SECONDARY_ACCEPTABLE_LATENCY_MS, y de vez en cuando
+        se consulta a otro secundario para mantener al día su latencia.
+
+        @type sid: str
+        @param sid: id del servidor
+
+        @type exclude: list
+        @param exclude: miembros ya consultados
+
+        @rtype int o None
+        @return posición del miembro, o None si no quedan miembros
+        '''
+        members = self.servers_members[sid]
+        candidates = [index for index in xrange(len(members)) if not index in exclude]
+        if not candidates:
+            return None
+
+        # secundarios elegibles o, en su defecto, el primario antes que los miembros sin estado conocido
+        roles = [self.members_role.get((sid, members[index][0])) for index in candidates]
+        if "secondary" in roles:
+            candidates = [index for index, role in zip(candidates, roles) if role=="secondary"]
+        elif "primary" in roles:
+            return candidates[roles.index("primary")]
+
+        self.members_reads[sid] += 1
+        if not exclude and len(candidates)>1 and self.members_reads[sid]%self.probe_interval==0:
+            return candidates[(self.members_reads[sid]/self.probe_interval)%len(candidates)]
+
+        acceptable = self.secondary_acceptable_latency_ms/1000.
+        best, best_latency = candidates[0], self.members_latency[(sid, members[candidates[0]][0])].p50
+        for index in candidates[1:]:
+            latency = self.members_latency[(sid, members[index][0])].p50
+            if latency is not None and (best_latency is None or latency+acceptable<best_latency):
+                best, best_latency = index, latency
+        return best
+
+    def _hedge_delay(self, sid, member):
+        '''
+        Tiempo de espera antes de duplicar una consulta: el percentil 95 del
+        miembro consultado, sin pasar del de una latencia sana, que es la del
+        mejor de los otros miembros del servidor o, si no hay datos de ellos,
+        la mediana de todos los miembros. Así un miembro siempre lento no
+        retrasa sus propias repeticiones. Nunca pasa de la mitad del tiempo
+        máximo, que es también la espera si aún no hay datos.
+        '''
+        name = self.servers_members[sid][member][0]
+        latency = self.members_latency[(sid, name)]
+        if len(latency)<self.hedge_min_samples:
+            return self.get_files_timeout/2.
+
+        others = [window.p95 for (server, member_name), window in self.members_latency.items()
+                  if server==sid and member_name!=name and len(window)>=self.hedge_min_samples]
+        if others:
+            healthy = min(others)
+        else:
+            known = sorted(window.p95 for window in self.members_latency.values() if len(window)>=self.hedge_min_samples)
+            healthy = known[len(known)/2]
+        return min(max(self.hedge_min_delay, min(latency.p95, healthy)), self.get_files_timeout/2.)
+
+    def _get_member_files(self, params):
+        '''
+        Usado por get_files para consultar un miembro de un servidor desde el
+        pool de hilos. Registra la latencia aunque la respuesta llegue tarde.
+
+        @rtype tuple
+        @return id del servidor, miembro y documentos, o la excepción producida
+        '''
+        sid, member, ids, bl, fields = params
+        name, conn = self.servers_members[sid][member]
+        start = time.time()
+        try:
+            data = tuple(conn.foofind.foo.find({"_id": {"$in": ids}} if bl is None else {"_id": {"$in": ids},"bl":bl}, fields))
+            for doc in data:
+                doc["s"] = sid
+        except BaseException as e:
+            data = e
+        self.members_latency[(sid, name)].record(time.time()-start)
+        return sid, member, data
+
+    def _get_files_hedged(self, sids, bl, fields):
+        '''
+        Obtiene los ficheros de cada servidor en paralelo. Si un servidor tarda
+        más que su percentil 95, repite la consulta en otro miembro de la
+        réplica y se queda con la primera respuesta. Las repeticiones están
+        limitadas a una fracción de las consultas (GET_FILES_HEDGE_RATIO).
+
+        @type sids: dict
+        @param sids: ids de ficheros de cada servidor
+
+        @rtype list
+        @return documentos obtenidos antes de GET_FILES_TIMEOUT
+        '''
+        responses = Queue()
+        start = time.time()
+        end = start+self.get_files_timeout
+        reads = {}
+        for sid, ids in sids.iteritems():
+            member = self._choose_member(sid)
+            # ids, miembros consultados, consultas sin respuesta, momento de duplicar
+            reads[sid] = [ids, [member], 1, start+self._hedge_delay(sid, member)]
+            self.hedge_budget.request()
+            self._get_thread_pool().apply_async(self._get_member_files, ((sid, member, ids, bl, fields),), callback=responses.put)
+
+        results = []
+        while reads:
+            now = time.time()
+            if now>=end:
+                break
+            try:
+                sid, member, data = responses.get(True, max(0, min([end]+[read[3] for read in reads.itervalues() if read[3]])-now))
+            except Empty:
+                sid = None
+
+            read = reads.get(sid)
+            if read:
+                read[2] -= 1
+                if not isinstance(data, BaseException):
+                    results.extend(data)
+                    del reads[sid]
+                else:
+                    logging.warn("Error getting files from server %s (%s): %s" % (sid, self.servers_members[sid][member][0], repr(data)))
+                    if not read[2]:
+                        # sin consultas pendientes: se prueba otro miembro si no se ha hecho ya
+                        if read[3]:
+                            read[3] = now
+                        else:
+                            del reads[sid]
+
+            # duplica las consultas que tardan más de lo normal
+            now = time.time()
+            for sid, read in reads.items():
+                if read[3] and read[3]<=now:
+                    read[3] = None
+                    member = self._choose_member(sid, read[1])
+                    if member is None or read[2] and not self.hedge_budget.hedge():
+                        if not read[2]:
+                            del reads[sid]
+                        continue
+                    read[1].append(member)
+                    read[2] += 1
+                    self.thread_pool.apply_async(self._get_member_files, ((sid, member, read[0], bl, fields),), callback=responses.put)
+
+        if reads:
+            logging.warn("Timeout getting files from servers %s." % ", ".join(sorted(reads)))
+        return results
+
+    def get_hedging_stats(self):
+        '''
+        Obtiene las latencias de cada miembro de los servidores y las consultas duplicadas.
+
+        @rtype dict
+        @return latencias por miembro, (p50, p95, consultas), y consultas duplicadas y denegadas
+        '''
+        return {"members": {"%s/%s" % key: (latency.p50, latency.p95, len(latency)) for key, latency in self.members_latency.iteritems()},
+                "hedged": self.hedge_budget.hedged, "denied": self.hedge_budget.denied}
+
+    def get_files(self, ids, servers_known = False, bl = 0, projection = "full"):
         '''
         Devuelve los datos de los ficheros correspondientes a los ids
         dados en formato hexadecimal.
@@ -102,11 +475,15 @@ class FilesStore(object):
         @type bl: int o None
         @param bl: valor de bl para buscar, None para no restringir
 
+        @type projection: str
+        @param projection: perfil de campos a obtener (ver add_projection)
+
         @rtype generator
         @return Generador con los documentos de ficheros
         '''
 
         if not ids: return ()
+        fields = self.projections[projection]
 
         sids = defaultdict(list)
         # si conoce los servidores en los que están los ficheros,
@@ -117,46 +494,16 @@ class FilesStore(object):
                 sids[x[1]].append(hex2mid(x[0]))
         else:
             # averigua en qué servidor está cada fichero
-            nindir = self.server_conn.foofind.indir.find({"_id": {"$in": [hex2mid(fid) for fid in ids]}, "s": {"$exists": 1}})
-            for ind in nindir:
-                indserver = str(int(ind["s"])) # Bug en indir: 's' como float
+            for indserver, target in self.get_locations([hex2mid(fid) for fid in ids]).itervalues():
                 if indserver in self.servers_conn:
-                    if "t" in ind: # si apunta a otro id, lo busca en vez del id dado
-                        sids[indserver].append(ind["t"])
-                    else:
-                        sids[indserver].append(ind["_id"])
-            self.server_conn.end_request()
+                    sids[indserver].append(target)
 
-        lsids = len(sids)
-        if lsids == 0:
+        if not sids:
             # Si no hay servidores, no hay ficheros
             return ()
-        elif lsids == 1:
-            k, v = sids.iteritems().next()
-            return self._get_server_files((k, v, bl))
-        else:
-            # crea el pool de hilos si no existe
-            if not self.thread_pool:
-                self.thread_pool = ThreadPool(processes=self.thread_pool_size)
-
-            # obtiene la información de los ficheros de cada servidor
-            results = []
-            chunks = self.thread_pool.imap_unordered(self._get_server_files, ((k, v, bl) for k, v in sids.iteritems()))
-            end = time.time()+self.get_files_timeout
-            try:
-                for i in xrange(len(sids)):
-                    now = time.time()
-                    if now>end:
-                        break
-                    for r in chunks.next(end-now):
-                        results.append(r)
-            except TimeoutError:
-                pass
-            except BaseException as e:
-                logging.error("Error on get_files.")
-            return results
+        return self._get_files_hedged(sids, bl, fields)
 
-    def get_file(self, fid, sid=None, bl=0):
+    def get_file(self, fid, sid=None, bl=0, projection="full"):
         '''
         Obtiene un fichero del servidor
 
@@ -169,25 +516,24 @@ class FilesStore(object):
         @type bl: int o None
         @param bl: valor de bl para buscar, None para no restringir
 
+        @type projection: str
+        @param projection: perfil de campos a obtener (ver add_projection)
+
         @rtype mongodb document
         @return Documento del fichero
         '''
         if sid is None:
             # averigua en qué servidor está el fichero
-            ind = self.server_conn.foofind.indir.find_one({"_id":fid})
-            # Verificación para evitar basura de indir
-            if ind is None or not "s" in ind or not ind["s"]:
+            location = self.get_locations([fid]).get(fid, None)
+            if location is None:
                 return None
-            sid = str(int(ind["s"]))
+            sid, fid = location
             if not sid in self.servers_conn:
                 return None
-            if "t" in ind:
-                fid = ind["t"]
-            self.server_conn.end_request()
 
         data = self.servers_conn[sid].foofind.foo.find_one(
             {"_id":fid} if bl is None else
-            {"_id":fid,"bl":bl})
+            {"_id":fid,"bl":bl}, self.projections[projection])
         if data:
             data["s"] = sid
         return data
@@ -235,6 +581,7 @@ class FilesStore(object):
                 update["$unset"][rem] = 1
 
         fid = hex2mid(data["_id"])
+        self.forget_location(fid)
         _indir = self.server_conn.foofind.indir.find_one({"_id": fid})
         if _indir and "t" in _indir:
             fid = hex2mid(_indir['t'])
@@ -275,7 +622,7 @@ class FilesStore(object):
         '''
         Obtiene los últimos ficheros del último mongo
         '''
-        data = tuple( self.servers_conn[str(self.current_server)].foofind.foo.find({"bl":0})
+        data = tuple( self.servers_conn[str(self.current_server)].foofind.foo.find({"bl":0}, self.projections["listing"])
             .sort([("$natural",-1)])
             .skip(offset)
             .limit(n) )
@@ -554,3 +901,107 @@ class FilesStore(object):
 
         self.server_conn.foofind.server.update({"_id":{"$in":[oid, int(oid)]}}, update)
         self.server_conn.end_request()
+
+if __name__ == "__main__":
+    # Compara bytes transferidos y tiempo de decodificación por página de
+    # resultados con cada perfil de campos.
+    # Uso: python -m foofind.services.db.filesstore mongodb://servidor [ficheros]
+    #      python -m foofind.services.db.filesstore hedging
+    # hedging simula servidores de ficheros cuyos miembros responden con los
+    # retrasos de cada escenario y compara get_files con consultas duplicadas
+    # y sin ellas, consultando siempre al mismo secundario, como antes. En
+    # cada servidor el puerto 27017 es el primario y el 27018 el secundario.
+    import sys
+
+    if sys.argv[1:2]==["hedging"]:
+        import random
+        from foofind import defaults
+        from sphinxservice.metrics import Histogram
+
+        SERVERS, PAGES, IDS = 3, 150, 10
+        delays = {}
+        class FakeMember(object):
+            '''
+            Miembro de una réplica que responde con el retraso de su escenario.
+            '''
+            def __init__(self, host=None, port=None, *args, **kwargs):
+                self.name = "%s:%d" % (host, port)
+                self.foofind = self
+                self.foo = self
+                self.admin = self
+                self.queries = 0
+
+            def command(self, name):
+                primary = self.name.endswith(":27017")
+                return {"ismaster": primary, "secondary": not primary}
+
+            def find(self, spec=None, fields=None):
+                self.queries += 1
+                time.sleep(delays[self.name]())
+                return [{"_id": fid, "bl": 0} for fid in spec["_id"]["$in"]]
+
+        class FakeReplicaSet(object):
+            def __init__(self, *args, **kwargs):
+                self.foofind = self
+                self.server = self
+            def find(self, spec=None, fields=None):
+                return [{"_id": float(server), "rs": "rs%d" % server, "ip": "server%d" % server, "p": 27017, "rip": "server%d" % server, "rp": 27018}
+                        for server in xrange(SERVERS)]
+
+        pymongo.MongoClient = FakeMember
+        pymongo.MongoReplicaSetClient = FakeReplicaSet
+        class FakeApp:
+            config = {key: getattr(defaults, key) for key in dir(defaults) if key.isupper()}
+            config.update(GET_FILES_TIMEOUT=0.5, DATA_SOURCE_SERVER_RS="rs")
+
+        rnd = random.Random(0)
+        fast = lambda: rnd.uniform(0.002, 0.006)
+        scenarios = [
+            ("healthy", {}),
+            ("one slow secondary (150 ms)", {"server1:27018": lambda: rnd.uniform(0.14, 0.16)}),
+            ("one secondary stalls 10% (800 ms)", {"server1:27018": lambda: 0.8 if rnd.random()<0.1 else fast()}),
+            ("all members slow (50-100 ms)", {"server%d:%d" % (server, port): lambda: rnd.uniform(0.05, 0.1) for server in xrange(SERVERS) for port in (27017, 27018)}),
+            ]
+        print "%-34s %-10s %9s %9s %9s %8s %8s" % ("scenario", "mode", "p50 ms", "p99 ms", "max ms", "dropped", "extra")
+        for label, scenario in scenarios:
+            for mode in ("fixed", "hedged"):
+                store = FilesStore()
+                store.init_app(FakeApp())
+                if mode=="fixed":
+                    store.hedge_budget = HedgeBudget(0, 0)
+                    store.probe_interval = sys.maxint
+                store.load_servers_conn()
+                time.sleep(0.1) # espera a conocer el estado de los miembros
+                for name in ("server%d:%d" % (server, port) for server in xrange(SERVERS) for port in (27017, 27018)):
+                    delays[name] = scenario.get(name, fast)
+
+                histogram = Histogram()
+                dropped = queries = 0
+                for page in xrange(PAGES):
+                    ids = [(bson.ObjectId(), str(server)) for server in xrange(SERVERS) for i in xrange(IDS)]
+                    start = time.time()
+                    files = store.get_files([(str(fid), server) for fid, server in ids], True)
+                    histogram.record(time.time()-start)
+                    dropped += SERVERS-len(set(doc["s"] for doc in files))
+                time.sleep(0.9) # espera a las consultas que siguen en curso
+                queries = sum(member.queries for members in store.servers_members.itervalues() for name, member in members)
+                p50, p99 = histogram.percentiles(50, 99)
+                print "%-34s %-10s %9.1f %9.1f %9.1f %8d %7.1f%%" % (label, mode, p50*1000, p99*1000, histogram.max/1000., dropped, (queries*100./(PAGES*SERVERS))-100)
+        sys.exit(0)
+
+    import foofind.blueprints.files.fill_data # registra el perfil de búsqueda
+    from foofind.services import filesdb
+
+    PAGE = 10
+    conn = pymongo.MongoClient(sys.argv[1])
+    n = int(sys.argv[2]) if len(sys.argv)>2 else 1000
+    ids = [doc["_id"] for doc in conn.foofind.foo.find({"bl":0}, {"_id":1}).limit(n)]
+    pages = max(1, len(ids)/PAGE)
+
+    for name, fields in sorted(filesdb.projections.iteritems()):
+        raw = [bson.BSON.encode(doc) for doc in conn.foofind.foo.find({"_id":{"$in":ids}}, fields)]
+        t = time.time()
+        for doc in raw:
+            bson.BSON(doc).decode()
+        t = time.time()-t
+        print "%-8s %8d bytes/page %8.3f ms/page decoding" % (name, sum(len(doc) for doc in raw)/pages, t*1000/pages)
@@ -4,11 +4,36 @@ from bson.code import Code
 from hashlib import sha256
 from datetime import datetime
 from time import time
+from math import exp
+from itertools import chain
 
 from foofind.utils import hex2mid, check_collection_indexes, userid_parse, mid2hex, logging
 from foofind.services.extensions import cache
 
 
+def file_votes_summary(positive, negative):
+    '''
+    Obtiene los valores de votos de un idioma a partir de sus contadores, con
+    el formato que generaba el antiguo map-reduce: karma entre 0 y 1 con la
+    función 1/1+E^(-X), cuenta de votos y suma de votos positivos y negativos.
+
+    @type positive: int
+    @param positive: número de votos positivos
+
+    @type negative: int
+    @param negative: número de votos negativos
+
+    @rtype dict
+    @return diccionario con los valores "t", "c" y "s"
+    '''
+    # con votos de +1 y -1, (s0*c0+s1*c1)/(c0+c1) se reduce a la diferencia
+    difference = positive - negative
+    return {
+        "t": 1/(1+exp(-difference)) if difference > -700 else 0.,
+        "c": [positive, negative],
+        "s": [positive, -negative],
+        }
+
 class UsersStore(object):
     '''
     Clase para acceder a los datos de los usuarios.
@@ -34,7 +59,11 @@ class UsersStore(object):
             ),
         "comment_vote": (
             {"key": [("f", 1)]},
-            )
+            ),
+        "vote_sum": (
+            {"key": [("f", 1), ("l", 1)], "unique":1},
+            {"key": [("r", 1)]},
+            ),
         }
 
     def __init__(self):
@@ -193,7 +222,14 @@ class UsersStore(object):
 
     def set_file_vote(self, file_id, user, lang, vote):
         '''
-        Guarda el voto en la colección y actualiza el archivo correspondiente con los nuevos datos
+        Guarda el voto en la colección y actualiza los contadores del archivo.
+
+        Los contadores de votos positivos y negativos de cada archivo e idioma
+        se mantienen con $inc a partir del voto anterior del usuario, sin
+        recorrer el resto de votos del archivo.
+
+        @rtype dict
+        @return diccionario de la forma idioma:valores, ver file_votes_summary
         '''
         data  = {
             "u": user.id,
@@ -201,57 +237,99 @@ class UsersStore(object):
             "d": datetime.utcnow(),
             "l": lang,
             }
+        file_hex = mid2hex(file_id)
         # TODO(felipe): borrar con error solucionado
         if user.id < 0 and user.is_authenticated():
             logging.error("Inconsistencia de usuario votando logeado id negativo.", extra=locals())
         else:
             if user.is_authenticated():
-                data["_id"] =  "%s_%s" % (mid2hex(file_id), user.id)
-                self.user_conn.users.vote.update(
-                    {"_id": data["_id"]}, data, upsert=True)
+                data["_id"] =  "%s_%s" % (file_hex, user.id)
+                query = {"_id": data["_id"]}
             else:
-                data["_id"] = "%s:%s" % (mid2hex(file_id), user.session_ip)
-                self.user_conn.users.vote.update(
-                    {"_id": data["_id"], "u": data["u"]},
-                    data, upsert=True)
+                data["_id"] = "%s:%s" % (file_hex, user.session_ip)
+                query = {"_id": data["_id"], "u": data["u"]}
+
+            # obtiene el voto anterior en la misma operación que guarda el nuevo
+            previous = self.user_conn.users.vote.find_and_modify(query, data, upsert=True, new=False)
+
+            # deshace el voto anterior y suma el nuevo
+            increments = {}
+            if previous:
+                key = (previous.get("l"), "p" if previous["k"]>0 else "n")
+                increments[key] = increments.get(key, 0) - 1
+            key = (lang, "p" if data["k"]>0 else "n")
+            increments[key] = increments.get(key, 0) + 1
+
+            updates = {}
+            for (vote_lang, field), value in increments.iteritems():
+                if value:
+                    updates.setdefault(vote_lang, {})[field] = value
+            for vote_lang, inc in updates.iteritems():
+                self.user_conn.users.vote_sum.update({"f": file_hex, "l": vote_lang}, {"$inc": inc}, upsert=True)
 
-        # Para cada idioma guarda el karma, la cuenta total y la suma
-        map_function = Code('''
-            function()
-            {
-                emit(this.l,{
-                    k:this.k,
-                    c:new Array((this.k>0)?1:0,(this.k<0)?1:0),
-                    s:new Array((this.k>0)?this.k:0,(this.k<0)?this.k:0)
-                })
-            }''')
-        # Suma todo y aplica la funcion 1/1+E^(-X) para que el valor este entre 0 y 1
-        reduce_function = Code('''
-            function(lang, vals)
-            {
-                c=new Array(0,0);
-                s=new Array(0,0);
-                for (var i in vals)
-                {
-                    c[0]+=vals[i].c[0];
-                    c[1]+=vals[i].c[1];
-                    s[0]+=vals[i].s[0];
-                    s[1]+=vals[i].s[1];
-                }
-                return {t:1/(1+Math.exp(-((s[0]*c[0]+s[1]*c[1])/(c[0]+c[1])))), c:c, s:s};
-            }''')
-        # Tercer parametro para devolverlo en vez de generar una coleccion nueva
-        votes = self.user_conn.users.vote.map_reduce(
-            map_function,
-            reduce_function,
-            {"inline": 1},
-            query = {"_id": {"$regex": "^%s" % mid2hex(file_id)}}
-            )
-        # Devolver un diccionario de la forma idioma:valores
-        data = {values["_id"]: values["value"] for values in votes["results"]}
+            if user.is_authenticated():
+                self.get_file_user_state.flush(self, file_id, user)
+
+        data = self.get_file_votes(file_id)
         self.user_conn.end_request()
         return data
 
+    def get_file_votes(self, file_id):
+        '''
+        Obtiene los contadores de votos de un archivo.
+
+        @type file_id: ObjectId
+        @param file_id: id del archivo
+
+        @rtype dict
+        @return diccionario de la forma idioma:valores, ver file_votes_summary
+        '''
+        data = {doc["l"]: file_votes_summary(doc.get("p", 0), doc.get("n", 0))
+                for doc in self.user_conn.users.vote_sum.find({"f": mid2hex(file_id)})}
+        self.user_conn.end_request()
+        return data
+
+    def rebuild_file_votes(self, file_id=None):
+        '''
+        Reconstruye los contadores de votos a partir de los votos guardados,
+        de un archivo o de todos. Para reconstruir todos los contadores se
+        recorren los votos por orden de _id, que empieza por el id del archivo,
+        de modo que sólo se mantienen en memoria los contadores de un archivo.
+
+        @type file_id: ObjectId
+        @param file_id: id del archivo, o None para reconstruir todos
+
+        @rtype generator
+        @return genera tuplas (id de archivo en hexadecimal, diccionario de
+                la forma idioma:valores) con los contadores reconstruidos
+        '''
+        stamp = datetime.utcnow()
+        query = {"_id": {"$regex": "^%s" % mid2hex(file_id)}} if file_id else {}
+        cursor = self.user_conn.users.vote.find(query, {"k":1, "l":1}).sort("_id", 1)
+
+        current = None
+        counts = {}
+        for vote in chain(cursor, ({"_id": None},)):
+            file_hex = vote["_id"][:24] if vote["_id"] else None
+            if file_hex != current:
+                if current:
+                    self.user_conn.users.vote_sum.remove({"f": current})
+                    self.user_conn.users.vote_sum.insert([{"f": current, "l": lang, "p": p, "n": n, "r": stamp}
+                                                          for lang, (p, n) in counts.iteritems()])
+                    yield current, {lang: file_votes_summary(p, n) for lang, (p, n) in counts.iteritems()}
+                current = file_hex
+                counts = {}
+            if file_hex:
+                lang_counts = counts.setdefault(vote.get("l"), [0, 0])
+                lang_counts[0 if vote["k"]>0 else 1] += 1
+
+        # contadores de archivos sin votos, excepto los creados durante la reconstrucción
+        if file_id:
+            self.user_conn.users.vote_sum.remove({"f": mid2hex(file_id), "r": {"$lt": stamp}})
+        else:
+            self.user_conn.users.vote_sum.remove({"r": {"$lt": stamp}})
+        self.user_conn.end_request()
+
     @cache.memoize(timeout=60*60)
     def list_fav_lists(self, user):
         '''
@@ -319,6 +397,7 @@ class UsersStore(object):
         @param listname: Nombre de la lista para los favoritos con nombre (category = 0)
         '''
         self.list_fav_files.flush(self, user)
+        self.get_file_user_state.flush(self, fileid, user)
         self.user_conn.users.favfile.update(
             {"user_id": user.id, "name": listname if category == 0 else None, "type": category},
             {"$addToSet":{
@@ -343,6 +422,7 @@ class UsersStore(object):
         @param listname: Nombre de la lista para los favoritos con nombre (category = 0)
         '''
         self.list_fav_files.flush(self, user)
+        self.get_file_user_state.flush(self, fileid, user)
         self.user_conn.users.favfile.update(
             {"user_id": user.id, "name":listname if category == 0 else None, "type":category},
             {"$pull": {"files": {"id": fileid}}})
@@ -422,6 +502,7 @@ class UsersStore(object):
             "t": comment
             })
         self.user_conn.end_request()
+        self.get_file_comments_authors.flush(self, file_id, lang)
         return data
 
     def get_file_comments_sum(self, file_id):
@@ -446,6 +527,107 @@ class UsersStore(object):
             yield document
         self.user_conn.end_request()
 
+    @cache.memoize(timeout=60)
+    def get_file_user_state(self, file_id, user):
+        '''
+        Obtiene el voto de un usuario registrado para un archivo, en cualquier
+        idioma, y si lo tiene en su lista de favoritos. La lista se consulta
+        por el id del archivo, sin traerla entera.
+
+        @type file_id: ObjectId
+        @param file_id: id del archivo
+
+        @param user: objeto usuario
+
+        @rtype tuple
+        @return voto del usuario o None, y si el archivo está en sus favoritos
+        '''
+        vote = self.user_conn.users.vote.find_one({"_id": "%s_%s" % (mid2hex(file_id), user.id)})
+        favorite = self.user_conn.users.favfile.find_one(
+            {"user_id": user.id, "type": 1, "name": None, "files.id": file_id},
+            {"_id": 1}) is not None
+        self.user_conn.end_request()
+        return vote, favorite
+    get_file_user_state.make_cache_key = lambda self, file_id, user: "memoized/usersstore.get_file_user_state/%s/%s" % (user.id, mid2hex(file_id))
+
+    @cache.memoize(timeout=60)
+    def get_file_comments_authors(self, file_id, lang):
+        '''
+        Recupera los comentarios de un archivo junto con sus autores, que se
+        obtienen todos en una sola consulta.
+
+        @type file_id: ObjectId
+        @param file_id: id del archivo
+
+        @type lang: str
+        @param lang: idioma de los comentarios
+
+        @rtype list
+        @return lista de tuplas (comentario, autor), con autor None si ya no existe
+        '''
+        comments = list(self.user_conn.users.comment.find({"f": hex2mid(file_id), "l": lang}))
+        authors = {}
+        if comments:
+            authors_ids = list({userid_parse(comment["_id"].split("_")[0]) for comment in comments})
+            authors = {author["_id"]: author for author in self.user_conn.users.users.find(
+                        {"_id": {"$in": authors_ids}}, {"username": 1, "location": 1})}
+        self.user_conn.end_request()
+        return [(comment, authors.get(userid_parse(comment["_id"].split("_")[0]))) for comment in comments]
+    get_file_comments_authors.make_cache_key = lambda self, file_id, lang: "memoized/usersstore.get_file_comments_authors/%s/%s" % (mid2hex(file_id), lang)
+
+    def declare_file_page_state(self, file_id, user, lang, comments=True):
+        '''
+        Declara las claves de caché que usa get_file_page_state, para que se
+        pidan a memcached junto con las demás claves de la página.
+
+        @type file_id: ObjectId
+        @param file_id: id del archivo
+
+        @param user: objeto usuario
+
+        @type lang: str
+        @param lang: idioma del voto y de los comentarios
+
+        @type comments: bool
+        @param comments: si se van a obtener los comentarios
+        '''
+        if user.is_authenticated():
+            cache.declare_call(self.get_file_user_state, file_id, user)
+        if comments:
+            cache.declare_call(self.get_file_comments_authors, file_id, lang)
+
+    def get_file_page_state(self, file_id, user, lang, comments=True):
+        '''
+        Obtiene los datos de usuarios de la página de un archivo: voto y
+        favorito del usuario y comentarios con sus autores. Cada parte se
+        guarda en caché un minuto y las dos se piden juntas a memcached.
+
+        @type file_id: ObjectId
+        @param file_id: id del archivo
+
+        @param user: objeto usuario
+
+        @type lang: str
+        @param lang: idioma del voto y de los comentarios
+
+        @type comments: bool
+        @param comments: si hay que obtener los comentarios
+
+        @rtype dict
+        @return voto del usuario en el idioma o None ("vote"), si el archivo
+                está en sus favoritos ("favorite") y lista de tuplas
+                (comentario, autor) ("comments")
+        '''
+        self.declare_file_page_state(file_id, user, lang, comments)
+
+        authenticated = user.is_authenticated()
+        vote, favorite = self.get_file_user_state(file_id, user) if authenticated else (None, False)
+        return {
+            "vote": vote if vote and vote.get("l") == lang else None,
+            "favorite": favorite,
+            "comments": self.get_file_comments_authors(file_id, lang) if comments else [],
+            }
+
     def set_file_comment_vote(self,comment_id,user,file_id,vote):
         '''
         Guarda el comentario en la colección y actualiza el archivo correspondiente con los nuevos datos
@@ -499,3 +681,157 @@ class UsersStore(object):
         for document in cursor:
             yield cursor
         self.user_conn.end_request()
+
+if __name__ == "__main__":
+    # Uso: python -m foofind.services.db.usersstore mongodb://servidor rebuild
+    #      python -m foofind.services.db.usersstore mongodb://servidor benchmark
+    #      python -m foofind.services.db.usersstore roundtrips
+    # La prueba mide el tiempo de un voto según el número de votos que ya
+    # tiene el archivo, comparado con el antiguo map-reduce, sobre un archivo
+    # ficticio cuyos votos se borran al terminar.
+    # roundtrips cuenta las consultas a la base de datos de usuarios de la
+    # página de un archivo, antes y después de agruparlas, sobre una base de
+    # datos en memoria.
+    from bson.objectid import ObjectId
+
+    class FakeUser(object):
+        karma = 0.2
+        session_ip = None
+        def __init__(self, uid):
+            self.id = uid
+        def is_authenticated(self):
+            return True
+
+    if sys.argv[1:2] == ["roundtrips"]:
+        from flask import Flask
+
+        roundtrips = [0]
+        class Collection(object):
+            '''
+            Colección en memoria que cuenta las consultas.
+            '''
+            def __init__(self):
+                self.docs = []
+
+            def insert(self, docs):
+                self.docs.extend(docs if isinstance(docs, list) else [docs])
+
+            def _values(self, doc, path):
+                values = [doc]
+                for part in path.split("."):
+                    values = [item.get(part) if isinstance(item, dict) else None
+                              for value in values for item in (value if isinstance(value, list) else [value])]
+                return values
+
+            def _match(self, doc, spec):
+                for key, condition in spec.iteritems():
+                    values = self._values(doc, key)
+                    if isinstance(condition, dict) and "$in" in condition:
+                        if not any(value in condition["$in"] for value in values):
+                            return False
+                    elif not condition in values:
+                        return False
+                return True
+
+            def find(self, spec=None, fields=None):
+                roundtrips[0] += 1
+                return [doc for doc in self.docs if self._match(doc, spec or {})]
+
+            def find_one(self, spec=None, fields=None):
+                found = self.find(spec, fields)
+                return found[0] if found else None
+
+        class Client(object):
+            def __init__(self):
+                self.users = type("Database", (object,), {})()
+                for name in ("users", "vote", "favfile", "comment"):
+                    setattr(self.users, name, Collection())
+            def end_request(self):
+                pass
+
+        def old_page(usersdb, file_id, user, lang):
+            '''
+            Consultas de la página de un archivo antes de agruparlas.
+            '''
+            vote = usersdb.get_file_vote(file_id, user, lang)
+            favorite = any(file_id==favorite["id"] for favorite in usersdb.get_fav_files(user))
+            comments = [(usersdb.find_userid(comment["_id"].split("_")[0]), comment) for comment in usersdb.get_file_comments(file_id, lang)]
+            return vote, favorite, [(author and author["username"], comment["t"]) for author, comment in comments]
+
+        def new_page(usersdb, file_id, user, lang):
+            state = usersdb.get_file_page_state(file_id, user, lang)
+            return state["vote"], state["favorite"], [(author and author["username"], comment["t"]) for comment, author in state["comments"]]
+
+        app = Flask(__name__)
+        app.config["CACHE_TYPE"] = "simple"
+        cache.init_app(app)
+
+        print "%8s %11s %15s %17s %22s" % ("comments", "old pattern", "batched (cold)", "batched (cached)", "memcached gets (cached)")
+        for count in (0, 5, 50):
+            usersdb = UsersStore()
+            usersdb.user_conn = Client()
+            db = usersdb.user_conn.users
+            file_id = ObjectId()
+            user = FakeUser(ObjectId())
+            authors = [ObjectId() for i in xrange(count)]
+            db.users.insert([{"_id": user.id, "username": "user"}]+[{"_id": author, "username": "author%d" % i} for i, author in enumerate(authors)])
+            db.vote.insert({"_id": "%s_%s" % (mid2hex(file_id), user.id), "u": user.id, "k": 1, "l": "en"})
+            db.favfile.insert({"user_id": user.id, "type": 1, "name": None,
+                               "files": [{"id": ObjectId(), "server": 1} for i in xrange(500)]+[{"id": file_id, "server": 1}]})
+            db.comment.insert([{"_id": "%s_%d" % (author, 1000+i), "f": file_id, "l": "en", "t": "comment %d" % i} for i, author in enumerate(authors)])
+
+            results = []
+            counts = []
+            for label, page in (("old", old_page), ("cold", new_page), ("cached", new_page)):
+                with app.test_request_context():
+                    roundtrips[0] = 0
+                    results.append(page(usersdb, file_id, user, "en"))
+                    counts.append(roundtrips[0])
+                    stats = cache.request_stats()
+            assert results[0]==results[1]==results[2], "different page state"
+            print "%8d %11d %15d %17d %22d" % (count, counts[0], counts[1], counts[2], stats["cache_rt"])
+            cache.clear()
+        sys.exit(0)
+
+    usersdb = UsersStore()
+    usersdb.share_connections(pymongo.MongoClient(sys.argv[1]))
+    command = sys.argv[2] if len(sys.argv)>2 else "benchmark"
+
+    if command == "rebuild":
+        t = time()
+        for count, (file_hex, votes) in enumerate(usersdb.rebuild_file_votes(), 1):
+            if count % 10000 == 0:
+                print "%d files rebuilt" % count
+        print "Vote counters rebuilt in %.1f s" % (time()-t)
+        sys.exit(0)
+
+    map_function = Code("function(){emit(this.l,{c:new Array((this.k>0)?1:0,(this.k<0)?1:0),s:new Array((this.k>0)?this.k:0,(this.k<0)?this.k:0)})}")
+    reduce_function = Code("function(l,v){c=[0,0];s=[0,0];for(var i in v){c[0]+=v[i].c[0];c[1]+=v[i].c[1];s[0]+=v[i].s[0];s[1]+=v[i].s[1];}return {c:c,s:s};}")
+
+    REPEAT = 20
+    file_id = ObjectId()
+    file_hex = mid2hex(file_id)
+    existing = 0
+    try:
+        for total in (10, 100, 1000, 10000):
+            usersdb.user_conn.users.vote.insert([
+                {"_id": "%s_%d" % (file_hex, uid), "u": uid, "k": 1 if uid%3 else -1, "l": "en", "d": datetime.utcnow()}
+                for uid in xrange(existing, total)])
+            existing = total
+            list(usersdb.rebuild_file_votes(file_id))
+
+            t = time()
+            for i in xrange(REPEAT):
+                usersdb.set_file_vote(file_id, FakeUser(i), "en", i%2)
+            incremental = (time()-t)/REPEAT
+
+            t = time()
+            for i in xrange(REPEAT):
+                usersdb.user_conn.users.vote.map_reduce(map_function, reduce_function, {"inline": 1},
+                                                         query={"_id": {"$regex": "^%s" % file_hex}})
+            mapreduce = (time()-t)/REPEAT
+
+            print "%6d votes: incremental %7.2f ms/vote, map-reduce %8.2f ms/vote" % (total, incremental*1000, mapreduce*1000)
+    finally:
+        usersdb.user_conn.users.vote.remove({"_id": {"$regex": "^%s" % file_hex}})
+        usersdb.user_conn.users.vote_sum.remove({"f": file_hex})
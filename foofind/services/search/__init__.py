@@ -3,8 +3,9 @@ from proxy import SearchProxy
 from search import Search, escape_string
 from results_browser import ResultsBrowser
 from sphinxservice import Sphinx
-from foofind.utils import mid2bin, logging
+from foofind.utils import mid2bin, hex2mid, logging
 from foofind.utils.splitter import slugify
+from flask import g
 
 class Searchd:
     '''
@@ -13,8 +14,10 @@ class Searchd:
     def __init__(self):
         self.sphinx = Sphinx(self, ResultsBrowser)
         self.service = True
+        self.filesdb = None
 
     def init_app(self, app, filesdb, entitiesdb, profiler):
+        self.filesdb = filesdb
         try:
             self.sphinx.init_app(app)
             self.proxy = SearchProxy(app.config, filesdb, entitiesdb, profiler, self.sphinx)
@@ -23,7 +26,12 @@ class Searchd:
             logging.exception("Error on search deamon initialization.")
 
     def search(self, text, filters={}, start=True, group=True, no_group=False, limits=None, order=None, dynamic_tags=None):
-        return Search(self.proxy, text, filters, start, group, no_group, limits, order, dynamic_tags)
+        # las busquedas de robots se atienden con menor prioridad
+        try:
+            bot = bool(g.search_bot)
+        except (RuntimeError, AttributeError):
+            bot = False
+        return Search(self.proxy, text, filters, start, group, no_group, limits, order, dynamic_tags, bot)
 
     def get_search_info(self, text, filters={}, group=True, no_group=False, limits=None, order=None):
         return Search(self.proxy, text, filters, False, group, no_group, limits, order).get_search_info()
@@ -32,7 +40,23 @@ class Searchd:
         return None
 
     def get_id_server_from_search(self, file_id, file_name, timeout=1000):
-        return self.sphinx.get_id_server_from_search(mid2bin(file_id), escape_string(" ".join(slugify(file_name).split(" ")[:4])) if file_name else "", timeout)
+        # la ubicación puede estar ya en caché (sólo sirve si no redirige a otro id)
+        fid = hex2mid(file_id)
+        location = self.filesdb.get_cached_locations([fid]).get(fid, None) if self.filesdb else None
+        if location and location[1]==fid:
+            return location[0]
+
+        sid = self.sphinx.get_id_server_from_search(mid2bin(file_id), escape_string(" ".join(slugify(file_name).split(" ")[:4])) if file_name else "", timeout)
+        if sid and self.filesdb:
+            self.filesdb.set_location(fid, sid)
+        return sid
+
+    def get_reindex_generation(self):
+        '''
+        Devuelve la fecha de la última reindexación de las partes activas, que cambia con cada reindexado.
+        '''
+        last_reindex = self.sphinx.last_reindex
+        return max(last_reindex.itervalues()) if last_reindex else -1
 
     def get_sources_stats(self):
         return self.proxy.sources_relevance_streaming, self.proxy.sources_relevance_download, self.proxy.sources_relevance_p2p
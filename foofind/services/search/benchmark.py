@@ -0,0 +1,1214 @@
+# -*- coding: utf-8 -*-
+'''
+    Banco de pruebas de extremo a extremo de la búsqueda, sin servicios externos.
+
+    Ejecuta en el mismo proceso el camino completo de una búsqueda por ajax:
+    vista searcha, search_files, Searchd/Search, cliente Sphinx, SphinxService,
+    ResultsBrowser, FilesStore.get_files, fill_data y plantillas. Redis,
+    mongo y sphinx se sustituyen por equivalentes en memoria: un redis con
+    pubsub, colecciones de documentos al estilo de mongomock y un servidor que
+    habla el protocolo binario de searchd con respuestas generadas a partir de
+    un corpus fijo.
+
+    El corpus y el registro de consultas se generan con semilla fija, y antes
+    de cada pasada se vacían las cachés de búsqueda, de forma que distintas
+    ejecuciones hacen exactamente el mismo trabajo y sus tiempos se pueden
+    comparar entre commits.
+
+    Uso: python -m foofind.services.search.benchmark [opciones]
+         --queries FICHERO   registro de consultas, una por línea con el
+                             formato "consulta[<tab>filtros]" de searcha
+         --save-queries FICHERO  guarda el registro generado para reutilizarlo
+         --save FICHERO      guarda el resumen en JSON
+         --baseline FICHERO  compara con un resumen guardado anteriormente
+         --redis-shards N    reparte la caché de búsquedas entre N redis
+         --api VERSION       lanza las consultas contra la API 1 o 2 en
+                             lugar de searcha, leyendo las respuestas por
+                             partes y repitiéndolas con su ETag
+'''
+import re, json, random, resource, gc, bisect, argparse, SocketServer, urllib
+from time import time, sleep
+from threading import Thread, Lock, RLock, Event
+from Queue import Queue
+from collections import defaultdict
+from fnmatch import fnmatchcase
+from hashlib import md5
+from struct import pack, unpack, Struct
+from zlib import crc32
+from copy import deepcopy
+
+import bson, redis, pymongo
+from flask import Flask, g
+from flask.ext.assets import Environment
+
+from sphinxservice.common import *
+from sphinxservice.metrics import Histogram, Metrics
+from foofind import defaults
+from foofind.services import *
+from foofind.templates import register_filters
+from foofind.utils import u, logging
+from foofind.utils.profiler import decode_histogram
+
+FULL_ID_STRUCT = Struct("III") # mismo formato que SphinxService
+
+# protocolo de searchd
+SEARCHD_COMMAND_SEARCH = 0
+SEARCHD_COMMAND_PERSIST = 4
+VER_COMMAND_SEARCH = 0x119
+SEARCHD_OK = 0
+SEARCHD_ERROR = 1
+SPH_RANK_EXPR = 8
+SPH_FILTER_VALUES = 0
+SPH_FILTER_RANGE = 1
+SPH_FILTER_FLOATRANGE = 2
+SPH_ATTR_INTEGER = 1
+SPH_ATTR_FLOAT = 5
+SPH_ATTR_BIGINT = 6
+
+'''
+    Redis en memoria
+'''
+class FakeRedisServer(object):
+    '''
+    Datos compartidos por todos los clientes de un servidor de redis. Sólo
+    implementa los comandos que usan el cliente y el servicio de búsqueda.
+    '''
+    def __init__(self):
+        self.lock = RLock()
+        self.dbs = defaultdict(dict)
+        self.expirations = {}
+        self.subscribers = []
+        self.commands = 0
+
+    def client(self, host=None, port=None, db=0, **kwargs):
+        return FakeRedis(self, db)
+
+    def flushall(self):
+        with self.lock:
+            self.dbs.clear()
+            self.expirations.clear()
+
+    def publish(self, channel, message):
+        with self.lock:
+            self.commands += 1
+            receivers = 0
+            for subscriber in self.subscribers:
+                if subscriber.deliver(channel, message):
+                    receivers += 1
+            return receivers
+
+def fake_redis_client(servers):
+    '''
+    Sustituto de redis.StrictRedis para varios servidores en memoria, que se
+    eligen por el número de puerto.
+    '''
+    def client(host=None, port=None, db=0, **kwargs):
+        return servers[port or 0].client(db=db)
+    return client
+
+class FakeRedis(object):
+    '''
+    Cliente de FakeRedisServer con la interfaz de redis.StrictRedis.
+    '''
+    def __init__(self, server, db=0):
+        self.server = server
+        self.db = db
+
+    def _data(self):
+        # devuelve los datos de la base de datos, quitando las claves caducadas
+        server = self.server
+        server.commands += 1
+        data = server.dbs[self.db]
+        if server.expirations:
+            now = time()
+            for key, expiration in server.expirations.items():
+                if key[0]==self.db and expiration<now:
+                    data.pop(key[1], None)
+                    del server.expirations[key]
+        return data
+
+    def ping(self):
+        return True
+
+    def get(self, name):
+        with self.server.lock:
+            return self._data().get(name, None)
+
+    def mget(self, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        with self.server.lock:
+            data = self._data()
+            return [data.get(key, None) for key in keys+list(args)]
+
+    def set(self, name, value):
+        with self.server.lock:
+            self._data()[name] = str(value)
+            self.server.expirations.pop((self.db, name), None)
+            return True
+
+    def setex(self, name, time_seconds, value):
+        with self.server.lock:
+            self._data()[name] = str(value)
+            self.server.expirations[(self.db, name)] = time()+time_seconds
+            return True
+
+    def setnx(self, name, value):
+        with self.server.lock:
+            data = self._data()
+            if name in data:
+                return False
+            data[name] = str(value)
+            return True
+
+    def delete(self, *names):
+        with self.server.lock:
+            data = self._data()
+            return sum(1 for name in names if data.pop(name, None) is not None)
+
+    def expire(self, name, time_seconds):
+        with self.server.lock:
+            if not name in self._data():
+                return False
+            self.server.expirations[(self.db, name)] = time()+time_seconds
+            return True
+
+    def hget(self, name, key):
+        with self.server.lock:
+            return self._data().get(name, {}).get(key, None)
+
+    def hgetall(self, name):
+        with self.server.lock:
+            return dict(self._data().get(name, {}))
+
+    def hmget(self, name, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        with self.server.lock:
+            value = self._data().get(name, {})
+            return [value.get(key, None) for key in keys+list(args)]
+
+    def hset(self, name, key, value):
+        with self.server.lock:
+            value_dict = self._data().setdefault(name, {})
+            new = key not in value_dict
+            value_dict[key] = str(value)
+            return int(new)
+
+    def hsetnx(self, name, key, value):
+        with self.server.lock:
+            value_dict = self._data().setdefault(name, {})
+            if key in value_dict:
+                return False
+            value_dict[key] = str(value)
+            return True
+
+    def hmset(self, name, mapping):
+        with self.server.lock:
+            self._data().setdefault(name, {}).update((key, str(value)) for key, value in mapping.iteritems())
+            return True
+
+    def hdel(self, name, *keys):
+        # admite listas de claves, como las que envía SphinxService al reindexar
+        keys = [key for item in keys for key in (item if isinstance(item, (list, tuple)) else [item])]
+        with self.server.lock:
+            value_dict = self._data().get(name, {})
+            return sum(1 for key in keys if value_dict.pop(str(key), None) is not None)
+
+    def sadd(self, name, *values):
+        with self.server.lock:
+            members = self._data().setdefault(name, set())
+            added = sum(1 for value in values if value not in members)
+            members.update(values)
+            return added
+
+    def smembers(self, name):
+        with self.server.lock:
+            return set(self._data().get(name, ()))
+
+    def zadd(self, name, *args):
+        with self.server.lock:
+            zset = self._data().setdefault(name, {})
+            added = 0
+            for score, member in zip(args[::2], args[1::2]):
+                added += member not in zset
+                zset[member] = float(score)
+            return added
+
+    def zrange(self, name, start, end):
+        with self.server.lock:
+            members = sorted(self._data().get(name, {}).iteritems(), key=lambda item: (item[1], item[0]))
+        end = len(members) if end==-1 else end+1
+        return [member for member, score in members[start:end]]
+
+    def publish(self, channel, message):
+        return self.server.publish(channel, message)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def pubsub(self):
+        return FakePubSub(self.server)
+
+    def lock(self, name, timeout=None, sleep=0.1):
+        return FakeLock(self, name, timeout)
+
+class FakePipeline(object):
+    '''
+    Acumula comandos y los ejecuta de una vez.
+    '''
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        def command(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        with self.client.server.lock:
+            results = [method(*args, **kwargs) for method, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+class FakeLock(object):
+    def __init__(self, client, name, timeout):
+        self.client = client
+        self.name = name
+        self.timeout = timeout
+
+    def acquire(self, blocking=True):
+        while True:
+            with self.client.server.lock:
+                if self.client.setnx(self.name, time()):
+                    if self.timeout:
+                        self.client.server.expirations[(self.client.db, self.name)] = time()+self.timeout
+                    return True
+            if not blocking:
+                return False
+            sleep(0.001)
+
+    def release(self):
+        self.client.delete(self.name)
+
+class FakePubSub(object):
+    '''
+    Suscripción a canales de FakeRedisServer con la interfaz de redis.client.PubSub.
+    '''
+    def __init__(self, server, queue=None, shard=None):
+        self.server = server
+        self.channels = set()
+        self.patterns = set()
+        self.queue = queue or Queue() # varias suscripciones pueden compartir cola
+        self.shard = shard
+        self.connection_pool = self # connection_pool.disconnect() cierra la suscripción
+
+    def _subscribe(self, kind, names, target):
+        with self.server.lock:
+            if not self in self.server.subscribers:
+                self.server.subscribers.append(self)
+            for name in names:
+                target.add(name)
+                self.queue.put({"type": kind, "pattern": None, "channel": name, "data": len(self.channels)+len(self.patterns)})
+
+    def subscribe(self, *channels):
+        self._subscribe("subscribe", channels, self.channels)
+
+    def psubscribe(self, *patterns):
+        self._subscribe("psubscribe", patterns, self.patterns)
+
+    def deliver(self, channel, message):
+        if channel in self.channels:
+            self.queue.put({"type": "message", "pattern": None, "channel": channel, "data": message, "shard": self.shard})
+            return True
+        for pattern in self.patterns:
+            if fnmatchcase(channel, pattern):
+                self.queue.put({"type": "pmessage", "pattern": pattern, "channel": channel, "data": message, "shard": self.shard})
+                return True
+        return False
+
+    def listen(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        with self.server.lock:
+            if self in self.server.subscribers:
+                self.server.subscribers.remove(self)
+        self.queue.put(None)
+
+    def disconnect(self):
+        self.close()
+
+'''
+    Mongo en memoria
+'''
+def _match_value(value, condition):
+    if isinstance(condition, dict) and condition and all(key[0]=="$" for key in condition):
+        for operator, argument in condition.iteritems():
+            if operator=="$in":
+                if not (any(item in argument for item in value) if isinstance(value, list) else value in argument):
+                    return False
+            elif operator=="$all":
+                if not (isinstance(value, list) and all(item in value for item in argument)):
+                    return False
+            elif operator=="$exists":
+                if (value is not _MISSING)!=bool(argument):
+                    return False
+            elif operator=="$ne":
+                if value==argument:
+                    return False
+            else:
+                raise NotImplementedError("Operator %s is not supported." % operator)
+        return True
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return value==condition
+
+_MISSING = object()
+def _match(doc, spec):
+    for key, condition in spec.iteritems():
+        if key=="$or":
+            if not any(_match(doc, subspec) for subspec in condition):
+                return False
+        elif not _match_value(doc.get(key, _MISSING), condition):
+            return False
+    return True
+
+class FakeCursor(object):
+    def __init__(self, docs):
+        self.docs = docs
+        self.start = 0
+        self.end = None
+
+    def sort(self, key, direction=1):
+        keys = [(key, direction)] if isinstance(key, basestring) else key
+        for key, direction in reversed(keys):
+            self.docs.sort(key=lambda doc: doc.get(key, None), reverse=direction<0)
+        return self
+
+    def skip(self, skip):
+        self.start = skip
+        return self
+
+    def limit(self, limit):
+        self.end = limit
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        return len(self._slice()) if with_limit_and_skip else len(self.docs)
+
+    def _slice(self):
+        return self.docs[self.start:self.start+self.end if self.end else None]
+
+    def __iter__(self):
+        return iter(self._slice())
+
+class FakeCollection(object):
+    '''
+    Colección en memoria. Devuelve copias de los documentos, como hace el
+    driver al decodificarlos.
+    '''
+    def __init__(self):
+        self.docs = {}
+        self.queries = 0
+
+    def insert(self, docs):
+        for doc in (docs if isinstance(docs, list) else [docs]):
+            doc.setdefault("_id", bson.ObjectId())
+            self.docs[doc["_id"]] = doc
+
+    def _find(self, spec, fields):
+        self.queries += 1
+        spec = spec or {}
+        ids = spec.get("_id", None)
+        if isinstance(ids, dict) and "$in" in ids:
+            candidates = (self.docs[_id] for _id in ids["$in"] if _id in self.docs)
+        elif ids is not None and not isinstance(ids, dict):
+            candidates = [self.docs[ids]] if ids in self.docs else []
+        else:
+            candidates = self.docs.itervalues()
+        results = []
+        for doc in candidates:
+            if _match(doc, spec):
+                if fields:
+                    doc = {key: value for key, value in doc.iteritems() if key=="_id" or key in fields}
+                results.append(deepcopy(doc))
+        return results
+
+    def find(self, spec=None, fields=None, **kwargs):
+        return FakeCursor(self._find(spec, fields))
+
+    def find_one(self, spec=None, fields=None, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {"_id": spec}
+        results = self._find(spec, fields)
+        return results[0] if results else None
+
+class FakeDatabase(object):
+    def __init__(self):
+        self.collections = defaultdict(FakeCollection)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self.collections[name]
+    __getitem__ = __getattr__
+
+    def command(self, name, *args, **kwargs):
+        '''
+        Solo responde a ismaster: todos los miembros son secundarios con los mismos datos.
+        '''
+        if name!="ismaster":
+            raise NotImplementedError(name)
+        return {"ismaster": False, "secondary": True}
+
+class FakeMongo(object):
+    '''
+    Datos de todas las conexiones a mongo del proceso.
+    '''
+    def __init__(self):
+        self.databases = defaultdict(FakeDatabase)
+
+    def client(self, *args, **kwargs):
+        '''
+        Sustituto de pymongo.MongoClient y pymongo.MongoReplicaSetClient.
+        '''
+        return FakeMongoClient(self)
+
+class FakeMongoClient(object):
+    def __init__(self, mongo):
+        self.mongo = mongo
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self.mongo.databases[name]
+    __getitem__ = __getattr__
+
+    def end_request(self):
+        pass
+
+'''
+    Corpus de ficheros
+'''
+SOURCES = [
+    (1, "youtube.com", ["s"], 2), (2, "vimeo.com", ["s"], 2), (3, "dailymotion.com", ["s"], 2),
+    (4, "mega.co.nz", ["w"], 1), (5, "mediafire.com", ["w"], 1), (6, "4shared.com", ["w"], 1),
+    (7, "Torrent", ["p", "t"], 4), (8, "eD2k", ["p", "e"], 1)]
+
+CONTENT_TYPES = [(1, ("mp3", "ogg", "flac"), ("audio:artist", "audio:album", "audio:title")),
+                 (2, ("avi", "mkv", "mp4"), ("video:title", "video:series", "video:duration")),
+                 (3, ("pdf", "epub"), ("book:title", "document:pages")),
+                 (6, ("exe", "dmg"), ("application:name", "application:fileversion"))]
+
+class Corpus(object):
+    '''
+    Ficheros generados con semilla fija, repartidos en partes como en los
+    servidores de sphinx. Cada parte tiene un índice invertido por palabra.
+    '''
+    def __init__(self, parts, files_per_part, seed=0):
+        rnd = random.Random(seed)
+        syllables = [c+v for c in "bcdfglmnprstvz" for v in "aeiou"]
+        words = set()
+        while len(words)<3000:
+            words.add("".join(rnd.choice(syllables) for i in xrange(rnd.randint(2, 3))))
+        self.words = sorted(words)
+        rnd.shuffle(self.words)
+
+        # frecuencias de las palabras segun la ley de Zipf
+        self.cumulative = []
+        total = 0
+        for rank in xrange(len(self.words)):
+            total += 1./(rank+1)**1.1
+            self.cumulative.append(total)
+
+        self.parts = {}
+        self.docs = []
+        self.sources = [{"_id": float(sid), "d": domain, "g": groups, "crbl": 0} for sid, domain, groups, weight in SOURCES]
+        source_choices = [source for source in SOURCES for i in xrange(source[3])]
+        for part in xrange(1, parts+1):
+            index = self.parts[part] = {"matches": [], "words": defaultdict(list)}
+            for i in xrange(files_per_part):
+                doc, match = self._new_file(rnd, part, i, rnd.choice(source_choices), rnd.choice(CONTENT_TYPES))
+                for word in set(match["words"]):
+                    index["words"][word].append(len(index["matches"]))
+                index["matches"].append(match)
+                self.docs.append(doc)
+
+    def random_word(self, rnd):
+        return self.words[bisect.bisect(self.cumulative, rnd.random()*self.cumulative[-1])]
+
+    def _new_file(self, rnd, part, number, source, content_type):
+        sid, domain, groups, weight = source
+        ct, extensions, metadata = content_type
+        oid = bson.ObjectId(pack(">B", part)+"".join(chr(rnd.randint(0, 255)) for i in xrange(11)))
+        words = [self.random_word(rnd) for i in xrange(rnd.randint(2, 6))]
+        name = " ".join(words)
+        extension = rnd.choice(extensions)
+        crc = "%08x" % (crc32(name.encode("utf-8")) & 0xffffffff)
+        hexuri = md5(str(oid)).hexdigest()
+        if "s" in groups:
+            url = "http://%s/watch?v=%s" % (domain, hexuri[:11])
+        elif "w" in groups:
+            url = "http://%s/%s/%s.%s" % (domain, hexuri[:8], name.replace(" ", "_"), extension)
+        elif "t" in groups:
+            url = "http://torrents.example.com/%s.torrent" % hexuri
+        else:
+            url = hexuri
+        md = {key: (rnd.randint(60, 7200) if key.endswith("duration") else rnd.randint(1, 900) if key.endswith("pages") else
+                    " ".join(self.random_word(rnd) for i in xrange(rnd.randint(1, 3))))
+              for key in rnd.sample(metadata, rnd.randint(1, len(metadata)))}
+        doc = {"_id": oid, "bl": 0, "z": rnd.randint(10**5, 4*10**9), "ct": ct,
+               "fn": {crc: {"n": name, "x": extension}},
+               "src": {hexuri: {"t": sid, "url": url, "bl": 0, "m": rnd.randint(1, 500), "fn": {crc: {"m": 1}}}},
+               "md": md}
+
+        rating = -1. if rnd.random()<0.3 else round(rnd.random(), 3)
+        uri1, uri2, uri3 = FULL_ID_STRUCT.unpack(oid.binary)
+        match = {"id": (part<<32)+number, "uri1": uri1, "uri2": uri2, "uri3": uri3,
+                 "g": (ct<<28)|(sid<<12)|(crc32(words[0])&0xfff), "r": rating, "ct": ct, "s": sid, "z": doc["z"],
+                 "words": words+[word for value in md.itervalues() if isinstance(value, basestring) for word in value.split(" ")]}
+        return doc, match
+
+    def queries(self, count, seed=1):
+        '''
+        Genera un registro de consultas: palabras frecuentes y algunas
+        repetidas, como en el tráfico real, y filtros de tipo en una de cada
+        cinco.
+        '''
+        rnd = random.Random(seed)
+        queries = []
+        for i in xrange(count):
+            if queries and rnd.random()<0.3:
+                queries.append(rnd.choice(queries))
+                continue
+            query = " ".join(self.random_word(rnd) for j in xrange(rnd.randint(1, 2)))
+            queries.append((query, "type:"+rnd.choice(["audio", "video", "document", "software"]) if rnd.random()<0.2 else None))
+        return queries
+
+'''
+    Servidor de sphinx con respuestas generadas
+'''
+QUERY_FIELDS_RE = re.compile(r"\|\s*@(?:fil|ntt)\s+\S+|@\([^)]*\)|@\w+|[()|\"]")
+
+class SearchRequestReader(object):
+    '''
+    Lee las consultas de una petición SEARCH, en el formato de AddQuery.
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def int(self):
+        value, = unpack(">L", self.data[self.position:self.position+4])
+        self.position += 4
+        return value
+
+    def string(self):
+        length = self.int()
+        value = self.data[self.position:self.position+length]
+        self.position += length
+        return value
+
+    def skip(self, length):
+        self.position += length
+
+    def queries(self):
+        self.skip(4) # cero
+        return [self.query() for i in xrange(self.int())]
+
+    def query(self):
+        query = {}
+        query["offset"], query["limit"], mode, ranker = self.int(), self.int(), self.int(), self.int()
+        if ranker==SPH_RANK_EXPR:
+            self.string()
+        self.int() # modo de ordenación
+        self.string() # orden
+        query["text"] = self.string()
+        self.skip(4*self.int()) # pesos
+        self.string() # indice
+        self.skip(4+16) # rango de ids
+        query["filters"] = filters = []
+        for i in xrange(self.int()):
+            attr, filter_type = self.string(), self.int()
+            if filter_type==SPH_FILTER_VALUES:
+                count = self.int()
+                values = set(unpack(">%dq" % count, self.data[self.position:self.position+8*count]))
+                self.skip(8*count)
+            elif filter_type==SPH_FILTER_RANGE:
+                values = unpack(">2q", self.data[self.position:self.position+16])
+                self.skip(16)
+            else:
+                values = unpack(">2f", self.data[self.position:self.position+8])
+                self.skip(8)
+            filters.append((attr, filter_type, values, self.int()))
+        self.int() # funcion de agrupacion
+        query["group"] = self.string()
+        query["max_matches"] = self.int()
+        self.string() # orden de grupos
+        self.skip(12) # cutoff, reintentos
+        self.string() # agrupacion distinta
+        if self.int(): # punto de anclaje
+            self.string(); self.string(); self.skip(8)
+        for i in xrange(self.int()): # pesos por indice
+            self.string(); self.skip(4)
+        self.int() # tiempo maximo
+        for i in xrange(self.int()): # pesos por campo
+            self.string(); self.skip(4)
+        query["comment"] = self.string()
+        if self.int():
+            raise NotImplementedError("Attribute overrides are not supported.")
+        self.string() # select
+        return query
+
+class CannedSphinxHandler(SocketServer.BaseRequestHandler):
+    '''
+    Atiende una conexión persistente de sphinxapi.
+    '''
+    def read(self, length):
+        data = []
+        while length:
+            chunk = self.request.recv(length)
+            if not chunk:
+                raise EOFError
+            data.append(chunk)
+            length -= len(chunk)
+        return "".join(data)
+
+    def handle(self):
+        self.request.sendall(pack(">L", 1))
+        try:
+            self.read(4) # version del cliente
+            while True:
+                command, version, length = unpack(">HHL", self.read(8))
+                body = self.read(length)
+                if command==SEARCHD_COMMAND_PERSIST:
+                    continue
+                elif command==SEARCHD_COMMAND_SEARCH:
+                    response = self.server.respond(body)
+                else:
+                    message = "unsupported command %d" % command
+                    response = pack(">2HL", SEARCHD_ERROR, version, len(message)+4)+pack(">L", len(message))+message
+                self.request.sendall(response)
+        except EOFError:
+            pass
+
+class CannedSphinxServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''
+    Servidor que habla el protocolo binario de searchd para una parte del
+    corpus. Las respuestas se calculan sobre el índice invertido de la parte
+    y se guardan por petición, de forma que las repetidas cuestan lo mismo
+    que leer de la caché de sphinx.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    ATTRS = [("uri1", SPH_ATTR_INTEGER), ("uri2", SPH_ATTR_INTEGER), ("uri3", SPH_ATTR_INTEGER), ("g", SPH_ATTR_BIGINT),
+             ("r", SPH_ATTR_FLOAT), ("e", SPH_ATTR_INTEGER), ("ok", SPH_ATTR_FLOAT), ("w", SPH_ATTR_INTEGER)]
+    GROUP_ATTRS = ATTRS+[("@count", SPH_ATTR_INTEGER)]
+
+    def __init__(self, index, latency=0):
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", 0), CannedSphinxHandler)
+        self.index = index
+        self.latency = latency
+        self.responses = {}
+        self.lock = Lock()
+        self.requests = 0
+
+    def respond(self, body):
+        if self.latency:
+            sleep(self.latency)
+        key = md5(body).digest()
+        with self.lock:
+            self.requests += 1
+            response = self.responses.get(key, None)
+        if response is None:
+            results = "".join(self.result(query) for query in SearchRequestReader(body).queries())
+            response = pack(">2HL", SEARCHD_OK, VER_COMMAND_SEARCH, len(results))+results
+            with self.lock:
+                self.responses[key] = response
+        return response
+
+    def search(self, query):
+        words = [word.replace("\\", "").lower() for word in QUERY_FIELDS_RE.sub(" ", query["text"]).split()]
+        include = [word for word in words if word[0]!="-"]
+        exclude = set(word[1:] for word in words if word[0]=="-")
+        index_words = self.index["words"]
+        matches = self.index["matches"]
+
+        if not include:
+            return [], []
+        candidates = set(index_words.get(include[0], ()))
+        for word in include[1:]:
+            candidates.intersection_update(index_words.get(word, ()))
+
+        results = []
+        for position in sorted(candidates):
+            match = matches[position]
+            if exclude.intersection(match["words"]):
+                continue
+            accepted = True
+            for attr, filter_type, values, exclude_values in query["filters"]:
+                value = match.get({"bl": None}.get(attr, attr), 0)
+                if filter_type==SPH_FILTER_VALUES:
+                    found = value in values
+                else:
+                    found = values[0]<=value<=values[1]
+                if found==bool(exclude_values):
+                    accepted = False
+                    break
+            if accepted:
+                weight = 1000*len(include)+100*sum(1 for word in include if word in match["words"][:2])
+                results.append((weight*(max(match["r"], 0)+10), match["uri1"], weight, match))
+        results.sort(reverse=True)
+        return results, [(word, len(index_words.get(word, ()))) for word in include]
+
+    def result(self, query):
+        results, words = self.search(query)
+
+        if query["group"]:
+            groups = {}
+            for result in results:
+                groups.setdefault(result[3]["g"], []).append(result)
+            results = sorted(((len(group),)+group[0] for group in groups.itervalues()), reverse=True)
+            attrs = self.GROUP_ATTRS
+        else:
+            results = [(1,)+result for result in results]
+            attrs = self.ATTRS
+
+        total = min(len(results), query["max_matches"])
+        page = results[query["offset"]:query["offset"]+query["limit"]]
+
+        data = [pack(">LL", SEARCHD_OK, 2), pack(">L", 2), "fn", pack(">L", 2), "md", pack(">L", len(attrs))]
+        for name, attr_type in attrs:
+            data.append(pack(">L", len(name))+name+pack(">L", attr_type))
+        data.append(pack(">LL", len(page), 1))
+        for count, order, uri1, weight, match in page:
+            data.append(pack(">QL3Lqf", match["id"], weight, match["uri1"], match["uri2"], match["uri3"], match["g"], match["r"]))
+            data.append(pack(">LfL", 0, order, weight))
+            if query["group"]:
+                data.append(pack(">L", count))
+        data.append(pack(">4L", len(page), total, 1, len(words)))
+        for word, docs in words:
+            data.append(pack(">L", len(word))+word+pack(">2L", docs, docs))
+        return "".join(data)
+
+'''
+    Servicio de búsqueda
+'''
+class ServiceRunner(Thread):
+    '''
+    Ejecuta un SphinxService de una parte. Sustituye el bucle de gevent de
+    serve_forever por uno que atiende los mensajes de uno en uno, de todas
+    las particiones de la caché, para que el orden de proceso no dependa del
+    planificador, pero usa los mismos métodos para preparar, buscar y
+    guardar resultados.
+    '''
+    def __init__(self, redis_servers, sphinx_server, part, workers=2):
+        Thread.__init__(self)
+        self.daemon = True
+        self.redis_servers = redis_servers
+        self.sphinx_server = sphinx_server
+        self.part = part
+        self.workers = workers
+        self.ready = Event()
+        self.service = None
+
+    def run(self):
+        # el servicio usa pools de gevent, que deben crearse en su hilo
+        from sphinxservice.service import SphinxService
+        self.service = service = SphinxService([("127.0.0.1", shard) for shard in xrange(len(self.redis_servers))], self.sphinx_server, self.part, self.workers)
+        service.update_last_reindex()
+        service.update_blocked_sources()
+
+        queue = Queue()
+        self.pubsubs = [FakePubSub(server, queue, shard) for shard, server in enumerate(self.redis_servers)]
+        for pubsub in self.pubsubs:
+            pubsub.subscribe(EXECUTE_CHANNEL, EXECUTE_CHANNEL+service.part, CONTROL_CHANNEL+service.part)
+        self.ready.set()
+
+        for msg in self.pubsubs[0].listen():
+            if msg["type"]!="message":
+                continue
+            channel, data = msg["channel"][0], msg["data"]
+            try:
+                if channel==EXECUTE_CHANNEL:
+                    message = parse_data(data)
+                    request_id, info = message[0], message[1]
+                    reply = message[3] if len(message)>3 else None
+                    if request_id[0]==QUERY_KEY:
+                        service.process_search_request(request_id, info, reply, msg["shard"])
+                    elif request_id[0]==LOCATION_KEY:
+                        service.process_get_id_server_request(request_id, info, reply, msg["shard"])
+                elif channel==CONTROL_CHANNEL:
+                    if data=="lr":
+                        service.update_last_reindex()
+                    elif data=="bs":
+                        service.update_blocked_sources()
+                    elif data=="st":
+                        service.export_metrics(False)
+            except BaseException as e:
+                logging.exception("Error processing message on benchmark service %d." % self.part)
+
+    def stop(self):
+        for pubsub in self.pubsubs:
+            pubsub.close()
+
+'''
+    Aplicación web
+'''
+class StageRecorder(object):
+    '''
+    Histogramas de duración por etapa. Recibe también los datos del
+    profiler de search_files.
+    '''
+    PROFILER_STAGES = ("sphinx", "entities", "mongo", "visited")
+
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = defaultdict(Histogram)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.histograms[stage].record(seconds)
+
+    def save_profile_summary(self, summary):
+        with self.lock:
+            for stage in self.PROFILER_STAGES:
+                if stage in summary["stats"]:
+                    self.histograms["search_files."+stage].merge(decode_histogram(summary["stats"][stage]))
+
+    def instrument(self, obj, name, stage):
+        '''
+        Mide las llamadas a una función de un módulo o a un método de un objeto.
+        '''
+        original = getattr(obj, name)
+        def timed(*args, **kwargs):
+            start = time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.record(stage, time()-start)
+        setattr(obj, name, timed)
+
+def merge_histograms(histograms):
+    result = Histogram()
+    for histogram in histograms:
+        result.merge(histogram)
+    return result
+
+def create_benchmark_app(parts, redis_shards):
+    '''
+    Crea una aplicación con el blueprint de ficheros y los servicios que usa
+    la búsqueda, conectados a los sustitutos en memoria.
+    '''
+    from foofind.blueprints.files import files
+    from foofind.blueprints.api import api
+
+    app = Flask("foofind")
+    app.config.from_object(defaults)
+    app.config.update(
+        CACHE_TYPE = "simple",
+        TEMPLATE_BYTECODE_CACHE = False,
+        SPHINX_REDIS_SERVER = (("127.0.0.1", 0),),
+        SPHINX_REDIS_SHARDS = [[("127.0.0.1", shard)] for shard in xrange(redis_shards)],
+        GET_FILES_TIMEOUT = 5,
+        )
+
+    register_filters(app)
+    app.jinja_env.globals["u"] = u
+    app.register_blueprint(files)
+    app.register_blueprint(api)
+    app.assets = Environment(app)
+
+    @app.url_defaults
+    def add_language_code(endpoint, values):
+        if not 'lang' in values and app.url_map.is_endpoint_expecting(endpoint, 'lang'):
+            values['lang'] = g.lang
+
+    @app.url_value_preprocessor
+    def pull_lang_code(endpoint, values):
+        g.lang = values.pop('lang', "en") if values else "en"
+
+    @app.before_request
+    def before_request():
+        # valores de g que usan la búsqueda y las plantillas, como en web.init_g
+        g.args = {}
+        g.active_types = {}
+        g.active_srcs = {}
+        g.full_browser = True
+        g.ios_device = False
+        g.search_bot = False
+        g.beta_request = False
+        g.static_prefix = app.static_url_path
+        g.autocomplete_disabled = "true"
+        g.domain = g.title = "foofind.is"
+        g.keywords = set()
+        g.page_description = g.title
+        g.accept_cookies = "1"
+
+    babel.init_app(app)
+    @babel.localeselector
+    def get_locale():
+        try: return g.lang
+        except: return "en"
+
+    cache.init_app(app)
+    filesdb.init_app(app)
+    filesdb.load_servers_conn()
+    searchd.init_app(app, filesdb, entitiesdb, profiler)
+    return app
+
+def run_queries(client, queries, recorder, concurrency):
+    '''
+    Lanza las consultas contra la vista searcha. Con varios clientes, cada
+    uno recorre las consultas que le tocan por turno, en orden.
+    '''
+    errors = []
+    files = []
+    def worker(offset):
+        for query, filters in queries[offset::concurrency]:
+            start = time()
+            response = client.post("/en/searcha", data={"filters": query.replace(" ", "_")+("/"+filters if filters else "")})
+            recorder.record("request", time()-start)
+            files_ids = json.loads(response.data).get("files_ids", None) if response.status_code==200 else None
+            if files_ids is None:
+                errors.append(query)
+            else:
+                files.append(len(files_ids))
+
+    threads = [Thread(target=worker, args=(i,)) for i in xrange(concurrency)]
+    start = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time()-start, errors, sum(files), {}
+
+def run_api_queries(client, queries, recorder, concurrency, version):
+    '''
+    Lanza las consultas contra la API, leyendo cada respuesta por partes como
+    haría el servidor web, y las repite con el ETag recibido como haría un
+    cliente que consulta periódicamente.
+    '''
+    errors = []
+    files = []
+    sizes = []
+    chunks = []
+    not_modified = []
+    def worker(offset):
+        for query, filters in queries[offset::concurrency]:
+            url = "/api/%d?method=%s&q=%s" % (version, "getSearch" if version==1 else "search", urllib.quote(query.encode("utf-8")))
+            start = time()
+            response = client.get(url, buffered=False)
+            body = []
+            for chunk in response.response:
+                body.append(chunk)
+            response.close()
+            recorder.record("request", time()-start)
+            sizes.append(sum(len(chunk) for chunk in body))
+            chunks.append(max(len(chunk) for chunk in body) if body else 0)
+            body = "".join(body)
+            if response.status_code!=200:
+                errors.append(query)
+                continue
+            files.append(len(json.loads(body)["result"] or ()) if version==2 else body.count("<key_"))
+
+            etag = response.headers.get("ETag")
+            if etag:
+                start = time()
+                response = client.get(url, headers={"If-None-Match": etag}, buffered=True)
+                recorder.record("request.revalidate", time()-start)
+                not_modified.append(response.status_code==304)
+
+    threads = [Thread(target=worker, args=(i,)) for i in xrange(concurrency)]
+    start = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time()-start, errors, sum(files), {"response_kb": sum(sizes)/1024./max(len(sizes), 1), "max_chunk_kb": max(chunks or [0])/1024.,
+                                              "not_modified": "%d/%d" % (sum(not_modified), len(queries))}
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end search benchmark.")
+    parser.add_argument("--parts", type=int, default=4, help="Number of search parts.")
+    parser.add_argument("--files", type=int, default=5000, help="Files per part.")
+    parser.add_argument("--queries", help="Query log to replay, one 'query[<tab>filters]' per line.")
+    parser.add_argument("--count", type=int, default=300, help="Queries to generate if no log is given.")
+    parser.add_argument("--save-queries", help="Save the generated query log.")
+    parser.add_argument("--runs", type=int, default=3, help="Measured runs, after a warm-up run.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Concurrent web clients.")
+    parser.add_argument("--redis-shards", type=int, default=1, help="Redis servers sharing the search cache.")
+    parser.add_argument("--api", type=int, choices=(1, 2), help="Query the API of this version instead of searcha.")
+    parser.add_argument("--sphinx-latency", type=float, default=0, help="Simulated sphinx latency in ms.")
+    parser.add_argument("--seed", type=int, default=0, help="Corpus seed.")
+    parser.add_argument("--sample-interval", type=float, default=0, help="Sample stacks every this many ms during measured runs.")
+    parser.add_argument("--sample-output", help="Save the sampled stacks in flamegraph collapsed format.")
+    parser.add_argument("--save", help="Save the summary as JSON.")
+    parser.add_argument("--baseline", help="Compare with a saved JSON summary.")
+    params = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    corpus = Corpus(params.parts, params.files, params.seed)
+    if params.queries:
+        with open(params.queries) as f:
+            queries = [(line.split("\t")+[None])[:2] for line in f.read().decode("utf-8").splitlines() if line.strip() and not line.startswith("#")]
+        queries = [(query, filters.strip() if filters else None) for query, filters in queries]
+    else:
+        queries = corpus.queries(params.count)
+    if params.save_queries:
+        with open(params.save_queries, "w") as f:
+            f.write("".join("%s\t%s\n" % (query, filters or "") for query, filters in queries).encode("utf-8"))
+
+    # sustitutos de los servicios externos
+    redis_servers = [FakeRedisServer() for shard in xrange(params.redis_shards)]
+    mongo = FakeMongo()
+    sphinx_servers = {}
+    for part in xrange(1, params.parts+1):
+        sphinx_servers[part] = server = CannedSphinxServer(corpus.parts[part], params.sphinx_latency/1000.)
+        server_thread = Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    database = mongo.databases["foofind"]
+    database.source.insert(deepcopy(corpus.sources))
+    database.foo.insert(corpus.docs)
+    database.server.insert([{"_id": float(part), "sp": "127.0.0.1", "spp": server.server_address[1], "rs": defaults.DATA_SOURCE_SERVER_RS,
+                             "ip": "127.0.0.1", "p": 27017, "rip": "127.0.0.1", "rp": 27017} for part, server in sphinx_servers.iteritems()])
+    database.search_stats.insert([{"_id": part} for part in sphinx_servers])
+
+    redis.StrictRedis = fake_redis_client(redis_servers)
+    pymongo.MongoClient = pymongo.MongoReplicaSetClient = mongo.client
+
+    runners = [ServiceRunner(redis_servers, server.server_address, part) for part, server in sorted(sphinx_servers.iteritems())]
+    for runner in runners:
+        runner.start()
+        runner.ready.wait()
+
+    recorder = StageRecorder()
+    profiler.init_app(None, recorder)
+    app = create_benchmark_app(params.parts, params.redis_shards)
+    if not hasattr(searchd, "proxy"):
+        raise SystemExit("Search daemon initialization failed.")
+
+    import foofind.blueprints.files as files_module
+    recorder.instrument(files_module, "prepare_args", "prepare_args")
+    recorder.instrument(files_module, "render_template", "render_template")
+    recorder.instrument(searchd, "search", "searchd.search")
+    recorder.instrument(filesdb, "get_files", "filesdb.get_files")
+    if params.api:
+        import foofind.blueprints.api as api_module
+        recorder.instrument(api_module, "secure_fill_api_data" if hasattr(api_module, "secure_fill_api_data") else "secure_fill_data", "fill_data")
+
+    client = app.test_client()
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    gc.collect()
+    objects_start = len(gc.get_objects())
+
+    sampled_stacks = defaultdict(int)
+    sampler.configure(params.sample_interval/1000., defaults.SAMPLER_MAX_OVERHEAD)
+
+    runs = []
+    for run in xrange(params.runs+1):
+        # cada pasada empieza sin búsquedas en caché
+        for redis_server in redis_servers:
+            redis_server.flushall()
+        searchd.sphinx.requests = LimitedDict(app.config["SPHINX_CLIENT_REQUESTS_CACHE_SIZE"], app.config["SPHINX_CLIENT_REQUESTS_CACHE_TIMEOUT"])
+        for runner in runners:
+            runner.service.metrics.snapshot(True)
+        profiler.flush() # descarta lo anterior a la pasada
+        recorder.histograms.clear()
+        redis_commands = [redis_server.commands for redis_server in redis_servers]
+
+        sampling = params.sample_interval and run
+        if sampling:
+            sampler.start()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_start = usage.ru_utime+usage.ru_stime
+
+        if params.api:
+            elapsed, errors, files, extra = run_api_queries(client, queries, recorder, params.concurrency, params.api)
+        else:
+            elapsed, errors, files, extra = run_queries(client, queries, recorder, params.concurrency)
+        profiler.flush() # etapas de search_files
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        extra["cpu ms/query"] = (usage.ru_utime+usage.ru_stime-cpu_start)*1000/len(queries)
+
+        if sampling:
+            report = sampler.stop()
+            extra["samples"] = report["samples"]
+            extra["sampler overhead %"] = report["overhead"]*100
+            for stack, count in sampler.stacks.iteritems():
+                sampled_stacks[stack] += count
+
+        service_timings = defaultdict(list)
+        service_counters = defaultdict(int)
+        for runner in runners:
+            for name, histogram in runner.service.metrics.histograms.iteritems():
+                service_timings[name].append(histogram)
+            for name, value in runner.service.metrics.counters.iteritems():
+                service_counters[name] += value
+        stages = {name: histogram.summary() for name, histogram in recorder.histograms.iteritems()}
+        stages.update(("service."+name, merge_histograms(histograms).summary()) for name, histograms in service_timings.iteritems())
+
+        if run==0:
+            continue # calentamiento
+        runs.append({"elapsed": elapsed, "throughput": len(queries)/elapsed, "errors": len(errors), "files": files,
+                     "redis_commands": sum(redis_server.commands for redis_server in redis_servers)-sum(redis_commands),
+                     "redis_commands_per_shard": [redis_server.commands-commands for redis_server, commands in zip(redis_servers, redis_commands)],
+                     "service_counters": dict(service_counters), "stages": stages, "extra": extra})
+        print "run %d: %d queries in %.2f s, %.1f queries/s, %d files returned, %d errors%s" % (run, len(queries), elapsed, len(queries)/elapsed, files, len(errors),
+                                                                                              "".join(", %s %s" % (name, "%.1f" % value if isinstance(value, float) else value) for name, value in sorted(extra.iteritems())))
+
+    gc.collect()
+    memory = {"max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "rss_growth_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-rss_start,
+              "objects_growth": len(gc.get_objects())-objects_start}
+
+    # resumen: mediana de las pasadas para cada valor
+    median = lambda values: sorted(values)[len(values)/2]
+    summary = {"settings": vars(params), "queries": len(queries), "memory": memory,
+               "throughput": median([run["throughput"] for run in runs]),
+               "redis_commands": median([run["redis_commands"] for run in runs]),
+               "service_counters": runs[-1]["service_counters"],
+               "stages": {name: {key: median([run["stages"][name][key] for run in runs if name in run["stages"]]) for key in runs[-1]["stages"][name]}
+                          for name in runs[-1]["stages"]}}
+
+    baseline = None
+    if params.baseline:
+        with open(params.baseline) as f:
+            baseline = json.load(f)
+
+    print
+    print "%-34s %7s %9s %9s %9s %9s %9s%s" % ("stage (ms)", "count", "mean", "p50", "p90", "p99", "max", "   p50 vs baseline" if baseline else "")
+    for name, stage in sorted(summary["stages"].iteritems()):
+        line = "%-34s %7d %9.3f %9.3f %9.3f %9.3f %9.3f" % (name, stage["count"], stage["mean"]*1000, stage["p50"]*1000, stage["p90"]*1000, stage["p99"]*1000, stage["max"]*1000)
+        if baseline and name in baseline["stages"] and baseline["stages"][name]["p50"]:
+            line += "   %+7.1f%%" % ((stage["p50"]/baseline["stages"][name]["p50"]-1)*100)
+        print line
+    print
+    print "throughput %.1f queries/s%s" % (summary["throughput"], "  (%+.1f%% vs baseline)" % ((summary["throughput"]/baseline["throughput"]-1)*100) if baseline else "")
+    print "redis commands per run %d (per shard %s), service counters %s" % (summary["redis_commands"], ", ".join(str(commands) for commands in runs[-1]["redis_commands_per_shard"]),
+                                                                           json.dumps(summary["service_counters"], sort_keys=True))
+    print "memory: max rss %(max_rss_kb)d KB, rss growth %(rss_growth_kb)d KB, live objects growth %(objects_growth)d" % memory
+
+    if params.save:
+        with open(params.save, "w") as f:
+            json.dump(summary, f, indent=1, sort_keys=True)
+
+    if params.sample_output:
+        with open(params.sample_output, "w") as f:
+            f.writelines("%s %d\n" % (stack, count) for stack, count in sorted(sampled_stacks.iteritems()))
+
+    for runner in runners:
+        runner.stop()
+    for server in sphinx_servers.itervalues():
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,9 @@ class SearchProxy:
         # informacion de accesos de bots
         profiling_info, self.bot_events = self.bot_events, defaultdict(int)
 
+        # publicaciones de busquedas enviadas y evitadas
+        profiling_info.update(self.sphinx.pop_publish_stats())
+
         # guarda información
         self.profiler.save_data(profiling_info)
 
@@ -38,8 +38,9 @@ def ngram_separator(x):
     return x if x in NGRAM_CHARS else False
 
 class Search(object):
-    def __init__(self, proxy, original_text, filters={}, start=True, group=True, no_group=False, limits=None, order=None, dynamic_tags=None):
+    def __init__(self, proxy, original_text, filters={}, start=True, group=True, no_group=False, limits=None, order=None, dynamic_tags=None, bot=False):
         self.proxy = proxy
+        self.bot = bot
         self.stats = None
         self.computable = True
         self.canonical_parts = []
@@ -352,7 +353,7 @@ class Search(object):
         self.query = self.proxy.sphinx.build_query(self.text, self.filters, self.limits, self.grouping, self.order)
 
         if start and self.computable:
-            self.proxy.sphinx.start_search(self.query)
+            self.proxy.sphinx.start_search(self.query, bot=self.bot)
 
     def parse_query(self, query):
         # inicializa variables
@@ -432,19 +433,19 @@ class Search(object):
 
     def get_results(self, timeouts, last_items=[], skip=None, min_results=5, max_results=10, hard_limit=10000, extra_browse=None, weight_processor=None, tree_visitor=None, restart_if_skip=False):
         if self.computable:
-            results, self.stats = self.proxy.sphinx.get_results(self.query, timeouts, last_items, skip, min_results, max_results, hard_limit, extra_browse, weight_processor, tree_visitor)
+            results, self.stats = self.proxy.sphinx.get_results(self.query, timeouts, last_items, skip, min_results, max_results, hard_limit, extra_browse, weight_processor, tree_visitor, self.bot)
 
             # no search results available for this search, if has skipped and user wants to, start search with grouping information included
             if skip and restart_if_skip and self.stats == Sphinx.EMPTY_STATS:
                 self.query = self.proxy.sphinx.build_query(self.text, self.filters, self.limits, (True, True), self.order)
-                self.proxy.sphinx.start_search(self.query)
-                results, self.stats = self.proxy.sphinx.get_results(self.query, timeouts, last_items, skip, min_results, max_results, hard_limit, extra_browse, weight_processor, tree_visitor)
+                self.proxy.sphinx.start_search(self.query, bot=self.bot)
+                results, self.stats = self.proxy.sphinx.get_results(self.query, timeouts, last_items, skip, min_results, max_results, hard_limit, extra_browse, weight_processor, tree_visitor, self.bot)
 
             self._generate_canonical_query()
             return results
         else:
             self.stats = Sphinx.EMPTY_STATS
-            self.stats["s"] = self.stats["end"] = self.stats["total_sure"] = True
+            self.stats["s"] = self.stats["end"] = self.stats["total_sure"] = self.stats["done"] = True
             return []
 
     def get_group_count(self, mask):
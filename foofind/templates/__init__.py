@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from flask import g, request, url_for
 from flask.ext.babelex import gettext as _
-from babel.numbers import get_decimal_symbol, get_group_symbol
+from babel import Locale
+from babel.numbers import get_decimal_symbol, get_group_symbol, format_number
 from math import log, ceil
 from datetime import datetime,timedelta
 from foofind.utils.htmlcompress import HTMLCompress
@@ -14,6 +15,46 @@ from jinja2 import escape
 from urllib import quote_plus
 from pprint import pformat
 from markdown import markdown
+from functools import wraps
+
+class FilterCache(object):
+    '''
+    Caché acotada para los resultados de filtros puros, que dependen sólo
+    de sus argumentos (incluyendo el idioma, cuando se usa). Al llenarse se
+    vacía completamente: los valores frecuentes se recuperan enseguida y el
+    mantenimiento no tiene coste por acceso.
+    '''
+    def __init__(self, size=10000):
+        self.size = size
+        self.data = {}
+        self.hits = self.misses = 0
+
+    def memoize(self, fnc):
+        '''
+        Decorador que guarda los resultados de la función. Los argumentos que
+        no se pueden usar como clave se calculan sin caché.
+        '''
+        @wraps(fnc)
+        def wrapped(*args, **kwargs):
+            if kwargs or not self.size:
+                return fnc(*args, **kwargs)
+            key = (fnc, args)
+            try:
+                value = self.data[key]
+                self.hits += 1
+                return value
+            except KeyError:
+                pass
+            except TypeError:
+                return fnc(*args)
+            self.misses += 1
+            if len(self.data) >= self.size:
+                self.data.clear()
+            value = self.data[key] = fnc(*args)
+            return value
+        return wrapped
+
+filter_cache = FilterCache()
 
 
 def register_filters(app):
@@ -35,11 +76,14 @@ def register_filters(app):
     app.jinja_env.filters['emarkdown'] = escaped_markdown_filter
     app.jinja_env.filters['seoize'] = seoize_filter
     app.jinja_env.add_extension(HTMLCompress)
+    filter_cache.size = app.config.get("TEMPLATE_FILTER_CACHE_SIZE", filter_cache.size)
 
 _attr_filter = "\"'" # Ampersand en primer lugar para no reescaparlo
+@filter_cache.memoize
 def escaped_markdown_filter(text):
     return escape(markdown(text, output_format="html5"))
 
+@filter_cache.memoize
 def markdown_filter(text):
     return Markup(markdown(text, output_format="html5"))
 
@@ -53,14 +97,15 @@ def number_size_format_filter(size, lang=None):
     '''
     Formatea un tamaño de fichero en el idioma actual
     '''
+    return number_size_format(size, lang or g.lang)
+
+@filter_cache.memoize
+def number_size_format(size, lang):
     if not size:
         return ""
     elif int(float(size))==0:
         return "0 B"
 
-    if not lang:
-        lang = g.lang
-
     if lang in format_cache:
         decimal_sep, group_sep = format_cache[lang]
     else:
@@ -91,12 +136,21 @@ def number_size_format_filter(size, lang=None):
         return ""
 
 
+locale_cache = {}
 def number_format_filter(number):
     '''
     Formatea un numero en el idioma actual
     '''
+    return number_format(number, g.lang)
+
+@filter_cache.memoize
+def number_format(number, lang):
     try:
-        return format_number(number, g.lang)
+        if lang in locale_cache:
+            locale = locale_cache[lang]
+        else:
+            locale = locale_cache[lang] = Locale.parse(lang)
+        return format_number(number, locale)
     except BaseException as e:
         logging.exception(e)
         return ""
@@ -104,8 +158,53 @@ def number_format_filter(number):
 def url_search_filter(new_params, args=None, delete_params=[]):
     '''
     Devuelve los parametros para generar una URL de busqueda
+
+    Los argumentos de la petición se procesan una sola vez por petición: los
+    enlaces que sólo cambian la consulta se generan a partir de la parte
+    común ya calculada, y el resto se guardan por si se repiten.
+    '''
+    if not filter_cache.size:
+        return url_search(new_params, args, delete_params)
+
+    base = getattr(g, "url_search_base", None)
+    if base is None or base[0] is not args:
+        query, filters = url_search_params({}, args, [])
+        g.url_search_base = base = (args, query, url_search_suffix(filters), {})
+
+    # solo cambia la consulta
+    if not delete_params and len(new_params)==("query" in new_params):
+        query = u(new_params["query"]).replace(" ","_") if "query" in new_params else base[1]
+        return g.search_url + quote_plus(query.encode('utf8')) + base[2]
+
+    links = base[3]
+    try:
+        key = (tuple(sorted(new_params.iteritems())), tuple(delete_params))
+        return links[key]
+    except KeyError:
+        link = links[key] = url_search(new_params, args, delete_params)
+        return link
+    except TypeError:
+        return url_search(new_params, args, delete_params)
+
+def url_search(new_params, args, delete_params):
+    '''
+    Genera una URL de busqueda sin usar los datos calculados para la petición.
     '''
+    query, filters = url_search_params(new_params, args, delete_params)
+    return g.search_url + quote_plus(query.encode('utf8')) + url_search_suffix(filters)
 
+def url_search_suffix(filters):
+    '''
+    Genera la parte de filtros de una URL de busqueda
+    '''
+    if filters:
+        return "/" + "/".join(param+":"+",".join(filters[param]) for param in ["type", "src", "size"] if param in filters)
+    return ""
+
+def url_search_params(new_params, args, delete_params):
+    '''
+    Obtiene la consulta y los filtros de una URL de busqueda
+    '''
     # filtros actuales sin parametros eliminados
     filters = {key:value for key, value in args.iteritems() if key not in delete_params} if "all" not in delete_params else {"q":args["q"]} if "q" in args else {}
 
@@ -158,11 +257,7 @@ def url_search_filter(new_params, args=None, delete_params=[]):
     else:
         query = u""
 
-    # genera url de salida
-    if filters:
-        return g.search_url + quote_plus(query.encode('utf8')) + "/" + "/".join(param+":"+",".join(filters[param]) for param in ["type", "src", "size"] if param in filters)
-    else:
-        return g.search_url + quote_plus(query.encode('utf8'))
+    return query, filters
 
 def querystring_params_filter(params):
     '''
@@ -195,13 +290,17 @@ def format_timedelta_filter(date,granularity='second', threshold=.85):
             if unit == granularity and value > 0:
                 value = max(1, value)
             value = int(round(value))
-            rv = u'%s %s' % (value, _(unit))
+            rv = u'%s %s' % (value, timedelta_unit(unit, g.lang))
             if value != 1:
                 rv += u's'
             return rv
 
     return u''
 
+@filter_cache.memoize
+def timedelta_unit(unit, lang):
+    return _(unit)
+
 def url_lang_filter(url, lang="en"):
     '''
     Devuelve la url con la parte del idioma indicada
@@ -219,6 +318,7 @@ def number_friendly_filter(number):
     pos_round = (number_pos-1)/2
     return int(round(number/10.0**pos_round)*10**pos_round)
 
+@filter_cache.memoize
 def seoize_filter(text, separator, is_url, max_length=None):
     return seoize_text(text, separator, is_url, max_length)
 
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+'''
+Mide el tiempo de generación del bloque de resultados de la página de
+búsqueda con 50 ficheros, con y sin la caché de filtros.
+
+Uso: python -m foofind.templates
+'''
+import os, random
+from time import time
+from flask import Flask, g
+from flask.ext.babelex import Babel
+from flask.ext.assets import Environment
+from foofind.templates import register_filters, filter_cache
+
+FILES = 50
+RENDERS = 50
+
+app = Flask("foofind", template_folder=os.path.dirname(os.path.abspath(__file__)))
+Babel(app)
+Environment(app) # extensión de plantillas de webassets
+register_filters(app)
+app.add_url_rule("/<lang>/download/<file_id>/<file_name>", "download")
+app.url_build_error_handlers.append(lambda error, endpoint, values: "/"+endpoint) # resto de vistas de la aplicación
+
+rnd = random.Random(0)
+streamings = ["youtube", "vimeo", "dailymotion", "veoh", "metacafe", "blip", "break", "vevo", "twitch", "ustream"]
+downloads = ["mega", "rapidshare", "mediafire", "zippyshare", "uploaded", "depositfiles", "4shared", "hotfile", "turbobit", "filefactory"]
+p2ps = ["torrent", "ed2k", "gnutella"]
+words = ["the", "best", "of", "live", "remix", "official", "video", "season", "episode", "album", "part", "hd"]
+
+def fake_file(i):
+    source = rnd.choice(streamings+downloads+p2ps)
+    md = {meta: " ".join(rnd.sample(words, 2)) for meta in rnd.sample(["series", "season", "episode", "album", "artist", "title", "length", "seeds"], 4)}
+    return {"file": {"id": "%024x" % i, "z": rnd.randint(1000, 4*1024**3), "vs": {"en": {"t": 0.7}}},
+            "view": {"file_type": rnd.choice(["audio", "video", "document"]),
+                     "source": source, "play": None, "embed": None, "source_groups": [("icon_%s" % source, source)],
+                     "sources": {source: {"source": source, "icons": {"32": False}, "tip": source, "icon": "web" if source in streamings else "torrent",
+                                          "urls": ["http://%s/%d" % (source, i)], "count": 1, "d": source, "downloader": 0}},
+                     "fn": " ".join(rnd.sample(words, 5)) + ".mp3", "nfn": " ".join(rnd.sample(words, 5)),
+                     "md": md, "mdh": {}, "searches": {meta: value for meta, value in md.iteritems()},
+                     "format": ("mp3", "MPEG audio")}}
+
+files = [fake_file(i) for i in xrange(FILES)]
+args = {"q": u"the best", "type": ["audio", "video"], "src": ["streaming", "mega"]}
+context = {"files": files, "args": args, "active_srcs": set(streamings[:8]+["streaming", "mega"]), "active_types": set(args["type"]),
+           "sources_count": {"streaming": 9, "download": 1, "p2p": 0}, "top_filters": {"type": ["audio", "video"], "src": [], "size": []},
+           "static_download": {"html": None}, "bot": False, "comments": None, "scroll_start": False}
+
+def prepare_request():
+    g.lang = "en"
+    g.static_prefix = "/static"
+    g.search_url = "/en/search/"
+    g.sources_names = {source: source for source in streamings+downloads+p2ps+["other-streamings", "other-downloads"]}
+    g.sources_streaming, g.sources_download, g.sources_p2p = streamings, downloads, p2ps
+    g.visible_sources_streaming = streamings[:8]+["other-streamings"]
+    g.visible_sources_download = downloads[:8]+["other-downloads"]
+    g.active_srcs = context["active_srcs"]
+
+template = app.jinja_env.get_template("files/search.html")
+for label, size in (("compiling", 0), ("without filter cache", 0), ("with filter cache", 10000)):
+    filter_cache.size = size
+    filter_cache.data.clear()
+    filter_cache.hits = filter_cache.misses = 0
+    timings = []
+    for i in xrange(RENDERS if label!="compiling" else 1):
+        with app.test_request_context("/en/search/the_best"):
+            prepare_request()
+            start = time()
+            # la plantilla define sus macros antes de empezar a generar la
+            # plantilla padre, que no se llega a generar
+            variables = template.new_context(context)
+            next(template.root_render_func(variables))
+            html = u"".join(template.blocks["content"](variables))
+            timings.append(time()-start)
+    if label=="compiling":
+        continue
+    first = timings[0]
+    timings.sort()
+    print "%-22s first %6.2f ms, median %6.2f ms, %d bytes, filter cache hits %d misses %d" % (
+        label, first*1000, timings[len(timings)/2]*1000, len(html), filter_cache.hits, filter_cache.misses)
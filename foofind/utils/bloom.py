@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+    Filtro de Bloom para comprobaciones de pertenencia compactas.
+"""
+from hashlib import md5
+from math import log, ceil
+from struct import unpack
+
+class BloomFilter(object):
+    '''
+    Filtro de Bloom sobre un bytearray. Puede dar falsos positivos con la
+    probabilidad indicada, pero nunca falsos negativos. No permite borrar
+    elementos, sólo vaciar el filtro completo.
+    '''
+    def __init__(self, capacity, error_rate=0.001):
+        '''
+        @type capacity: int
+        @param capacity: número de elementos para el que se dimensiona el filtro
+
+        @type error_rate: float
+        @param error_rate: probabilidad de falso positivo con el filtro lleno
+        '''
+        self.capacity = capacity
+        self.size = int(ceil(-capacity*log(error_rate)/(log(2)**2)))
+        self.hashes = max(1, int(round(self.size*log(2)/capacity)))
+        self.bits = bytearray((self.size+7)/8)
+        self.count = 0
+
+    def _positions(self, key):
+        # doble hashing a partir de un único md5
+        h1, h2 = unpack("<QQ", md5(key).digest())
+        return ((h1+i*h2)%self.size for i in xrange(self.hashes))
+
+    def add(self, key):
+        '''
+        Añade un elemento al filtro.
+
+        @type key: str
+        @param key: elemento
+        '''
+        for position in self._positions(key):
+            self.bits[position>>3] |= 1<<(position&7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position>>3] & (1<<(position&7)) for position in self._positions(key))
+
+    def full(self):
+        '''
+        Indica si se ha alcanzado la capacidad del filtro.
+        '''
+        return self.count>=self.capacity
+
+    def clear(self):
+        '''
+        Vacía el filtro.
+        '''
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
@@ -24,27 +24,33 @@ def is_full_browser():
     '''
     return request.user_agent.browser in _FULL_BROWSERS_USER_AGENTS
 
+def is_ios_device():
+    '''
+    Detecta si la peticion es de un iPhone o un iPad, que reciben una version adaptada de algunas paginas
+    '''
+    return request.user_agent.platform=="iphone" or "ipad" in request.user_agent.string.lower()
+
 def check_rate_limit(search_bot):
     '''
     Hace que se respeten los limites de peticiones.
+
+    Los contadores se mantienen en memoria del proceso y se sincronizan
+    periódicamente con memcached (ver RateLimiter).
     '''
     if search_bot: # robots
-        if not cache.add("rlimit_bot_"+search_bot, 1, timeout=60):
-            rate_limit = current_app.config["ROBOT_USER_AGENTS_RATE_LIMIT"].get(search_bot, current_app.config["ROBOT_DEFAULT_RATE_LIMIT"])
-            current = cache.inc("rlimit_bot_"+search_bot) # devuelve None si no existe la clave
-            if current and current > rate_limit:
-                if (current%rate_limit)==1:
-                    logging.warn("Request rate over limit %d times from bot %s."%(int(current/rate_limit),search_bot))
-                newrelic.agent.ignore_transaction()
-                abort(429)
+        rate_limit = current_app.config["ROBOT_USER_AGENTS_RATE_LIMIT"].get(search_bot, current_app.config["ROBOT_DEFAULT_RATE_LIMIT"])
+        current = ratelimiter.hit("rlimit_bot_"+search_bot, rate_limit)
+        if current > rate_limit:
+            if (current%rate_limit)==1:
+                logging.warn("Request rate over limit %d times from bot %s."%(int(current/rate_limit),search_bot))
+            newrelic.agent.ignore_transaction()
+            abort(429)
     else: # resto
-       ip = request.headers.getlist("X-Forwarded-For")[0] if request.headers.getlist("X-Forwarded-For") else request.remote_addr
-       client_id = md5(ip).hexdigest()
-       if not cache.add("rlimit_user_"+client_id, 1, timeout=60):
-            current = cache.inc("rlimit_user_"+client_id) # devuelve None si no existe la clave
-            rate_limit = current_app.config["USER_RATE_LIMIT"]
-            if current and current > rate_limit:
-                if (current%rate_limit)==1:
-                    user_agent = request.user_agent.string
-                    logging.warn("Request rate over limit %d times from user %s."%(int(current/rate_limit),client_id))
-                abort(429)
+        ip = request.headers.getlist("X-Forwarded-For")[0] if request.headers.getlist("X-Forwarded-For") else request.remote_addr
+        client_id = md5(ip).hexdigest()
+        rate_limit = current_app.config["USER_RATE_LIMIT"]
+        current = ratelimiter.hit("rlimit_user_"+client_id, rate_limit)
+        if current > rate_limit:
+            if (current%rate_limit)==1:
+                logging.warn("Request rate over limit %d times from user %s."%(int(current/rate_limit),client_id))
+            abort(429)
@@ -30,8 +30,35 @@ from hachoir_core.cmd_line import unicodeFilename
 from hachoir_parser import createParser
 from hachoir_metadata import extractMetadata
 
+# metadatos extraídos por ruta, con la fecha de modificación y tamaño del fichero
+_metadata_cache = {}
+
 def get_file_metadata(path):
+    '''
+    Obtiene los metadatos de un fichero. El resultado se guarda en memoria
+    mientras no cambien la fecha de modificación ni el tamaño del fichero.
+
+    @type path: str
+    @param path: ruta del fichero
+
+    @rtype dict
+    @return diccionario de metadatos, vacío si el fichero no existe
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    key = (stat.st_mtime, stat.st_size)
+    cached = _metadata_cache.get(path, None)
+    if cached and cached[0] == key:
+        return cached[1].copy()
+    rdata = _extract_file_metadata(path)
+    _metadata_cache[path] = (key, rdata)
+    return rdata.copy()
+
+def _extract_file_metadata(path):
     rdata = {}
+    parser = None
     if os.path.isfile(path):
         try:
             parser = createParser(unicodeFilename(path), path)
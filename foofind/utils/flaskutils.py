@@ -1,20 +1,130 @@
 # -*- coding: utf-8 -*-
+import os
+import mimetypes
+from datetime import datetime
 from werkzeug.wsgi import wrap_file
 from flask import request, current_app
 
-def send_gridfs_file(fileobj, cache_for=31536000):
+def _range_iter(fileobj, length, buffer_size):
     '''
-    flask.send_file para ficheros de gridfs
+    Lee un fragmento de fichero por bloques, desde la posición actual.
+    '''
+    try:
+        while length > 0:
+            data = fileobj.read(min(buffer_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fileobj.close()
+
+def send_stream(fileobj, length, mimetype, etag, last_modified, cache_for=31536000, buffer_size=1024 * 256):
+    '''
+    Envía un fichero abierto por bloques, sin cargarlo en memoria, con
+    soporte de peticiones condicionales (If-None-Match, If-Modified-Since)
+    y de rangos (Range, If-Range) para reanudar descargas.
+
+    @param fileobj: objeto de fichero con los métodos read, seek y close
+    @type length: int
+    @param length: tamaño del fichero
+    @type mimetype: str
+    @param mimetype: tipo de contenido
+    @type etag: str
+    @param etag: etag del fichero
+    @type last_modified: datetime
+    @param last_modified: fecha de modificación
+    @type cache_for: int
+    @param cache_for: tiempo de caché en segundos
+    @type buffer_size: int
+    @param buffer_size: tamaño de los bloques leídos
+
+    @rtype Response
+    @return respuesta de Flask
     '''
     response = current_app.response_class(
-        wrap_file(request.environ, fileobj, buffer_size=1024 * 256),
-        mimetype=(fileobj.content_type or "application/octet-stream"),
+        wrap_file(request.environ, fileobj, buffer_size=buffer_size),
+        mimetype=mimetype or "application/octet-stream",
         direct_passthrough=True)
-    response.content_length = fileobj.length
-    response.last_modified = fileobj.upload_date
-    response.set_etag(fileobj.md5)
+    response.call_on_close(fileobj.close)
+    response.content_length = length
+    response.last_modified = last_modified
+    response.set_etag(etag)
+    response.headers["Accept-Ranges"] = "bytes"
     response.cache_control.max_age = cache_for
     response.cache_control.s_max_age = cache_for
     response.cache_control.public = True
     response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+
+    # If-Range: sólo se envía el rango si el fichero no ha cambiado
+    byte_range = request.range
+    if byte_range and request.if_range:
+        if_range = request.if_range
+        if if_range.etag and if_range.etag != etag or if_range.date and if_range.date < last_modified.replace(microsecond=0):
+            byte_range = None
+
+    # varios rangos en una petición: no se soportan, se envía el fichero completo
+    if byte_range and len(byte_range.ranges) != 1:
+        byte_range = None
+
+    if byte_range:
+        span = byte_range.range_for_length(length)
+        if span is None:
+            response.status_code = 416
+            response.response = ()
+            response.content_length = 0
+            response.headers["Content-Range"] = "bytes */%d" % length
+        else:
+            start, stop = span
+            fileobj.seek(start)
+            response.status_code = 206
+            response.response = _range_iter(fileobj, stop - start, buffer_size)
+            response.content_length = stop - start
+            response.headers["Content-Range"] = "bytes %d-%d/%d" % (start, stop - 1, length)
     return response
+
+def send_local_file(base_path, path, mimetype=None, cache_for=31536000):
+    '''
+    Envía un fichero local. Si está configurado, delega el envío en el
+    servidor frontal con X-Sendfile o X-Accel-Redirect, que se encarga de los
+    rangos y peticiones condicionales sin ocupar un worker de la aplicación.
+
+    @type base_path: str
+    @param base_path: directorio base, no forma parte de la url interna
+    @type path: str
+    @param path: ruta del fichero relativa al directorio base
+    @type mimetype: str
+    @param mimetype: tipo de contenido, por defecto se deduce del nombre
+    @type cache_for: int
+    @param cache_for: tiempo de caché en segundos
+
+    @rtype Response
+    @return respuesta de Flask
+    '''
+    filename = os.path.join(base_path, path)
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    offload = current_app.config["DOWNLOAD_OFFLOAD"]
+    if offload:
+        response = current_app.response_class(None, mimetype=mimetype)
+        if offload == "x-accel-redirect":
+            response.headers["X-Accel-Redirect"] = current_app.config["DOWNLOAD_ACCEL_PREFIX"] + path
+        else:
+            response.headers["X-Sendfile"] = os.path.abspath(filename)
+        return response
+
+    stat = os.stat(filename)
+    return send_stream(
+        open(filename, "rb"), stat.st_size, mimetype,
+        "%x-%x" % (int(stat.st_mtime), stat.st_size),
+        datetime.utcfromtimestamp(int(stat.st_mtime)),
+        cache_for)
+
+def send_gridfs_file(fileobj, cache_for=31536000):
+    '''
+    flask.send_file para ficheros de gridfs
+    '''
+    return send_stream(
+        fileobj, fileobj.length, fileobj.content_type, fileobj.md5,
+        fileobj.upload_date, cache_for, fileobj.chunk_size)
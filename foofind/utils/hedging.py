@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+    Latencias recientes y presupuesto de consultas duplicadas (hedged reads).
+"""
+from collections import deque
+from threading import Lock
+
+class LatencyWindow(object):
+    '''
+    Latencias de las últimas consultas a un servidor. Los percentiles se
+    recalculan cada cierto número de consultas, así que leerlos no cuesta
+    nada en el camino de cada petición.
+    '''
+    def __init__(self, size=200, refresh=20):
+        '''
+        @type size: int
+        @param size: número de consultas que se recuerdan
+
+        @type refresh: int
+        @param refresh: consultas entre recálculos de los percentiles
+        '''
+        self.values = deque(maxlen=size)
+        self.refresh = refresh
+        self.pending = 0
+        self.lock = Lock()
+        self.p50 = self.p95 = None
+
+    def record(self, seconds):
+        '''
+        Registra la duración de una consulta.
+
+        @type seconds: float
+        @param seconds: duración en segundos
+        '''
+        with self.lock:
+            self.values.append(seconds)
+            self.pending += 1
+            if self.pending>=self.refresh or self.p50 is None:
+                self.pending = 0
+                values = sorted(self.values)
+                self.p50 = values[len(values)/2]
+                self.p95 = values[min(len(values)-1, int(len(values)*0.95))]
+
+    def __len__(self):
+        return len(self.values)
+
+class HedgeBudget(object):
+    '''
+    Cubo de tokens que limita las consultas duplicadas a una fracción de las
+    consultas normales, para que duplicar no multiplique la carga cuando
+    todos los servidores van lentos.
+    '''
+    def __init__(self, ratio=0.05, burst=10):
+        '''
+        @type ratio: float
+        @param ratio: consultas duplicadas permitidas por cada consulta normal
+
+        @type burst: float
+        @param burst: máximo de consultas duplicadas acumuladas
+        '''
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.lock = Lock()
+        self.hedged = self.denied = 0
+
+    def request(self):
+        '''
+        Anota una consulta normal, que da derecho a una fracción de duplicada.
+        '''
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens+self.ratio)
+
+    def hedge(self):
+        '''
+        Intenta gastar una consulta duplicada.
+
+        @rtype bool
+        @return si se puede duplicar la consulta
+        '''
+        with self.lock:
+            if self.tokens>=1:
+                self.tokens -= 1
+                self.hedged += 1
+                return True
+            self.denied += 1
+            return False
@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+"""
+    Caché de páginas completas para los robots de búsqueda.
+"""
+import zlib
+from collections import OrderedDict
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+from time import time
+from flask import g, request, session, current_app, _request_ctx_stack
+from werkzeug.urls import url_encode
+
+from . import logging
+
+# marca del entorno de las peticiones que renuevan una página caducada
+REFRESH_ENVIRON_KEY = "foofind.page_cache_refresh"
+
+# cabeceras de la petición original que se repiten al renovar una página
+REFRESH_HEADERS = ("User-Agent", "Accept-Language", "Cookie", "X-Forwarded-For")
+
+# cabeceras de la respuesta que se guardan; nunca Set-Cookie ni las de la sesión
+STORED_HEADERS = ("Content-Type", "Content-Language", "Link", "X-Robots-Tag")
+
+# bytes que se suman al tamaño comprimido de cada entrada por la clave y la lista
+ENTRY_OVERHEAD = 300
+
+class PageCache(object):
+    '''
+    Caché en memoria del proceso de las páginas de búsqueda y de descarga
+    servidas a los robots de búsqueda.
+
+    Los robots recorren las mismas páginas una y otra vez, y cada visita
+    cuesta una búsqueda y el render completo de la página. Las páginas se
+    guardan comprimidas, por url normalizada, idioma, dominio y las
+    variantes que dependen del cliente (aviso de cookies y versión del
+    descargador), en una lista LRU limitada en bytes.
+
+    Una página se sirve tal cual durante ttl segundos; durante los
+    stale_ttl segundos siguientes se sirve igualmente, pero se renueva en
+    segundo plano repitiendo la petición con el cliente de pruebas de la
+    aplicación. Pasado ese tiempo se descarta.
+
+    Nunca se guardan páginas con datos de usuario: solo se consulta la
+    caché en peticiones GET de robots sin más datos de sesión que los de
+    session_keys ni cookie de sesión recordada, y solo se guardan
+    respuestas 200 de HTML sin mensajes flash ni marca de la vista (ver
+    skip). Los fragmentos propios de cada petición, como el token CSRF, se
+    sustituyen por marcas al guardar y por los valores de la petición
+    actual al servir (ver add_fragment).
+    '''
+    # posiciones en la lista de cada entrada
+    DATA, HEADERS, STORED, SIZE = xrange(4)
+
+    # posiciones en la lista de contadores de cada robot
+    HITS, STALE, MISSES, STORES, SKIPS = xrange(5)
+
+    def __init__(self):
+        self.app = None
+        self.profiler = None
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.stats = {}
+        self.fragments = []
+        self.pool = None
+        self.pending = set()
+        self.enabled = False
+        self.endpoints = self.session_keys = frozenset()
+        self.ttl = self.stale_ttl = self.max_bytes = self.max_entry_bytes = 0
+        self.compress_level = 6
+        self.workers = self.max_pending = 0
+        self.remember_cookie = "remember_token"
+
+    def init_app(self, app, profiler=None):
+        '''
+        Inicializa la caché con la configuración de la aplicación.
+
+        @param app: Aplicación de Flask.
+        @param profiler: Profiler donde se guardan los contadores de cada robot.
+        '''
+        self.app = app
+        self.profiler = profiler
+        self.enabled = app.config["PAGE_CACHE_ENABLED"]
+        self.endpoints = frozenset(app.config["PAGE_CACHE_ENDPOINTS"])
+        self.session_keys = frozenset(app.config["PAGE_CACHE_SESSION_KEYS"])
+        self.ttl = app.config["PAGE_CACHE_TTL"]
+        self.stale_ttl = app.config["PAGE_CACHE_STALE_TTL"]
+        self.max_bytes = app.config["PAGE_CACHE_MAX_BYTES"]
+        self.max_entry_bytes = app.config["PAGE_CACHE_MAX_ENTRY_BYTES"]
+        self.compress_level = app.config["PAGE_CACHE_COMPRESS_LEVEL"]
+        self.workers = app.config["PAGE_CACHE_WORKERS"]
+        self.max_pending = app.config["PAGE_CACHE_MAX_PENDING"]
+        self.remember_cookie = app.config.get("REMEMBER_COOKIE_NAME", "remember_token")
+
+    def add_fragment(self, name, getter):
+        '''
+        Registra un fragmento de las páginas que cambia en cada petición.
+
+        @type name: str
+        @param name: nombre del fragmento, para su marca en las páginas guardadas
+
+        @type getter: function
+        @param getter: función sin parámetros que devuelve el valor del
+                       fragmento en la petición actual, o None
+        '''
+        self.fragments.append(("\x00page_cache:%s\x00" % name, getter))
+
+    def skip(self):
+        '''
+        Evita que se guarde la página de la petición actual. Para las vistas
+        que añaden contenido propio del visitante.
+        '''
+        g.page_cache_skip = True
+
+    def _cacheable_request(self):
+        '''
+        Comprueba si la petición actual puede usar la caché.
+        '''
+        return (self.enabled and g.search_bot and request.method=="GET" and request.endpoint in self.endpoints
+                and self.remember_cookie not in request.cookies and self.session_keys.issuperset(session.iterkeys()))
+
+    def _key(self):
+        '''
+        Clave de la página de la petición actual. Incluye todo lo que hace
+        variar la página para un mismo robot, también según su navegador.
+        '''
+        return u"%s|%s|%s?%s|%s|%s|%s" % (request.host.lower(), g.lang, request.path, url_encode(request.args, sort=True),
+                                          g.accept_cookies, g.user_build, "ios" if g.ios_device else "")
+
+    def _count(self, position):
+        '''
+        Anota un evento para el robot de la petición actual. Se llama con el cerrojo.
+        '''
+        stats = self.stats.get(g.search_bot)
+        if stats is None:
+            stats = self.stats[g.search_bot] = [0]*5
+        stats[position] += 1
+
+    def get(self):
+        '''
+        Obtiene la respuesta guardada para la petición actual. Se llama antes
+        de procesar la petición; si no hay respuesta guardada, la petición
+        queda anotada para guardar su respuesta al terminar.
+
+        @rtype Response
+        @return respuesta guardada, o None
+        '''
+        if not self._cacheable_request():
+            return None
+
+        g.page_cache_key = key = self._key()
+
+        # la renovación de una página caducada siempre la genera de nuevo
+        if request.environ.get(REFRESH_ENVIRON_KEY):
+            return None
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                age = time()-entry[self.STORED]
+                if age>self.ttl+self.stale_ttl:
+                    self.size -= entry[self.SIZE]
+                    entry = None
+                else:
+                    self.entries[key] = entry # la mueve al final de la lista LRU
+
+            if entry is None:
+                self._count(self.MISSES)
+                return None
+
+            stale = age>self.ttl
+            self._count(self.STALE if stale else self.HITS)
+
+        if stale:
+            self._schedule(key)
+
+        body = zlib.decompress(entry[self.DATA])
+        for mark, getter in self.fragments:
+            body = body.replace(mark, getter() or "")
+
+        g.page_cache_key = None
+        response = current_app.response_class(body, headers=entry[self.HEADERS])
+        response.headers["X-Page-Cache"] = "stale" if stale else "hit"
+        response.headers["Age"] = str(int(age))
+        return response
+
+    def _uncacheable(self, response):
+        '''
+        Comprueba si una respuesta no se puede guardar.
+
+        @rtype str
+        @return motivo por el que no se puede guardar, o None
+        '''
+        if response.status_code!=200:
+            return "status"
+        if response.is_streamed or response.direct_passthrough:
+            return "streamed"
+        if response.mimetype!="text/html":
+            return "mimetype"
+        if getattr(g, "page_cache_skip", False):
+            return "view"
+        if getattr(_request_ctx_stack.top, "flashes", None) or "_flashes" in session:
+            return "flashes"
+        if not self.session_keys.issuperset(session.iterkeys()):
+            return "session"
+        return None
+
+    def store(self, response):
+        '''
+        Guarda la respuesta de la petición actual, si ha consultado la caché
+        sin encontrarla y no tiene contenido propio del visitante. Se llama
+        después de procesar la petición.
+
+        @type response: Response
+        @param response: respuesta de la petición
+
+        @rtype Response
+        @return la misma respuesta
+        '''
+        key = getattr(g, "page_cache_key", None)
+        if key is None:
+            return response
+        g.page_cache_key = None
+
+        data = None
+        if not self._uncacheable(response):
+            body = response.get_data()
+            for mark, getter in self.fragments:
+                value = getter()
+                if value:
+                    body = body.replace(value, mark)
+            data = zlib.compress(body, self.compress_level)
+            if len(data)>self.max_entry_bytes:
+                data = None
+
+        with self.lock:
+            # una página renovada que ya no se puede guardar descarta la anterior
+            if data is not None or request.environ.get(REFRESH_ENVIRON_KEY):
+                old = self.entries.pop(key, None)
+                if old is not None:
+                    self.size -= old[self.SIZE]
+
+            if data is None:
+                self._count(self.SKIPS)
+                return response
+
+            size = len(data)+len(key)+ENTRY_OVERHEAD
+            self.entries[key] = [data, [(name, value) for name, value in response.headers if name in STORED_HEADERS], time(), size]
+            self.size += size
+            while self.size>self.max_bytes:
+                self.size -= self.entries.popitem(False)[1][self.SIZE]
+            self._count(self.STORES)
+        return response
+
+    def _schedule(self, key):
+        '''
+        Encarga la renovación de una página caducada, si no está ya encargada.
+        '''
+        with self.lock:
+            if not self.app or key in self.pending or len(self.pending)>=self.max_pending:
+                return
+            self.pending.add(key)
+            if not self.pool:
+                self.pool = ThreadPool(processes=self.workers)
+
+        headers = [(name, request.headers[name]) for name in REFRESH_HEADERS if name in request.headers]
+        self.pool.apply_async(self._refresh, (key, request.path, request.query_string, request.url_root, headers, request.remote_addr))
+
+    def _refresh(self, key, path, query_string, url_root, headers, remote_addr):
+        '''
+        Repite una petición para renovar su página.
+        '''
+        try:
+            client = self.app.test_client()
+            client.get(path, query_string=query_string, base_url=url_root, headers=headers, buffered=True,
+                       environ_overrides={REFRESH_ENVIRON_KEY: True, "REMOTE_ADDR": remote_addr})
+        except BaseException as e:
+            logging.exception("Error refreshing cached page.")
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def purge(self):
+        '''
+        Descarta las páginas demasiado antiguas para servirlas.
+        '''
+        limit = time()-self.ttl-self.stale_ttl
+        with self.lock:
+            for key in [key for key, entry in self.entries.iteritems() if entry[self.STORED]<limit]:
+                self.size -= self.entries.pop(key)[self.SIZE]
+
+    def save_stats(self):
+        '''
+        Descarta las páginas antiguas y guarda en el profiler los contadores
+        de cada robot desde la última llamada y el tamaño de la caché. Se
+        ejecuta periódicamente desde el eventmanager.
+        '''
+        self.purge()
+        with self.lock:
+            stats, self.stats = self.stats, {}
+            data = {"pc_bytes": self.size, "pc_entries": len(self.entries)}
+
+        for bot, counters in stats.iteritems():
+            for name, value in zip(("hit", "stale", "miss", "store", "skip"), counters):
+                if value:
+                    data["pc_%s_%s" % (name, bot)] = value
+
+        if self.profiler:
+            self.profiler.save_data(data)
+        return data
+
+def hit_rates(stats, bots):
+    '''
+    Tasa de aciertos de la caché de páginas de cada robot, a partir de los
+    datos del profiler.
+
+    @type stats: dict
+    @param stats: estadísticas por clave, tal como las devuelve Profiler.get_data
+
+    @type bots: list
+    @param bots: nombres de los robots
+
+    @rtype list
+    @return tuplas con el robot, las peticiones por segundo servidas
+            frescas, caducadas y sin guardar, las páginas descartadas por
+            segundo y la fracción de peticiones servidas desde la caché
+    '''
+    rates = []
+    for bot in bots:
+        hits, stale, misses, skips = (stats["pc_%s_%s" % (name, bot)]["sum"] if "pc_%s_%s" % (name, bot) in stats else 0.
+                                      for name in ("hit", "stale", "miss", "skip"))
+        if hits or stale or misses:
+            rates.append((bot, hits, stale, misses, skips, (hits+stale)/(hits+stale+misses)))
+    return rates
+
+if __name__ == "__main__":
+    # Pruebas de la caché de páginas con una aplicación mínima: tasa de
+    # aciertos y latencia con tráfico de robots repartido como el real (pocas
+    # páginas muy visitadas y una cola larga), páginas con datos de usuario,
+    # token CSRF de cada petición, renovación de páginas caducadas y límite
+    # de memoria.
+    # Uso: python -m foofind.utils.pagecache
+    import random, re, bisect
+    from time import sleep
+    from flask import Flask, Blueprint, flash, render_template_string
+    from flask_seasurf import SeaSurf
+    from foofind import defaults
+
+    def check(label, condition):
+        print "%-72s %s" % (label, "ok" if condition else "FAILED")
+        if not condition:
+            raise SystemExit(1)
+
+    RENDER_TIME = 0.02
+    PAGE = u'''<html><head><script>var csrf_token="{{ csrf_token() }}";</script>{% if g.ios_device %}<link href="iphone_ipad.css">{% endif %}</head><body>
+        {% if session.user_id %}<p>hello {{ session.user_id }}</p>{% endif %}
+        {% for message in get_flashed_messages() %}<p>{{ message }}</p>{% endfor %}
+        <form><input type="hidden" name="_csrf_token" value="{{ csrf_token() }}"></form>
+        <h1>{{ query }}</h1>{% for i in range(200) %}<a href="/{{ lang }}/download/{{ (query ~ i)|hash }}">{{ query }} {{ i }}</a>{% endfor %}
+        </body></html>'''
+
+    class StatsProfiler(object):
+        def __init__(self):
+            self.data = []
+        def save_data(self, data):
+            self.data.append(data)
+
+    renders = []
+    files = Blueprint("files", __name__)
+    @files.route("/<lang>/search/<query>")
+    def search(lang, query):
+        renders.append(query)
+        sleep(RENDER_TIME)
+        if request.args.get("flash"):
+            flash("saved")
+        if request.args.get("partial"): # búsqueda aún no definitiva
+            page_cache.skip()
+        return render_template_string(PAGE, query=query, lang=lang)
+
+    @files.route("/<lang>/login/<user>")
+    def login(lang, user):
+        session["user_id"] = user
+        return "ok"
+
+    app = Flask(__name__)
+    app.config.from_object(defaults)
+    app.config.update(SECRET_KEY="test", PAGE_CACHE_MAX_BYTES=1024*1024)
+    app.jinja_env.filters["hash"] = lambda value: "%08x" % (hash(value)&0xffffffff)
+    csrf = SeaSurf(app)
+    app.register_blueprint(files)
+
+    @app.before_request
+    def before_request():
+        g.lang = request.view_args.get("lang", "en") if request.view_args else "en"
+        g.search_bot = "googlebot" if "Googlebot" in request.headers.get("User-Agent", "") else False
+        g.accept_cookies = "2"
+        g.user_build = "default"
+        g.ios_device = request.user_agent.platform=="iphone" or "ipad" in request.user_agent.string.lower()
+        return page_cache.get()
+
+    @app.after_request
+    def after_request(response):
+        return page_cache.store(response)
+
+    stats_profiler = StatsProfiler()
+    page_cache = PageCache()
+    page_cache.init_app(app, stats_profiler)
+    page_cache.add_fragment("csrf", csrf._get_token)
+
+    BOT = {"User-Agent": "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"}
+    MOBILE_BOT = {"User-Agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 6_0 like Mac OS X) AppleWebKit/536.26 (KHTML, like Gecko) Version/6.0 Mobile/10A5376e Safari/8536.25 (compatible; Googlebot-Mobile/2.1; +http://www.google.com/bot.html)"}
+    BROWSER = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/40.0 Safari/537.36"}
+    token = lambda response: re.search(r'csrf_token="(\w+)"', response.data).group(1)
+
+    # tráfico de robots: 5000 peticiones sobre 2000 páginas con distribución de Zipf
+    rnd = random.Random(0)
+    weights = [1./rank for rank in xrange(1, 2001)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0
+    for weight in weights:
+        acc += weight/total
+        cumulative.append(acc)
+    urls = ["/en/search/query%d" % min(bisect.bisect(cumulative, rnd.random()), 1999) for i in xrange(5000)]
+
+    client = app.test_client()
+    times = {"hit": [], None: []}
+    for url in urls:
+        start = time()
+        response = client.get(url, headers=BOT)
+        times[response.headers.get("X-Page-Cache")].append(time()-start)
+    data = page_cache.save_stats()
+    hits, misses = data.get("pc_hit_googlebot", 0), data.get("pc_miss_googlebot", 0)
+    median = lambda values: sorted(values)[len(values)/2]*1000
+    print "%d bot requests over %d pages: %d hits, %d misses, %d renders, %.1f%% hit rate" % (
+          len(urls), len(set(urls)), hits, misses, len(renders), hits*100./len(urls))
+    print "p50 %.2f ms served from the cache, %.2f ms rendered; %d pages in %d KB (%d KB limit)" % (
+          median(times["hit"]), median(times[None]), data["pc_entries"], data["pc_bytes"]/1024, app.config["PAGE_CACHE_MAX_BYTES"]/1024)
+    check("hits and misses add up to the bot requests", hits+misses==len(urls) and misses==len(renders))
+    check("memory stays within the limit", 0<page_cache.size<=app.config["PAGE_CACHE_MAX_BYTES"] and data["pc_entries"]<len(set(urls)))
+    check("counters are saved to the profiler", stats_profiler.data and stats_profiler.data[-1] is data)
+
+    # cada cliente recibe su propio token CSRF en la página guardada
+    url = urls[0]
+    first, second = app.test_client(), app.test_client()
+    response1, response2 = first.get(url, headers=BOT), second.get(url, headers=BOT)
+    check("cached page carries the token of each request",
+          response2.headers.get("X-Page-Cache")=="hit" and token(response1)!=token(response2)
+          and response2.data.count(token(response2))==2 and "\x00" not in response2.data)
+    check("token matches the csrf cookie set for the request", ("_csrf_token=%s" % token(response2)) in response2.headers.get("Set-Cookie", ""))
+
+    # páginas con datos de usuario
+    renders[:] = []
+    user = app.test_client()
+    user.get("/en/login/alice", headers=BOT)
+    response = user.get(url, headers=BOT)
+    check("logged in bots get a fresh page with their data", response.headers.get("X-Page-Cache") is None and "hello alice" in response.data)
+    user.get("/en/search/private", headers=BOT)
+    check("pages with user data are not stored", client.get("/en/search/private", headers=BOT).headers.get("X-Page-Cache") is None
+                                                 and "alice" not in client.get("/en/search/private", headers=BOT).data)
+    client.get("/en/search/flash?flash=1", headers=BOT)
+    check("pages with flash messages are not stored", client.get("/en/search/flash?flash=1", headers=BOT).headers.get("X-Page-Cache") is None)
+    client.get("/en/search/partial?partial=1", headers=BOT)
+    check("pages with partial search results are not stored", client.get("/en/search/partial?partial=1", headers=BOT).headers.get("X-Page-Cache") is None)
+    client.get("/en/search/browser", headers=BROWSER)
+    check("browsers never use the cache", client.get("/en/search/browser", headers=BROWSER).headers.get("X-Page-Cache") is None
+                                          and client.get("/en/search/browser", headers=BOT).headers.get("X-Page-Cache") is None)
+    client.get("/en/search/mobile", headers=BOT)
+    response = client.get("/en/search/mobile", headers=MOBILE_BOT)
+    check("iPhone and iPad bots get their own version of the page", response.headers.get("X-Page-Cache") is None and "iphone_ipad.css" in response.data
+                                                                  and "iphone_ipad.css" not in client.get("/en/search/mobile", headers=BOT).data)
+    client.get("/en/search/args?b=2&a=1", headers=BOT)
+    check("query arguments are normalized", client.get("/en/search/args?a=1&b=2", headers=BOT).headers.get("X-Page-Cache")=="hit")
+
+    # páginas caducadas: se sirven y se renuevan en segundo plano
+    page_cache.ttl = 0
+    renders[:] = []
+    response = client.get(url, headers=BOT)
+    check("stale page is served while it is refreshed", response.headers.get("X-Page-Cache")=="stale")
+    page_cache.pool.close()
+    page_cache.pool.join()
+    entry = page_cache.entries[[key for key in page_cache.entries if key.endswith(url[url.rfind("/"):]+"?|2|default|")][0]]
+    check("refresh renders the page again and stores it", renders==[url.rsplit("/", 1)[1]] and time()-entry[PageCache.STORED]<1 and not page_cache.pending)
+    page_cache.stale_ttl = 0
+    sleep(0.01)
+    check("expired pages are not served", client.get(url, headers=BOT).headers.get("X-Page-Cache") is None)
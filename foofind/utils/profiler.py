@@ -1,9 +1,47 @@
 # -*- coding: utf-8 -*-
+"""
+    Profiler de peticiones agregado en memoria.
+"""
+import os, socket, atexit
 from time import time
-from itertools import islice
+from threading import local, Lock, current_thread
+
+from sphinxservice.metrics import Histogram
+
+class ProfilerBuffer(object):
+    '''
+    Histogramas acumulados por un hilo desde el último volcado. Solo el hilo
+    propietario los modifica; el cerrojo únicamente se comparte con el
+    volcado, una vez por intervalo, así que nunca hay esperas en las peticiones.
+    '''
+    def __init__(self):
+        self.thread = current_thread()
+        self.lock = Lock()
+        self.stats = {}
+
+class Profiler(object):
+    '''
+    Agrega los datos de cada petición en histogramas por hilo y guarda en el
+    almacén un único documento resumen por proceso e intervalo, con lo que
+    cada petición solo cuesta unos microsegundos y se pueden obtener
+    percentiles de cada etapa.
+    '''
+    def __init__(self):
+        self.store = None
+        self.buffers = []
+        self.buffers_lock = Lock()
+        self.local = local()
+        self.since = time()
+        atexit.register(self.flush)
 
-class Profiler:
     def init_app(self, app, store):
+        '''
+        Inicializa el profiler.
+
+        @param app: Aplicación de Flask.
+
+        @param store: almacén de resúmenes, con save_profile_summary y get_profile_summaries
+        '''
         self.store = store
 
     def checkpoint(self, data, opening=(), closing=()):
@@ -14,42 +52,205 @@ class Profiler:
         for i in closing:
             data[i] += t
 
+    def _buffer(self):
+        buff = getattr(self.local, "buffer", None)
+        if buff is None:
+            buff = self.local.buffer = ProfilerBuffer()
+            with self.buffers_lock:
+                self.buffers.append(buff)
+        return buff
+
     def save_data(self, data):
+        '''
+        Acumula los datos de una petición en el buffer del hilo actual.
+
+        @type data: dict
+        @param data: valores por clave; las claves que empiezan por "_" y las
+                     etapas sin cerrar (valores negativos) se ignoran
+        '''
         try:
-            self.store.save_profile_info(data)
+            buff = self._buffer()
+            with buff.lock:
+                stats = buff.stats
+                for key, value in data.iteritems():
+                    if key[0]=='_' or value<0:
+                        continue
+                    histogram = stats.get(key)
+                    if histogram is None:
+                        histogram = stats[key] = Histogram()
+                    histogram.record(value)
         except:
             pass
 
+    def flush(self):
+        '''
+        Combina los buffers de todos los hilos y guarda el resumen del
+        intervalo. Se ejecuta periódicamente y al terminar el proceso.
+        '''
+        with self.buffers_lock:
+            buffers = list(self.buffers)
+
+        merged = {}
+        finished = []
+        for buff in buffers:
+            with buff.lock:
+                stats, buff.stats = buff.stats, {}
+            if not buff.thread.is_alive():
+                finished.append(buff)
+            for key, histogram in stats.iteritems():
+                if key in merged:
+                    merged[key].merge(histogram)
+                else:
+                    merged[key] = histogram
+
+        if finished:
+            with self.buffers_lock:
+                self.buffers = [buff for buff in self.buffers if buff not in finished]
+
+        now = time()
+        summary = {"_date": now, "_start": self.since,
+                   "_worker": "%s:%d" % (socket.gethostname(), os.getpid()),
+                   "stats": {key: encode_histogram(histogram) for key, histogram in merged.iteritems()}}
+        self.since = now
+
+        if merged and self.store:
+            try:
+                self.store.save_profile_summary(summary)
+            except:
+                pass
+        return summary
+
     def get_data(self, start):
-        results={}
-        last_date = start
-        for log in self.store.get_profile_info(start):
-            for key,value in log.iteritems():
-                if key[0]=='_': continue
+        '''
+        Combina los resúmenes guardados desde una fecha.
+
+        @type start: float
+        @param start: fecha de inicio
 
-                if key in results:
-                    current = results[key]
+        @rtype tuple
+        @return estadísticas por clave (valores por segundo, media, mínimo,
+                máximo y percentiles), fecha del último resumen y número
+                de procesos que han enviado resúmenes
+        '''
+        histograms = {}
+        workers = set()
+        last_date = start
+        for summary in self.store.get_profile_summaries(start):
+            workers.add(summary["_worker"])
+            for key, data in summary["stats"].iteritems():
+                if key in histograms:
+                    histograms[key].merge(decode_histogram(data))
                 else:
-                    current = {"count":0}
-
-                if value>0:
-                    if current["count"]:
-                        current["max"] = max(value, current["max"])
-                        current["min"] = min(value, current["min"])
-                        current["sum"] = value+current["sum"]
-                    else:
-                        current["max"] = value
-                        current["min"] = value
-                        current["sum"] = value
-                    current["count"]+=1
-                results[key] = current
-            last_date = max(log["_date"], last_date)
+                    histograms[key] = decode_histogram(data)
+            last_date = max(summary["_date"], last_date)
 
         length = (last_date-start) or 1 # segundos transcurridos
 
-        for key in results.iterkeys():
-            if "sum" in results[key]:
-                results[key]["mean"] = results[key]["sum"]/results[key]["count"]
-                results[key]["sum"]  = results[key]["sum"]/length
-            results[key]["count"] /= length
-        return results, last_date
+        results = {}
+        for key, histogram in histograms.iteritems():
+            current = results[key] = histogram.summary()
+            current["sum"] = histogram.total/1000000./length
+            current["count"] = histogram.count/float(length)
+        return results, last_date, len(workers)
+
+def encode_histogram(histogram):
+    '''
+    Representa un histograma como documento de base de datos.
+    '''
+    return {"n": histogram.count, "t": histogram.total, "mn": histogram.min or 0, "mx": histogram.max,
+            "h": {str(index): count for index, count in histogram.counts.iteritems()}}
+
+def decode_histogram(data):
+    '''
+    Obtiene un histograma a partir de su documento.
+    '''
+    histogram = Histogram()
+    histogram.counts = {int(index): count for index, count in data["h"].iteritems()}
+    histogram.count = data["n"]
+    histogram.total = data["t"]
+    histogram.min = data["mn"]
+    histogram.max = data["mx"]
+    return histogram
+
+if __name__ == "__main__":
+    # Coste por petición y documentos escritos, comparando con guardar un
+    # documento por petición en la cola de escritura de feedback, y
+    # comprobación de los datos combinados de varios hilos y procesos.
+    # Uso: python -m foofind.utils.profiler
+    import random, bson
+    from Queue import Queue
+    from threading import Thread
+
+    def check(label, condition):
+        print "%-72s %s" % (label, "ok" if condition else "FAILED")
+        if not condition:
+            raise SystemExit(1)
+
+    class MemoryStore(object):
+        def __init__(self):
+            self.summaries = []
+        def save_profile_summary(self, summary):
+            self.summaries.append(summary)
+        def get_profile_summaries(self, start):
+            return [summary for summary in self.summaries if summary["_date"]>start]
+
+    THREADS, REQUESTS = 8, 20000
+    rnd = random.Random(0)
+    samples = [{"sphinx": rnd.expovariate(1/0.05), "entities": rnd.expovariate(1/0.002), "mongo": rnd.expovariate(1/0.01),
+                "visited": rnd.expovariate(1/0.0005), "cache_gets": rnd.randint(1, 6), "cache_rt": rnd.randint(0, 2)}
+               for i in xrange(REQUESTS)]
+
+    def run(save):
+        def worker(number):
+            for data in samples[number::THREADS]:
+                save(dict(data))
+        threads = [Thread(target=worker, args=(number,)) for number in xrange(THREADS)]
+        start = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return (time()-start)/REQUESTS
+
+    # antes: un documento por petición en la cola de escritura, que el hilo
+    # de escritura del mismo proceso codificaba después para insertarlo
+    queue = Queue()
+    def save_document(data):
+        data["_date"] = time()
+        queue.put_nowait(("profiler", data))
+        bson.BSON.encode(data)
+    old_cost = run(save_document)
+
+    store = MemoryStore()
+    profiler = Profiler()
+    profiler.init_app(None, store)
+    new_cost = run(profiler.save_data)
+    profiler.flush()
+    print "per request: %.2f us queueing and encoding a document, %.2f us aggregated" % (old_cost*1e6, new_cost*1e6)
+    check("%d requests, %d threads: %d documents instead of %d" % (REQUESTS, THREADS, len(store.summaries), queue.qsize()),
+          len(store.summaries)==1 and queue.qsize()==REQUESTS)
+    check("no samples lost across thread buffers",
+          all(stats["n"]==REQUESTS for stats in store.summaries[0]["stats"].itervalues()))
+    check("finished threads release their buffers", len(profiler.buffers)==0)
+
+    # varios procesos: los percentiles se calculan combinando los cubos
+    store = MemoryStore()
+    start = time()-1
+    values = []
+    for worker in xrange(4):
+        profiler = Profiler()
+        profiler.init_app(None, None)
+        for i in xrange(5000):
+            value = rnd.expovariate(1/(0.01*(worker+1)))
+            values.append(value)
+            profiler.save_data({"sphinx": value, "mongo": -time()})
+        store.save_profile_summary(dict(profiler.flush(), _worker="worker%d"%worker))
+    profiler.init_app(None, store)
+    stats, last_date, workers = profiler.get_data(start)
+    values.sort()
+    errors = [abs(stats["sphinx"]["p%d"%percent]-values[int(len(values)*percent/100.)-1])/values[int(len(values)*percent/100.)-1]
+              for percent in (50, 90, 99)]
+    print "merged p50/p90/p99 %s, relative errors %s" % ("/".join("%.4f" % stats["sphinx"][p] for p in ("p50", "p90", "p99")),
+                                                         "/".join("%.1f%%" % (error*100) for error in errors))
+    check("percentiles merged from %d workers within 4%%" % workers, workers==4 and max(errors)<0.04)
+    check("unfinished stages are ignored", "mongo" not in stats)
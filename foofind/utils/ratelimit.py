@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+    Limitador de ratio de peticiones con cubos locales al proceso.
+"""
+import heapq
+import os
+from threading import Lock, Thread
+from time import time, sleep
+
+from . import logging
+
+class RateLimiter(object):
+    '''
+    Limitador de peticiones que mantiene un cubo de tokens por clave en la
+    memoria del proceso y reconcilia periódicamente las cuentas con memcached.
+
+    Las peticiones sólo consumen tokens del cubo local, sin acceder a red. La
+    sincronización (método sync, ejecutado en su propio hilo) envía a
+    memcached las peticiones pendientes de cada clave, en las mismas claves y
+    ventanas que usaba el limitador síncrono, y ajusta los tokens locales con
+    la cuenta global de todos los procesos.
+
+    Entre sincronizaciones cada proceso sólo puede consumir una fracción
+    (lease) de los tokens que quedan globalmente, de forma que el exceso
+    respecto al límite global se mantiene acotado aunque varios procesos
+    reciban a la vez las peticiones de la misma clave.
+
+    Cada sincronización trata como mucho max_sync_keys claves, primero las
+    de más peticiones pendientes. Las claves sin peticiones nuevas solo se
+    vuelven a leer cada idle_sync_interval segundos, ya que el lease acota
+    lo que pueden consumir mientras tanto.
+
+    Si una clave lleva más de stale_sync segundos sin sincronizarse, porque
+    la sincronización se retrasa o la deja fuera, al agotar su lease se
+    admiten peticiones con la cuenta local en lugar de rechazarlas todas.
+    '''
+    # posiciones en la lista de cada cubo
+    TOKENS, PENDING, EXPIRATION, LIMIT, LEASE, SYNCED = xrange(6)
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = Lock()
+        self.cache = None
+        self.window = 60
+        self.max_keys = 50000
+        self.lease = 0.1
+        self.idle_sync_interval = 5
+        self.max_sync_keys = 1000
+        self.stale_sync = 2
+        self.sync_interval = 0.3
+        self.sync_errors = 0
+        self._syncer_pid = None
+
+    def init_app(self, app, cache):
+        '''
+        Inicializa el limitador con la configuración de la aplicación.
+
+        @param app: Aplicación de Flask.
+        @param cache: Objeto de caché de la aplicación.
+        '''
+        self.cache = cache
+        self.window = app.config["RATE_LIMIT_WINDOW"]
+        self.max_keys = app.config["RATE_LIMIT_MAX_KEYS"]
+        self.lease = app.config["RATE_LIMIT_LEASE"]
+        self.idle_sync_interval = app.config["RATE_LIMIT_IDLE_SYNC_INTERVAL"]
+        self.max_sync_keys = app.config["RATE_LIMIT_MAX_SYNC_KEYS"]
+        self.stale_sync = app.config["RATE_LIMIT_STALE_SYNC"]
+        self.sync_interval = app.config["RATE_LIMIT_SYNC_INTERVAL"]
+
+    def start(self):
+        '''
+        Arranca el hilo de sincronización, propio para que no lo retrasen las
+        demás tareas periódicas. Debe llamarse en cada proceso tras el fork.
+        '''
+        if self._syncer_pid != os.getpid():
+            self._syncer_pid = os.getpid()
+            thread = Thread(target=self._sync_loop, name="ratelimit-sync")
+            thread.daemon = True
+            thread.start()
+
+    def _sync_loop(self):
+        while True:
+            sleep(self.sync_interval)
+            try:
+                self.sync()
+            except BaseException as e:
+                logging.exception("Error synchronizing rate limit counters.")
+
+    def _lease(self, tokens):
+        '''
+        Calcula los tokens que puede consumir el proceso hasta la siguiente
+        sincronización.
+        '''
+        return max(1, int(tokens*self.lease)) if tokens>0 else 0
+
+    def hit(self, key, limit):
+        '''
+        Consume un token del cubo de la clave dada.
+
+        @type key: str
+        @param key: clave del contador
+
+        @type limit: int
+        @param limit: peticiones permitidas por ventana
+
+        @rtype int
+        @return número estimado de peticiones de la clave en la ventana actual
+        '''
+        now = time()
+        with self.lock:
+            bucket = self.buckets.get(key, None)
+            if bucket is None or (bucket[self.EXPIRATION]<now and not bucket[self.PENDING]):
+                bucket = self.buckets[key] = [limit, 0, now+self.window, limit, self._lease(limit), 0]
+            bucket[self.TOKENS] -= 1
+            bucket[self.PENDING] += 1
+            bucket[self.LEASE] -= 1
+            current = limit - bucket[self.TOKENS]
+
+            # sin tokens concedidos hasta la siguiente sincronización, salvo que se retrase:
+            # entonces decide la cuenta local
+            if bucket[self.LEASE]<0 and now-(bucket[self.SYNCED] or bucket[self.EXPIRATION]-self.window)<=self.stale_sync:
+                return max(current, limit+1)
+            return current
+
+    def sync(self):
+        '''
+        Envía a memcached las peticiones pendientes de cada clave y actualiza los
+        cubos locales con las cuentas globales.
+        '''
+        now = time()
+        idle_limit = now-self.idle_sync_interval
+
+        # toma las peticiones pendientes y descarta cubos sin uso
+        with self.lock:
+            pending = []
+            idle = []
+            for key, bucket in self.buckets.items():
+                if bucket[self.PENDING]:
+                    pending.append((bucket[self.PENDING], key))
+                elif bucket[self.EXPIRATION]<now or len(self.buckets)>self.max_keys:
+                    del self.buckets[key]
+                elif bucket[self.SYNCED]<idle_limit:
+                    idle.append((bucket[self.SYNCED], key))
+
+            # primero las claves con más peticiones; el resto espera a la siguiente sincronización
+            if len(pending)>self.max_sync_keys:
+                pending = heapq.nlargest(self.max_sync_keys, pending)
+            pending = [(key, count, bool(self.buckets[key][self.SYNCED])) for count, key in pending]
+            for key, count, synced in pending:
+                self.buckets[key][self.PENDING] = 0
+
+            # de las claves sin peticiones nuevas, las que hace más tiempo que no se leen
+            idle = [key for synced, key in heapq.nsmallest(max(0, self.max_sync_keys-len(pending)), idle)]
+
+        # actualiza contadores globales
+        updates = {}
+        for position, (key, count, synced) in enumerate(pending):
+            try:
+                # si la clave ya existe en esta ventana basta con incrementarla
+                current = self.cache.inc(key, count) if synced else None # devuelve None si la clave ha expirado
+                if current is None:
+                    if self.cache.add(key, count, timeout=self.window):
+                        updates[key] = (count, True) # nueva ventana
+                        continue
+                    current = self.cache.inc(key, count)
+                    if current is None:
+                        self.cache.add(key, count, timeout=self.window)
+                        updates[key] = (count, True)
+                        continue
+                updates[key] = (int(current), False)
+            except BaseException as e:
+                # devuelve las peticiones a los cubos para enviarlas en la siguiente sincronización
+                self.sync_errors += 1
+                with self.lock:
+                    for key, count, synced in pending[position:]:
+                        if key in self.buckets:
+                            self.buckets[key][self.PENDING] += count
+                logging.warn("Error synchronizing rate limit counters: %s" % repr(e))
+                break
+
+        # las claves sin peticiones nuevas se consultan juntas
+        if idle:
+            try:
+                for key, current in self.cache.cache.get_dict(*idle).iteritems():
+                    if current is not None:
+                        updates[key] = (int(current), False)
+            except BaseException as e:
+                self.sync_errors += 1
+                logging.warn("Error reading rate limit counters: %s" % repr(e))
+
+        # ajusta los tokens locales con las cuentas globales
+        with self.lock:
+            for key, (current, new_window) in updates.iteritems():
+                bucket = self.buckets.get(key, None)
+                if bucket is None:
+                    continue
+                bucket[self.TOKENS] = bucket[self.LIMIT] - current - bucket[self.PENDING]
+                bucket[self.LEASE] = self._lease(bucket[self.TOKENS])
+                bucket[self.SYNCED] = now
+                if new_window:
+                    bucket[self.EXPIRATION] = now+self.window
+
+if __name__ == "__main__":
+    # Simulación con varios procesos compartiendo un contador global, con
+    # carga sesgada (un cliente concentra la mayoría de peticiones y el resto
+    # se reparte entre muchas IPs), contando los accesos a memcached.
+    from multiprocessing import Process, Manager
+    from threading import Thread
+    from time import sleep
+    import random
+
+    WORKERS = 8
+    LIMIT = 200
+    DURATION = 5
+    SYNC_INTERVAL = 0.3
+    ROUND_TRIP = 0.0005 # tiempo de acceso a memcached que se ahorra cada petición
+
+    class FakeCache(object):
+        def __init__(self, store, lock):
+            self.store = store
+            self.access = lock
+            self.cache = self
+            self.operations = self.keys_read = 0
+
+        def add(self, key, value, timeout=None):
+            self.operations += 1
+            with self.access:
+                if key in self.store:
+                    return False
+                self.store[key] = value
+                return True
+
+        def inc(self, key, delta=1):
+            self.operations += 1
+            with self.access:
+                if not key in self.store:
+                    return None
+                self.store[key] += delta
+                return self.store[key]
+
+        def get_dict(self, *keys):
+            self.operations += 1
+            self.keys_read += len(keys)
+            return {key:self.store.get(key, None) for key in keys}
+
+    def worker(store, lock, results, seed):
+        rnd = random.Random(seed)
+        limiter = RateLimiter()
+        limiter.cache = FakeCache(store, lock)
+        limiter.window = DURATION*2 # una sola ventana en toda la simulación
+
+        def syncer():
+            while syncing:
+                sleep(SYNC_INTERVAL)
+                limiter.sync()
+        syncing = True
+        thread = Thread(target=syncer)
+        thread.start()
+
+        allowed = {}
+        requests = 0
+        end = time()+DURATION
+        while time()<end:
+            key = "hot" if rnd.random()<0.8 else "ip%d"%rnd.randint(0, 5000)
+            if limiter.hit(key, LIMIT)<=LIMIT:
+                allowed[key] = allowed.get(key, 0)+1
+            requests += 1
+            sleep(0.001)
+
+        syncing = False
+        thread.join()
+        limiter.sync()
+        results.append((requests, allowed, limiter.cache.operations, limiter.cache.keys_read))
+
+    manager = Manager()
+    store, lock, results = manager.dict(), manager.Lock(), manager.list()
+    processes = [Process(target=worker, args=(store, lock, results, i)) for i in xrange(WORKERS)]
+    for p in processes: p.start()
+    for p in processes: p.join()
+
+    requests = sum(r[0] for r in results)
+    hot_allowed = sum(r[1].get("hot", 0) for r in results)
+    print "Requests: %d, hot key allowed: %d (limit %d, error %+.1f%%)" % (requests, hot_allowed, LIMIT, (hot_allowed-LIMIT)*100./LIMIT)
+    operations = sum(r[2] for r in results)
+    print "Memcached operations: %d (%.2f per request, instead of 1 inc per request), %d idle keys read" % (operations, operations/float(requests), sum(r[3] for r in results))
+    print "Round trips avoided: %d (~%.2f s of request time with %.1f ms per round trip)" % (requests*2, requests*2*ROUND_TRIP, ROUND_TRIP*1000)
+
+    # sincronización detenida: tras agotar el lease se rechaza hasta que las cuentas se consideran antiguas
+    limiter = RateLimiter()
+    limiter.cache = FakeCache({}, Lock())
+    limiter.stale_sync = 0.5
+    before = sum(1 for i in xrange(100) if limiter.hit("stalled", LIMIT)<=LIMIT)
+    sleep(limiter.stale_sync+0.1)
+    after = sum(1 for i in xrange(100) if limiter.hit("stalled", LIMIT)<=LIMIT)
+    print "Stalled sync: %d/100 allowed while recent, %d/100 allowed after %.1f s without sync (limit %d)" % (before, after, limiter.stale_sync, LIMIT)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+    Índice de sitemaps generado en segundo plano.
+"""
+import httplib, time, datetime, os
+from hashlib import md5
+from threading import Lock, Thread
+from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
+
+from . import logging
+
+class SitemapIndex(object):
+    '''
+    Mantiene el índice de sitemaps de cada dominio.
+
+    El método refresh, ejecutado periódicamente en un hilo propio para no
+    retrasar el arranque ni las tareas del eventmanager, consulta en paralelo los sitemaps de segundo nivel de cada servidor de
+    ficheros con peticiones HEAD con timeout. Si un servidor no responde se
+    mantiene la última fecha válida conocida, de forma que un servidor lento o
+    caído no afecta al índice. Las peticiones se sirven con el XML ya generado.
+    '''
+    def __init__(self):
+        self.snapshots = {}   # dominio -> (xml, etag, fecha de modificación)
+        self.entries = {}     # url -> fecha de modificación conocida
+        self.lock = Lock()
+        self.app = None
+        self.filesdb = None
+        self.urlformats = {}
+        self.timeout = 5
+        self.probes = 10
+        self.interval = 60*60
+        self._refresher_pid = None
+
+    def init_app(self, app, filesdb):
+        '''
+        Inicializa el índice con la configuración de la aplicación.
+
+        @param app: Aplicación de Flask.
+        @param filesdb: Acceso a datos de ficheros, para obtener los servidores.
+        '''
+        self.app = app
+        self.filesdb = filesdb
+        self.urlformats = app.config["FILES_SITEMAP_URL"]
+        self.timeout = app.config["SITEMAP_PROBE_TIMEOUT"]
+        self.probes = app.config["SITEMAP_PROBE_THREADS"]
+        self.interval = app.config["SITEMAP_REFRESH_INTERVAL"]
+
+    def start(self):
+        '''
+        Arranca el hilo de refresco, que genera el índice de inmediato y luego
+        lo renueva periódicamente. Debe llamarse en cada proceso tras el fork.
+        '''
+        if self._refresher_pid != os.getpid():
+            self._refresher_pid = os.getpid()
+            thread = Thread(target=self._refresh_loop, name="sitemap-refresh")
+            thread.daemon = True
+            thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except BaseException as e:
+                logging.exception("Error refreshing sitemaps index.")
+            time.sleep(self.interval)
+
+    def probe(self, url):
+        '''
+        Obtiene la fecha de modificación de un sitemap de segundo nivel.
+
+        @type url: str
+        @param url: url del sitemap
+
+        @rtype datetime o None
+        @return fecha de modificación, o None si no se puede obtener
+        '''
+        try:
+            con = httplib.HTTPConnection(urlparse(url)[1], timeout=self.timeout)
+            try:
+                con.request("HEAD", url)
+                response = con.getresponse()
+                if response.status == 200:
+                    mtime = time.mktime(time.strptime(response.getheader("last-modified"), "%a, %d %b %Y %H:%M:%S %Z"))
+                    return datetime.datetime.fromtimestamp(mtime)
+            finally:
+                con.close()
+        except BaseException as e:
+            logging.debug("Error probing sitemap %s: %s" % (url, repr(e)))
+        return None
+
+    def render(self, rules):
+        '''
+        Genera el XML del índice.
+        '''
+        return self.app.jinja_env.get_template("sitemap.xml").render(rules=rules).encode("utf-8")
+
+    def refresh(self):
+        '''
+        Consulta los sitemaps de todos los servidores y regenera los índices.
+        '''
+        if not self.urlformats:
+            return
+
+        servers = self.filesdb.get_servers()
+        urls = {domain: [urlformat % int(server["_id"]) for server in servers] for domain, urlformat in self.urlformats.iteritems()}
+        all_urls = list(set(url for domain_urls in urls.itervalues() for url in domain_urls))
+
+        pool = ThreadPool(min(self.probes, len(all_urls)) or 1)
+        try:
+            results = pool.map(self.probe, all_urls)
+        finally:
+            pool.close()
+
+        # conserva la última fecha válida de los servidores que no responden
+        failed = []
+        with self.lock:
+            for url, lastmod in zip(all_urls, results):
+                if lastmod:
+                    self.entries[url] = lastmod
+                else:
+                    failed.append(url)
+            for url in self.entries.keys():
+                if not url in all_urls:
+                    del self.entries[url]
+
+            for domain, domain_urls in urls.iteritems():
+                rules = [(url, self.entries[url]) for url in domain_urls if url in self.entries]
+                xml = self.render(rules)
+                previous = self.snapshots.get(domain, None)
+                if previous and previous[0] == xml:
+                    continue
+                last_modified = max(lastmod for url, lastmod in rules) if rules else datetime.datetime.utcnow()
+                self.snapshots[domain] = (xml, md5(xml).hexdigest(), last_modified)
+
+        if failed:
+            logging.error("Hay sitemaps no disponibles", extra={"failed":failed})
+
+    def get(self, domain):
+        '''
+        Obtiene el índice de sitemaps de un dominio.
+
+        @type domain: str
+        @param domain: dominio
+
+        @rtype tuple o None
+        @return tupla (xml, etag, fecha de modificación), o None si aún no se ha generado
+        '''
+        return self.snapshots.get(domain, None)
+
+if __name__ == "__main__":
+    # Prueba con servidores HTTP locales: uno correcto, uno lento, uno que
+    # falla y uno caído.
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from threading import Thread
+    from jinja2 import Environment, DictLoader
+    import os
+
+    class Handler(BaseHTTPRequestHandler):
+        behaviour = {}
+        def do_HEAD(self):
+            server = int(self.path.split("/")[-1].split(".")[0])
+            behaviour = self.behaviour[server]
+            if behaviour=="slow":
+                time.sleep(3)
+            if behaviour=="fail":
+                self.send_response(500)
+            else:
+                self.send_response(200)
+                self.send_header("Last-Modified", "Mon, 01 Jun 2015 10:00:00 GMT")
+            self.end_headers()
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    httpd = Server(("127.0.0.1", 0), Handler)
+    port = httpd.server_address[1]
+    Thread(target=httpd.serve_forever).start()
+
+    class FakeApp:
+        config = {"FILES_SITEMAP_URL": {"foofind.is": "http://127.0.0.1:%d/sitemap/%%d.xml" % port,
+                                        "foofind.com": "http://127.0.0.1:1/sitemap/%d.xml"}, # caído
+                  "SITEMAP_PROBE_TIMEOUT": 1, "SITEMAP_PROBE_THREADS": 10, "SITEMAP_REFRESH_INTERVAL": 60*60}
+        template = open(os.path.join(os.path.dirname(__file__), "..", "templates", "sitemap.xml")).read().decode("utf-8")
+        jinja_env = Environment(loader=DictLoader({"sitemap.xml": template}))
+
+    class FakeFilesStore:
+        def get_servers(self):
+            return [{"_id": float(i)} for i in xrange(1, 5)]
+
+    index = SitemapIndex()
+    index.init_app(FakeApp(), FakeFilesStore())
+
+    Handler.behaviour = {1: "ok", 2: "slow", 3: "ok", 4: "ok"}
+    start = time.time()
+    index.start()
+    started = time.time()-start
+    while index.get("foofind.is") is None:
+        time.sleep(0.01)
+    print "Background start: returned in %.3f s, index ready in %.2f s" % (started, time.time()-start)
+
+    Handler.behaviour = {1: "ok", 2: "ok", 3: "ok", 4: "ok"}
+    start = time.time()
+    index.refresh()
+    print "All servers up: %d entries in %.2f s" % (len(index.entries), time.time()-start)
+
+    Handler.behaviour = {1: "ok", 2: "slow", 3: "fail", 4: "ok"}
+    start = time.time()
+    index.refresh()
+    xml, etag, last_modified = index.get("foofind.is")
+    print "Slow and failing servers: %d sitemaps served in %.2f s (last known good kept), etag %s" % (xml.count("<sitemap>"), time.time()-start, etag)
+    print "Unreachable domain: %d sitemaps" % index.get("foofind.com")[0].count("<sitemap>")
+    httpd.shutdown()
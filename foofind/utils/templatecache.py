@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+    Caché persistente de plantillas compiladas, compartida entre workers.
+"""
+import os, sys, tempfile
+from hashlib import sha1
+from time import time
+from jinja2.bccache import FileSystemBytecodeCache, Bucket
+
+from . import logging
+
+TEMPLATE_EXTENSIONS = ("html", "xml", "txt")
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    '''
+    Caché de bytecode de jinja en disco.
+
+    La clave de cada plantilla incluye el hash de su código fuente y de la
+    configuración de extensiones del entorno (clases y código de sus
+    módulos), de modo que distintas versiones de la aplicación pueden
+    compartir directorio sin invalidarse entre sí. Los ficheros se escriben
+    en un temporal y se renombran, para que un worker nunca lea un fichero
+    a medio escribir de otro.
+    '''
+    def __init__(self, directory=None):
+        FileSystemBytecodeCache.__init__(self, directory, "__foofind_%s.cache")
+        self.salt = None
+
+    def extensions_salt(self, environment):
+        '''
+        Obtiene el hash de la configuración de extensiones del entorno.
+        '''
+        data = sha1()
+        for extension in sorted(environment.extensions.itervalues(), key=lambda ext: ext.identifier):
+            data.update(extension.identifier)
+            module = sys.modules.get(type(extension).__module__, None)
+            filename = getattr(module, "__file__", None)
+            if filename:
+                if filename.endswith((".pyc", ".pyo")):
+                    filename = filename[:-1]
+                try:
+                    with open(filename, "rb") as f:
+                        data.update(f.read())
+                except IOError:
+                    pass
+        for option in ("block_start_string", "variable_start_string", "comment_start_string",
+                       "line_statement_prefix", "trim_blocks", "lstrip_blocks", "newline_sequence"):
+            data.update("|%r" % (getattr(environment, option, None),))
+        return data.hexdigest()
+
+    def get_bucket(self, environment, name, filename, source):
+        if self.salt is None:
+            self.salt = self.extensions_salt(environment)
+        key = sha1("%s|%s|%s" % (self.get_cache_key(name, filename), self.get_source_checksum(source), self.salt)).hexdigest()
+        bucket = Bucket(environment, key, self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        fd, temp = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                bucket.write_bytecode(f)
+            os.rename(temp, filename)
+        except BaseException as e:
+            logging.warn("Error saving template bytecode: %s" % repr(e))
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+def init_bytecode_cache(app):
+    '''
+    Asigna la caché de bytecode al entorno de plantillas de la aplicación.
+
+    @param app: Aplicación de Flask.
+    '''
+    if app.config["TEMPLATE_BYTECODE_CACHE"]:
+        directory = app.config["TEMPLATE_BYTECODE_CACHE_DIR"]
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        app.jinja_env.bytecode_cache = TemplateBytecodeCache(directory)
+
+def warm_templates(environment):
+    '''
+    Carga todas las plantillas, compilándolas si no están en la caché de
+    bytecode. Debe llamarse después de registrar filtros y extensiones.
+
+    @param environment: entorno de jinja
+
+    @rtype dict
+    @return tiempo de carga en segundos de cada plantilla
+    '''
+    timings = {}
+    for name in environment.list_templates(extensions=TEMPLATE_EXTENSIONS):
+        start = time()
+        try:
+            environment.get_template(name)
+        except BaseException as e:
+            logging.warn("Error precompiling template %s: %s" % (name, repr(e)))
+            continue
+        timings[name] = time() - start
+    return timings
+
+if __name__ == "__main__":
+    # Tiempo de carga de cada plantilla en un worker nuevo, sin caché y con la
+    # caché ya generada por otro worker. El entorno usa las extensiones de la
+    # aplicación; los filtros se sustituyen por uno genérico, porque sólo se
+    # mide la compilación y no el renderizado.
+    # Uso: python -m foofind.utils.templatecache
+    import shutil
+    from jinja2 import Environment, FileSystemLoader
+    from foofind.utils.htmlcompress import HTMLCompress
+
+    class AnyFilter(dict):
+        def get(self, key, default=None):
+            return dict.get(self, key, lambda value, *args, **kwargs: value)
+        __getitem__ = get
+        __contains__ = lambda self, key: True
+
+    def new_worker(bytecode_cache):
+        environment = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), "..", "templates")),
+                                  extensions=["jinja2.ext.i18n", HTMLCompress], bytecode_cache=bytecode_cache)
+        environment.filters = AnyFilter(environment.filters)
+        return environment
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = []
+        for label, bytecode_cache in (("no cache", None), ("cold cache", TemplateBytecodeCache(directory)), ("warm cache", TemplateBytecodeCache(directory))):
+            results.append((label, warm_templates(new_worker(bytecode_cache))))
+
+        print "%-36s %s" % ("template", " ".join("%12s" % label for label, timings in results))
+        for name in sorted(results[0][1]):
+            print "%-36s %s" % (name, " ".join("%9.2f ms" % (timings.get(name, 0)*1000) for label, timings in results))
+        print "%-36s %s" % ("total", " ".join("%9.2f ms" % (sum(timings.values())*1000) for label, timings in results))
+    finally:
+        shutil.rmtree(directory)
@@ -20,16 +20,18 @@ from foofind.user import User
 from foofind.blueprints.index import index
 from foofind.blueprints.page import page
 from foofind.blueprints.user import user,init_oauth
-from foofind.blueprints.files import files
+from foofind.blueprints.files import files, related_files
 from foofind.blueprints.api import api
 from foofind.blueprints.downloader import downloader, get_downloader_properties
 from foofind.blueprints.labs import add_labs, init_labs
 from foofind.templates import register_filters
+from foofind.utils.templatecache import init_bytecode_cache, warm_templates
 from foofind.utils.webassets_filters import JsSlimmer, CssSlimmer
 from foofind.utils import u, logging
 from foofind.forms.files import SearchForm
 from foofind.utils.exceptions import allerrors, get_error_code_information
-from foofind.utils.bots import is_search_bot, is_full_browser, check_rate_limit
+from foofind.utils.bots import is_search_bot, is_full_browser, is_ios_device, check_rate_limit
+from foofind.utils.pagecache import REFRESH_ENVIRON_KEY
 
 try:
     from uwsgidecorators import postfork
@@ -40,6 +42,16 @@ try:
 except ImportError:
     pass
 
+try:
+    import uwsgi
+    def shutdown():
+        # uWSGI puede parar los workers sin ejecutar atexit: guarda los datos pendientes
+        profiler.flush()
+        feedbackdb.flush()
+    uwsgi.atexit = shutdown
+except ImportError:
+    pass
+
 def create_app(config=None, debug=False):
     '''
     Inicializa la aplicación Flask. Carga los siguientes módulos:
@@ -101,6 +113,7 @@ def create_app(config=None, debug=False):
     # Registra valores/funciones para plantillas
     app.jinja_env.globals["u"] = u
     app.jinja_env.auto_reload = debug
+    init_bytecode_cache(app)
 
     # Oauth
     init_oauth(app)
@@ -205,6 +218,9 @@ def create_app(config=None, debug=False):
     cache.init_app(app)
     configdb.register_action("flush_cache", cache.clear, _unique=True)
 
+    # Limite de peticiones
+    ratelimiter.init_app(app, cache)
+
     # Autenticación
     auth.setup_app(app)
     auth.login_view="user.login"
@@ -238,6 +254,27 @@ def create_app(config=None, debug=False):
 
     # Profiler
     profiler.init_app(app, feedbackdb)
+    eventmanager.interval(app.config["PROFILER_FLUSH_INTERVAL"], profiler.flush)
+
+    # Muestreo de pilas de los procesos web y de los servicios de búsqueda
+    sampler.configure(app.config["SAMPLER_INTERVAL"], app.config["SAMPLER_MAX_OVERHEAD"])
+    configdb.register_action("sampler_start", sampler.start, app.config["SAMPLER_DURATION"], feedbackdb.save_sampler_report)
+    configdb.register_action("sampler_stop", sampler.stop)
+
+    def start_services_sampler():
+        '''
+        Search services sampling started.
+        '''
+        searchd.sphinx.start_service_sampler()
+
+    def stop_services_sampler():
+        '''
+        Search services sampling stopped.
+        '''
+        searchd.sphinx.start_service_sampler(stop=True)
+
+    configdb.register_action("sampler_start_services", start_services_sampler, _unique=True)
+    configdb.register_action("sampler_stop_services", stop_services_sampler, _unique=True)
 
     eventmanager.once(searchd.init_app, hargs=(app, filesdb, entitiesdb, profiler))
 
@@ -247,7 +284,22 @@ def create_app(config=None, debug=False):
 
     # Refresco de configuración
     eventmanager.once(configdb.pull)
-    eventmanager.interval(app.config["CONFIG_UPDATE_INTERVAL"], configdb.pull)
+    eventmanager.interval(app.config["CONFIG_UPDATE_INTERVAL"], configdb.poll)
+
+    # Índice de sitemaps, refrescado en un hilo propio de cada worker
+    sitemaps.init_app(app, filesdb)
+    eventmanager.once(sitemaps.start)
+
+    # Ficheros relacionados de la página de descarga
+    related_files.init_app(app)
+
+    # Páginas guardadas para los robots de búsqueda, con el token CSRF de cada petición
+    page_cache.init_app(app, profiler)
+    page_cache.add_fragment("csrf", csrf._get_token)
+    eventmanager.interval(app.config["PROFILER_FLUSH_INTERVAL"], page_cache.save_stats)
+
+    # Sincronización de contadores de peticiones, en un hilo propio de cada worker
+    eventmanager.once(ratelimiter.start)
 
     # downloader files
     downloader_files = app.config["DOWNLOADER_FILES"]
@@ -261,6 +313,9 @@ def create_app(config=None, debug=False):
     configdb.register_action("update_downloader", update_downloader_properties)
     local_cache["downloader_properties"] = get_downloader_properties(base_path, downloader_files)
 
+    # Notificación de cambios de configuración, con las acciones ya registradas, en cada worker
+    eventmanager.once(configdb.start_listener)
+
     # Unittesting
     unit.init_app(app)
 
@@ -285,8 +340,9 @@ def create_app(config=None, debug=False):
         # default values for g object
         init_g()
 
-        # comprueba limite de ratio de peticiones
-        check_rate_limit(g.search_bot)
+        # comprueba limite de ratio de peticiones, salvo al renovar páginas guardadas
+        if not request.environ.get(REFRESH_ENVIRON_KEY):
+            check_rate_limit(g.search_bot)
 
         # si el idioma de la URL es inválido, devuelve página no encontrada
         all_langs = current_app.config["ALL_LANGS"]
@@ -297,6 +353,11 @@ def create_app(config=None, debug=False):
         if g.lang!="en":
             add_translation_fallback("en")
 
+        # página guardada para los robots de búsqueda
+        cached = page_cache.get()
+        if cached is not None:
+            return cached
+
         # si hay que cambiar el idioma
         if request.args.get("setlang",None):
             session["lang"]=g.lang
@@ -323,6 +384,9 @@ def create_app(config=None, debug=False):
 
     @app.after_request
     def after_request(response):
+        # guarda la página para los robots de búsqueda, si se puede
+        response = page_cache.store(response)
+
         if request.user_agent.browser == "msie": response.headers["X-UA-Compatible"] = "IE=edge"
 
         if g.accept_cookies == "0":
@@ -341,6 +405,10 @@ def create_app(config=None, debug=False):
             logging.warn(ex)
             return make_response("", error_code)
 
+    # Precompila las plantillas, con filtros y extensiones ya registrados
+    if app.config["TEMPLATE_WARMUP"]:
+        warm_templates(app.jinja_env)
+
     return app
 
 def init_g():
@@ -353,6 +421,7 @@ def init_g():
 
     # caracteristicas del cliente
     g.full_browser=is_full_browser()
+    g.ios_device=is_ios_device()
     g.search_bot=is_search_bot()
 
     # peticiones en modo preproduccion
@@ -2,27 +2,20 @@
 from threading import Thread, Condition
 from time import time, sleep
 from .common import *
+from .shards import *
 from collections import deque
-import redis, logging, timeit
-
-INFINITY            = float('inf')
-
-PING_INTERVAL       = 10  # Segundos
-PING_SWITCH_STEPS   =  6  # Cantidad de pings desfavorables al servidor actual para cambiar de servidor
+from hashlib import md5
+from socket import gethostname
+from os import getpid
+import redis, logging
 
 ACTIVE_PART_TIMEOUT = 60
 ACTIVE_PART_LIST_LEN = 3
 ACTIVE_PART_INTERVAL = ACTIVE_PART_TIMEOUT/ACTIVE_PART_LIST_LEN
 BROWSE_MAX_REQUESTS = 32
 
-def safe_ping(conn):
-    try:
-        return timeit.timeit(conn.ping, number=1)
-    except:
-        return INFINITY
-
 class Sphinx(Thread):
-    EMPTY_STATS = {"cs":0, "s": False, "ct": None, "end": False, "total_sure": False, "li": [], "t":0, "w":500}
+    EMPTY_STATS = {"cs":0, "s": False, "ct": None, "end": False, "total_sure": False, "done": False, "li": [], "t":0, "w":500}
 
     def __init__(self, context, browser):
         Thread.__init__(self)
@@ -36,53 +29,47 @@ class Sphinx(Thread):
         self.context = context
         self.browser = browser
 
-        # Constantes de conexion
-        self.redis_conn = None
-        self.redis_index = -1
-        self.last_try = self.redis_confidence = 0
+        # particiones de la cache de busquedas
+        self.shards = []
+        self.ring = None
+
+        # fechas de ultima reindexacion de cada parte
+        self.last_reindex = {}
+
+        # contadores de publicaciones de busquedas y de avisos de resultados recibidos
+        self.publish_stats = {"sp_published":0, "sp_avoided":0, "sp_avoided_wakeups":0, "sp_notified":0, "sp_dropped":0}
 
     def init_app(self, app):
         # configuracion
         self.requests = LimitedDict(app.config["SPHINX_CLIENT_REQUESTS_CACHE_SIZE"], app.config["SPHINX_CLIENT_REQUESTS_CACHE_TIMEOUT"])
         self.ct_weights = app.config["SEARCH_CONTENT_TYPE_WEIGHTS"]
 
-        # conexiones a redis
-        redis_servers = app.config["SPHINX_REDIS_SERVER"]
-        self.redis_conns = [redis.StrictRedis(host=server[0], port=server[1], db=self.version) for server in redis_servers]
-        self.redis_conns_ps = [redis.StrictRedis(host=server[0], port=server[1], db=self.version).pubsub() for server in redis_servers]
+        # canal de respuesta propio de este proceso: los servicios solo avisan aqui de las peticiones hechas por este proceso
+        self.reply_id = md5("%s:%d:%f"%(gethostname(), getpid(), time())).hexdigest()[:12]
+        self.results_channel = RESULTS_CHANNEL+self.reply_id
+
+        # conexiones a redis: una particion por grupo de servidores alternativos
+        self.shards = [RedisShard(servers, self.version) for servers in get_shards_config(app.config)]
+        self.ring = HashRing(len(self.shards))
 
-        self.update_redis_connections()
+        self.update_redis_connections(True)
+
+    @property
+    def redis_conn(self):
+        '''
+        Conexion a la particion de control.
+        '''
+        return self.shards[CONTROL_SHARD].conn
+
+    def conn_for(self, request_id):
+        '''
+        Conexion a la particion de una peticion.
+        '''
+        return self.shards[self.ring.get(request_id)].conn
 
     def update_redis_connections(self, force=False):
-        try:
-            # evita ejecutar la funcion si no se ha cumplido el intervalo
-            if not force and time()-self.last_try<PING_INTERVAL:
-                return
-
-            # calcula pings a conexiones
-            self.last_try = time()
-            self.redis_pings = [safe_ping(conn) for conn in self.redis_conns]
-            ping, new_index = min((ping, index) for index, ping in enumerate(self.redis_pings))
-
-            # evalua confianza de la conexion actual
-            if self.redis_pings[self.redis_index]==INFINITY:    # conexión actual caída, se debe cambiar ya de conexion
-                self.redis_confidence = 0
-            elif new_index==self.redis_index:                   # mantiene confianza, esta conexion es la mejor
-                self.redis_confidence = PING_SWITCH_STEPS
-            elif new_index!=self.redis_index:                   # conexión alternativa mejor, disminuye la confianza
-                self.redis_confidence -= 1
-
-            # si ha perdido la confianza cambia de servidor
-            if self.redis_confidence<=0:
-                if self.redis_index == new_index: # si no hay alternativa, espera
-                    sleep(PING_INTERVAL/2)
-                else:
-                    self.redis_index = new_index
-                    self.redis_confidence = PING_SWITCH_STEPS
-                    self.redis_conn = self.redis_conns[self.redis_index]
-                    self.redis_conn_ps = self.redis_conns_ps[self.redis_index]
-        except BaseException as e:
-            logging.exception("Error updating redis connections.")
+        for shard in self.shards:
+            shard.update(force)
 
     def build_query(self, text, filters, limits, grouping, order):
         result = {"t":text, "f":filters, "l":limits, "g":(GROUPING_GROUP if grouping[0] else 0)|(GROUPING_NO_GROUP if grouping[1] else 0)}
@@ -100,10 +87,74 @@ class Sphinx(Thread):
         self.last_parts_request = deque([0]*ACTIVE_PART_LIST_LEN, ACTIVE_PART_LIST_LEN)
         self.last_parts_request.append(now)
         self.active_parts = {int(part):now for part in initial_parts}
+        self.known_parts = set(self.active_parts)
 
         # inicia el thread
         self.start()
 
+    def update_last_reindex(self):
+        '''
+        Averigua cuando se realizó la última reindexación de cada parte conocida,
+        aunque no esté activa. Las partes sin fecha no aparecen en el diccionario.
+        '''
+        parts = list(self.known_parts)
+        if parts:
+            dates = self.redis_conn.mget([CONTROL_KEY+"lr_%d"%part for part in parts])
+            self.last_reindex = {part:float(date) for part, date in zip(parts, dates) if date}
+
+    def get_service_stats(self, parts=None, wait=0.2):
+        '''
+        Pide a los servicios de busqueda que exporten sus metricas y las devuelve.
+
+        @type parts: iterable o None
+        @param parts: partes a consultar, por defecto las activas
+
+        @type wait: float
+        @param wait: segundos que se espera a que los servicios respondan
+        '''
+        parts = list(parts or self.active_parts.keys())
+        pipe = self.redis_conn.pipeline()
+        for part in parts:
+            pipe.publish(CONTROL_CHANNEL+chr(part), "st")
+        pipe.execute()
+        sleep(wait)
+        data = self.redis_conn.mget([CONTROL_KEY+"m_%d"%part for part in parts])
+        return {part:parse_data(value) for part, value in zip(parts, data) if value}
+
+    def start_service_sampler(self, parts=None, stop=False):
+        '''
+        Pide a los servicios de busqueda que empiecen, o terminen, a tomar
+        muestras de sus pilas. Cada servicio guarda su informe al terminar.
+
+        @type parts: iterable o None
+        @param parts: partes a muestrear, por defecto las activas
+
+        @type stop: bool
+        @param stop: termina el muestreo en lugar de empezarlo
+        '''
+        pipe = self.redis_conn.pipeline()
+        for part in parts or self.active_parts.keys():
+            pipe.publish(CONTROL_CHANNEL+chr(part), "pe" if stop else "ps")
+        pipe.execute()
+
+    def get_service_sampler_reports(self, parts=None):
+        '''
+        Obtiene los informes del ultimo muestreo de cada servicio de busqueda.
+
+        @type parts: iterable o None
+        @param parts: partes a consultar, por defecto las activas
+        '''
+        parts = list(parts or self.active_parts.keys())
+        data = self.redis_conn.mget([CONTROL_KEY+"ps_%d"%part for part in parts])
+        return {part:parse_data(value) for part, value in zip(parts, data) if value}
+
+    def pop_publish_stats(self):
+        '''
+        Devuelve y reinicia los contadores de publicaciones de busquedas.
+        '''
+        stats, self.publish_stats = self.publish_stats, {"sp_published":0, "sp_avoided":0, "sp_avoided_wakeups":0, "sp_notified":0, "sp_dropped":0}
+        return stats
+
     def update_blocked_sources(self, blocked_sources):
         try:
             self.redis_conn.set(CONTROL_KEY+"bs", format_data(blocked_sources))
@@ -113,34 +164,72 @@ class Sphinx(Thread):
             self.update_redis_connections(True)
 
     def run(self):
+        # escucha los avisos de cada particion en su propio thread, la de control en este
+        for index in xrange(len(self.shards)):
+            if index!=CONTROL_SHARD:
+                listener = Thread(target=self.listen, args=(index,))
+                listener.daemon = True
+                listener.start()
+        self.listen(CONTROL_SHARD)
+
+    def listen(self, index):
+        '''
+        Recibe los avisos de resultados de una particion y, en la de control, los avisos de reindexado.
+        '''
+        shard = self.shards[index]
         while True:
             try:
-                # se suscribe al canal de resultados
-                self.redis_conn_ps.subscribe(RESULTS_CHANNEL)
+                # se suscribe al canal de resultados propio y a los de control de las partes
+                pubsub = shard.pubsub
+                pubsub.subscribe(self.results_channel)
+                if index==CONTROL_SHARD:
+                    pubsub.psubscribe(CONTROL_CHANNEL+"?")
+                    self.update_last_reindex()
+
+                for msg in pubsub.listen():
+                    # limpia las peticiones caducadas fuera de las peticiones web, al menos con cada ping de los servicios
+                    if index==CONTROL_SHARD:
+                        self.requests.cleanup()
+
+                    # avisos de reindexado y pings de los servicios, que indican que la parte sigue viva
+                    if msg["type"]=="pmessage":
+                        if msg["data"]=="lr":
+                            self.update_last_reindex()
+                        elif msg["data"]=="pn":
+                            self._log_part_response(ord(msg["channel"][len(CONTROL_CHANNEL)]))
+                        continue
 
-                for msg in self.redis_conn_ps.listen():
                     if msg["type"]!="message" or msg["data"]=="pn":
                         continue
 
+                    # descarta los avisos de peticiones que ya nadie espera sin decodificar el mensaje
+                    request = self.requests.get(peek_request_id(msg["data"]))
+                    if request is None:
+                        self.publish_stats["sp_dropped"] += 1
+                        continue
+
                     # recibe notificaciones de resultados principales obtenidos y avisa a quienes esperan
                     request_id, server, info = parse_data(msg["data"])
                     server = ord(server)
+                    self.publish_stats["sp_notified"] += 1
 
                     # loguea que ha recibido información de esta parte
                     self._log_part_response(server)
 
                     # avisa de las novedades
-                    exists, request = self._get_request_info(request_id)
                     with request[0]:
                         if info!=None:
                             request[2].append(info)
                         request[1].add(server)
                         request[0].notifyAll()
 
-                    self.update_redis_connections()
+                    # si la particion cambia de servidor, se suscribe en el nuevo
+                    if shard.update():
+                        pubsub.close()
+                        break
             except redis.ConnectionError as e:
-                logging.warning("Redis connection lost.")
-                self.update_redis_connections(True)
+                logging.warning("Redis connection lost on shard %d."%index)
+                shard.update(True)
 
     def _log_parts_request(self):
         '''
@@ -164,19 +253,15 @@ class Sphinx(Thread):
         Loguea que ha recibido información de esta parte.
         '''
         self.active_parts[part]=self.last_parts_request[-1]
+        if part not in self.known_parts:
+            self.known_parts.add(part)
+            self.update_last_reindex()
 
     def _get_request_info(self, request_id):
         '''
         Obtiene información de la peticion o la crea si no existe.
         '''
-        # limpieza de cache antes de obtener o asignar peticiones
-        self.requests.cleanup()
-
-        if request_id in self.requests:
-            return True, self.requests[request_id]
-        else:
-            new_request = self.requests[request_id] = (Condition(), set(), [])
-            return False, new_request
+        return self.requests.get_or_set(request_id, (Condition(), set(), []))
 
     def get_id_server_from_search(self, bin_file_id, search_text, timeout):
         '''
@@ -186,7 +271,8 @@ class Sphinx(Thread):
         request_id = LOCATION_KEY+bin_file_id
 
         # mira si se ha calculado antes
-        parts = self.redis_conn.hgetall(request_id)
+        redis_conn = self.conn_for(request_id)
+        parts = redis_conn.hgetall(request_id)
         if parts:
             try:
                 return (str(ord(server)) for server, has_it in parts.iteritems() if has_it=="H").next()
@@ -195,14 +281,18 @@ class Sphinx(Thread):
                 if not "P" in parts.itervalues():
                     return None # no quedan servidores pendientes por mirar
 
-        # envia la peticion a los procesos de busqueda si no estaba pedida
+        # envia la peticion a los procesos de busqueda si no estaba pedida, o si se pidió hace más del tiempo
+        # de espera y ninguna parte la está atendiendo: la petición se ha perdido (descartada por los
+        # servicios o al reconectar pubsub) y la entrada, que se renueva con cada lectura, no caduca
         exists, request = self._get_request_info(request_id)
-        if not exists:
+        now = time()
+        if not exists or not request[2] and not "P" in parts.itervalues() and now-self.requests.get(request_id+"t", 0)>timeout/1000.:
+            self.requests[request_id+"t"] = now
             self._log_parts_request()
-            self.redis_conn.publish(EXECUTE_CHANNEL, format_data((request_id, search_text)))
+            redis_conn.publish(EXECUTE_CHANNEL, format_data((request_id, search_text, False, self.reply_id, now)))
 
         # espera resultados
-        with request[0]:
+        with self.requests.waiting(request_id), request[0]:
             if not request[2]:
                 request[0].wait(timeout/1000.)
 
@@ -216,7 +306,7 @@ class Sphinx(Thread):
         results = {"version":{}, "time":{}, "tries":{}, "warning":{}, "date":{}, "main":{}, "sg":{}}
 
         query_id = QUERY_KEY+hash_dict(query)
-        search_info = self.redis_conn.hgetall(query_id)
+        search_info = self.conn_for(query_id).hgetall(query_id)
         for key, value in search_info.iteritems():
             if key == INFO_KEY:
                 results["canonical"] = parse_data(value)
@@ -247,7 +337,7 @@ class Sphinx(Thread):
         NOTA: La búsqueda debe haberse realizado anteriormente para obtener resultados.
         '''
         query_id = QUERY_KEY+hash_dict(query)
-        search_info = self.redis_conn.hgetall(query_id)
+        search_info = self.conn_for(query_id).hgetall(query_id)
         results_count = {}
         for key, value in search_info.iteritems():
             if key[0]==PART_KEY:
@@ -266,40 +356,85 @@ class Sphinx(Thread):
 
         return results_count
 
-    def start_search(self, query, requests=None):
+    def start_search(self, query, requests=None, bot=False):
         # identificador unico de la peticion
         request_id = QUERY_KEY+hash_dict(query)
+
+        # los robots se marcan para que los servicios los atiendan con menor prioridad,
+        # se indica el canal por el que se quieren recibir los avisos y la fecha de envio,
+        # para que los servicios descarten las peticiones que nadie espera ya.
+        # Los servicios anteriores solo entienden (request_id, info): deben actualizarse antes que las webs.
+        message = lambda info: format_data((request_id, info, bot, self.reply_id, time()))
+        redis_conn = self.conn_for(request_id)
         if requests:
             must_execute = False
-            pipe = self.redis_conn.pipeline()
+            pipe = redis_conn.pipeline()
             for server, subgroups in requests.iteritems():
                 # evita pedir los mismos subgrupos varias veces seguidas
                 subgroup_request_id = request_id+server+hash_dict(subgroups)
                 if subgroup_request_id in self.requests:
                      continue
                 must_execute = self.requests[subgroup_request_id] = True
-                pipe = pipe.publish(EXECUTE_CHANNEL+chr(ord(server)), format_data((request_id, (query, subgroups))))
+                pipe = pipe.publish(EXECUTE_CHANNEL+chr(ord(server)), message((query, subgroups)))
             if must_execute:
                 pipe.execute()
         else:
             # crea entrada para esperar resultados
             exists, request = self._get_request_info(request_id)
 
-            # envia la busqueda a los procesos de busqueda
+            # comprueba qué partes tienen resultados validos en cache: existen, no tienen avisos
+            # y son posteriores al ultimo reindexado conocido. Se comprueban todas las partes conocidas,
+            # no solo las activas, para volver a preguntar a las que se hayan dado por caidas.
+            parts = list(self.known_parts)
+            fresh = set()
+            if parts:
+                for part, part_info in zip(parts, redis_conn.hmget(request_id, *[PART_KEY+chr(part) for part in parts])):
+                    if part_info and part in self.last_reindex:
+                        part_info = parse_data(part_info)
+                        if not part_info[1] and part_info[0]>=self.last_reindex[part]:
+                            fresh.add(part)
+
+            # las partes con datos validos responderían sin buscar: se dan por respondidas y por activas
+            for part in fresh:
+                self._log_part_response(part)
+
+            # a las demás se les vuelve a preguntar, así que sus respuestas anteriores dejan de contar:
+            # la entrada de una busqueda frecuente no caduca y se reutiliza entre reindexados
+            with request[0]:
+                request[1].difference_update(part for part in parts if part not in fresh)
+                if fresh:
+                    request[1].update(fresh)
+                    request[0].notifyAll()
+
+            # envia la busqueda a los procesos de busqueda que la necesiten
             self._log_parts_request()
-            self.redis_conn.publish(EXECUTE_CHANNEL, format_data((request_id, (query, None))))
+            if not fresh:
+                redis_conn.publish(EXECUTE_CHANNEL, message((query, None)))
+                self.publish_stats["sp_published"] += 1
+            elif len(fresh)<len(parts):
+                pipe = redis_conn.pipeline()
+                for part in parts:
+                    if not part in fresh:
+                        pipe.publish(EXECUTE_CHANNEL+chr(part), message((query, None)))
+                pipe.execute()
+                self.publish_stats["sp_published"] += 1
+                self.publish_stats["sp_avoided_wakeups"] += len(fresh)
+            else:
+                self.publish_stats["sp_avoided"] += 1
+                self.publish_stats["sp_avoided_wakeups"] += len(fresh)
 
-    def get_results(self, query, timeouts, last_items, skip, min_results, max_results, hard_limit, extra_browse=None, weight_processor=None, tree_visitor=None):
+    def get_results(self, query, timeouts, last_items, skip, min_results, max_results, hard_limit, extra_browse=None, weight_processor=None, tree_visitor=None, bot=False):
         '''
         Obtiene los resultados de la busqueda en bruto
         '''
         # identificador unico de la busqueda
         request_id = QUERY_KEY+hash_dict(query)
 
-        # espera que lleguen resultados
-        if request_id in self.requests:
-            request = self.requests[request_id]
-            with request[0]:
+        # espera que lleguen resultados y anota si han respondido todas las partes
+        done = True
+        request = self.requests.get(request_id)
+        if request is not None:
+            with self.requests.waiting(request_id), request[0]:
                 # espera si no ha recibido ninguna respuesta
                 if len(request[1])==0:
                     request[0].wait(timeouts[0])
@@ -307,9 +442,11 @@ class Sphinx(Thread):
                 # espera un poco mas si no ha recibido todas las respuestas
                 if len(request[1])<len(self.active_parts):
                     request[0].wait(timeouts[1])
+                done = len(request[1])>=len(self.active_parts)
 
         # obtiene los datos del cache
-        results = self.redis_conn.hgetall(request_id)
+        redis_conn = self.conn_for(request_id)
+        results = redis_conn.hgetall(request_id)
 
         if not results:
             return [], Sphinx.EMPTY_STATS
@@ -318,7 +455,7 @@ class Sphinx(Thread):
         browser = self.browser(self.context, results, BROWSE_MAX_REQUESTS, self.ct_weights, weight_processor, tree_visitor)
 
         # añade una versión si hay cambios en la lista de versiones y obtiene la lista actualizada
-        ignore, raw_versions = self.redis_conn.pipeline().zadd(request_id+VERSION_KEY, sum(browser.versions.itervalues()), format_data(sorted(browser.versions.iteritems()))).zrange(request_id+VERSION_KEY, 0, -1).execute()
+        ignore, raw_versions = redis_conn.pipeline().zadd(request_id+VERSION_KEY, sum(browser.versions.itervalues()), format_data(sorted(browser.versions.iteritems()))).zrange(request_id+VERSION_KEY, 0, -1).execute()
 
         # prepara la lista de versiones para usarla
         all_versions = {}
@@ -389,11 +526,153 @@ class Sphinx(Thread):
             non_extra_number = number
 
         if not browser.sure: # vuelve a pedir buscar
-            self.start_search(query)
+            self.start_search(query, bot=bot)
         elif browser.requests: # pide mas resultados
             subgroup_query = query.copy()
             subgroup_query["l"] = (0, min(max(10, min_results),50), 10000, 2000000)
-            self.start_search(subgroup_query, requests=browser.requests)
+            self.start_search(subgroup_query, requests=browser.requests, bot=bot)
 
         # devuelve resultados e informacion de la busqueda
-        return to_return, {"cs": browser.total, "s": browser.sure, "ct": parse_data(results[INFO_KEY]), "end": not browser.requests and (non_extra_number>=browser.total-1 or non_extra_number>hard_limit), "total_sure": browser.fetch_more==BROWSE_MAX_REQUESTS, "li": new_versions, "t":0, "w":500 if browser.requests else 100}
+        return to_return, {"cs": browser.total, "s": browser.sure, "ct": parse_data(results[INFO_KEY]), "end": not browser.requests and (non_extra_number>=browser.total-1 or non_extra_number>hard_limit), "total_sure": browser.fetch_more==BROWSE_MAX_REQUESTS, "done": done, "li": new_versions, "t":0, "w":500 if browser.requests else 100}
+
+if __name__ == "__main__":
+    # Coste por proceso web de recibir los avisos de resultados, segun el
+    # numero de procesos web, con avisos por el canal comun o por el canal de
+    # respuesta de cada proceso. Cada proceso recibe el mismo numero de avisos
+    # propios por segundo, de modo que el volumen total crece con los procesos.
+    # Un servidor minimo con el protocolo de redis hace de broker de pubsub.
+    # Uso: python -m sphinxservice.client [--processes 1 2 4 8] [--rate 300] [--duration 5]
+    import argparse, os, SocketServer
+    from threading import Lock
+    from multiprocessing import Process, Queue, Event
+
+    class Broker(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+        daemon_threads = allow_reuse_address = True
+
+        def __init__(self):
+            SocketServer.TCPServer.__init__(self, ("127.0.0.1", 0), BrokerHandler)
+            self.lock = Lock()
+            self.channels = {}
+            self.patterns = {}
+
+        def handle_error(self, request, client_address):
+            pass # conexiones cerradas por los procesos al terminar
+
+    class BrokerHandler(SocketServer.StreamRequestHandler):
+        def send(self, *items):
+            data = "*%d\r\n"%len(items)+"".join(":%d\r\n"%item if isinstance(item, int) else "$%d\r\n%s\r\n"%(len(item), item) for item in items)
+            with self.write_lock:
+                self.wfile.write(data)
+                self.wfile.flush()
+
+        def handle(self):
+            self.write_lock = Lock()
+            server = self.server
+            try:
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        break
+                    args = []
+                    for i in xrange(int(line[1:])):
+                        length = int(self.rfile.readline()[1:])
+                        args.append(self.rfile.read(length+2)[:-2])
+                    command = args[0].upper()
+                    if command in ("SUBSCRIBE", "PSUBSCRIBE"):
+                        with server.lock:
+                            for name in args[1:]:
+                                (server.channels if command=="SUBSCRIBE" else server.patterns).setdefault(name, []).append(self)
+                                self.send(command.lower(), name, 1)
+                    elif command=="PUBLISH":
+                        with server.lock:
+                            subscribers = list(server.channels.get(args[1], ()))
+                        for subscriber in subscribers:
+                            subscriber.send("message", args[1], args[2])
+                        with self.write_lock:
+                            self.wfile.write(":%d\r\n"%len(subscribers))
+                    elif command=="PING":
+                        with self.write_lock:
+                            self.wfile.write("+PONG\r\n")
+                    elif command=="MGET":
+                        with self.write_lock:
+                            self.wfile.write("*%d\r\n"%(len(args)-1)+"$-1\r\n"*(len(args)-1))
+                    else:
+                        with self.write_lock:
+                            self.wfile.write("+OK\r\n")
+                    self.wfile.flush()
+            except IOError:
+                pass
+            finally:
+                with server.lock:
+                    for subscribers in server.channels.values()+server.patterns.values():
+                        if self in subscribers:
+                            subscribers.remove(self)
+
+    class FakeApp:
+        def __init__(self, port):
+            self.config = {"SPHINX_CLIENT_REQUESTS_CACHE_SIZE":10000, "SPHINX_CLIENT_REQUESTS_CACHE_TIMEOUT":300,
+                           "SEARCH_CONTENT_TYPE_WEIGHTS":{}, "SPHINX_REDIS_SERVER":(("127.0.0.1", port),)}
+
+    def web_process(number, port, requests_count, targeted, replies, start, stop, results):
+        client = Sphinx(None, None)
+        client.init_app(FakeApp(port))
+        if not targeted:
+            client.results_channel = RESULTS_CHANNEL
+        # peticiones de este proceso que esperan resultados
+        for i in xrange(requests_count):
+            client._get_request_info(QUERY_KEY+md5("%d %d"%(number, i)).digest())
+        client.start_client([1])
+        sleep(0.5)
+        replies.put((number, client.reply_id))
+        start.wait()
+        client.pop_publish_stats()
+        cpu = os.times()
+        stop.wait()
+        cpu = [end-begin for begin, end in zip(cpu, os.times())]
+        results.put((number, cpu[0]+cpu[1], client.pop_publish_stats()))
+
+    parser = argparse.ArgumentParser(description="Results notifications cost per web process.")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8], help="Numbers of web processes.")
+    parser.add_argument("--rate", type=int, default=300, help="Notifications per second for each web process.")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds of notifications.")
+    parser.add_argument("--requests", type=int, default=200, help="Pending requests in each web process.")
+    params = parser.parse_args()
+
+    broker = Broker()
+    Thread(target=broker.serve_forever).start()
+    port = broker.server_address[1]
+
+    print "%-10s %9s %14s %10s %10s %18s"%("mode", "processes", "notifications", "received", "dropped", "cpu per process")
+    for targeted in (False, True):
+        for processes in params.processes:
+            replies, results, start, stop = Queue(), Queue(), Event(), Event()
+            workers = [Process(target=web_process, args=(number, port, params.requests, targeted, replies, start, stop, results)) for number in xrange(processes)]
+            for worker in workers:
+                worker.start()
+            reply_ids = dict(replies.get() for worker in workers)
+
+            # un servicio de busqueda avisa de resultados de peticiones de todos los procesos
+            publisher = redis.StrictRedis(host="127.0.0.1", port=port)
+            start.set()
+            sent = 0
+            begin = time()
+            while time()-begin<params.duration:
+                pipe = publisher.pipeline(transaction=False)
+                for number, reply_id in reply_ids.iteritems():
+                    for i in xrange(params.rate/10):
+                        request_id = QUERY_KEY+md5("%d %d"%(number, (sent+i)%params.requests)).digest()
+                        pipe.publish(RESULTS_CHANNEL+reply_id if targeted else RESULTS_CHANNEL, format_data((request_id, "\x01", None)))
+                sent += params.rate/10
+                pipe.execute()
+                sleep(max(0, begin+sent/float(params.rate)-time()))
+            sleep(0.5)
+            stop.set()
+            publisher.connection_pool.disconnect()
+
+            stats = [results.get() for worker in workers]
+            for worker in workers:
+                worker.join()
+            print "%-10s %9d %14d %10d %10d %15.1f ms"%("targeted" if targeted else "broadcast", processes, sent*processes,
+                    sum(s[2]["sp_notified"] for s in stats)/processes, sum(s[2]["sp_dropped"] for s in stats)/processes,
+                    sum(s[1] for s in stats)/processes*1000)
+    broker.shutdown()
@@ -2,15 +2,16 @@
 from hashlib import md5
 from msgpack import unpackb as parse_data, packb as format_data
 from time import time
-from collections import deque
+from collections import OrderedDict
+from contextlib import contextmanager
 from threading import Lock
 import re
 
 __all__ = ["WORKER_VERSION", "EXECUTE_CHANNEL","RESULTS_CHANNEL","CONTROL_CHANNEL", "UPDATE_CHANNEL",
            "GROUPING_GROUP", "GROUPING_NO_GROUP",
            "CONTROL_KEY", "LOCATION_KEY", "QUERY_KEY",
-           "ACTIVE_KEY", "INFO_KEY", "LOCATION_KEY", "PART_KEY", "PART_SG_KEY", "VERSION_KEY",
-           "hash_dict", "parse_data", "format_data", "LimitedDict"]
+           "ACTIVE_KEY", "INFO_KEY", "LOCATION_KEY", "PART_KEY", "PART_SG_KEY", "VERSION_KEY", "WAITERS_KEY",
+           "hash_dict", "parse_data", "format_data", "peek_request_id", "LimitedDict"]
 
 
 # constantes
@@ -35,6 +36,7 @@ LOCATION_KEY = "l"
 PART_KEY = "p"
 PART_SG_KEY = "s"
 VERSION_KEY = "v"
+WAITERS_KEY = "w"
 
 INVARIANT_QUERY_KEYS = set(["l","g","mt"])
 
@@ -42,62 +44,321 @@ def hash_dict(adict):
     data = "\x00".join(key+"\x01"+format_data(value) for key,value in sorted(adict.iteritems()) if key not in INVARIANT_QUERY_KEYS)
     return md5(data).digest()
 
-class LimitedDict(dict):
+def peek_request_id(data):
+    '''
+    Obtiene el identificador de peticion de una notificacion de resultados
+    (request_id, part, info) sin decodificar el resto del mensaje.
+    '''
+    # array de msgpack de hasta 15 elementos, seguido de una cadena de tamaño fijo o de 8 o 16 bits
+    if data and "\x90"<=data[0]<="\x9f":
+        header = ord(data[1])
+        if 0xa0<=header<=0xbf:
+            return data[2:2+(header&0x1f)]
+        elif header==0xd9:
+            return data[3:3+ord(data[2])]
+        elif header==0xda:
+            return data[4:4+(ord(data[2])<<8|ord(data[3]))]
+    return parse_data(data)[0]
+
+class LimitedDict(object):
+    '''
+    Diccionario limitado en tamaño y en tiempo, ordenado por ultimo uso.
+
+    Leer o asignar una clave la pasa al final del orden y renueva su
+    caducidad. Al superar el tamaño maximo se descartan las claves usadas
+    hace mas tiempo, y cleanup() descarta las caducadas recorriendo el orden
+    desde el principio, por lo que su coste por clave es constante.
+
+    Las claves marcadas con pin() no se descartan, ni por tamaño ni por
+    tiempo, hasta que se llama a unpin() tantas veces como a pin(): sirve
+    para no perder las peticiones que tienen alguien esperando sus avisos.
+    '''
     def __init__(self, max_size=None, timeout=None, cleanup_min_interval=0.1, *args, **kwds):
-        dict.__init__(self, *args, **kwds)
-        self.__max_size = max_size
-        self.__timeout = timeout
-        now = time()
+        self.max_size = max_size
+        self.timeout = timeout
 
-        # control de datos
+        # control de datos: clave -> [valor, fecha de ultimo uso], en orden de uso
         self.access = Lock()
-        self.__order = deque(((key,now) for key in dict.iterkeys(self)), self.__max_size)
-        self.__full = self.__max_size and len(self.__order)==self.__max_size
+        self.__data = OrderedDict()
+        self.__pinned = {}
+        now = time()
+        for key, value in dict(*args, **kwds).iteritems():
+            self.__data[key] = [value, now]
+
+        # contadores de claves descartadas
+        self.evicted = self.expired = 0
 
         # control de limpieza
         self.__last_cleanup = now
         self.__cleanup_min_interval = cleanup_min_interval
-        self.cleanup()
-
-    def cleanup(self):
-        # claves expiradas
-        if self.__timeout and time()-self.__last_cleanup>self.__cleanup_min_interval:
-            with self.access:
-                self.__last_cleanup = now = time()
-                expired_now = now-self.__timeout
-                while self.__order and self.__order[0][1]<expired_now:
-                    dict.__delitem__(self, self.__order[0][0])
-                    self.__order.popleft()
-                    self.__full = False
+        self.__evict()
+
+    def __expired(self, key, entry, now):
+        return self.timeout and entry[1]<now-self.timeout and key not in self.__pinned
+
+    def __evict(self):
+        '''
+        Descarta las claves usadas hace mas tiempo hasta volver al tamaño maximo.
+        Las claves marcadas pasan al final como recien usadas, asi que cada una se salta como mucho una vez.
+        '''
+        if not self.max_size:
+            return
+        skipped = 0
+        while len(self.__data)>self.max_size and skipped<=len(self.__pinned):
+            key, entry = self.__data.popitem(False)
+            if key in self.__pinned:
+                entry[1] = time()
+                self.__data[key] = entry
+                skipped += 1
+            else:
+                self.evicted += 1
+
+    def cleanup(self, force=False):
+        '''
+        Descarta las claves caducadas.
+
+        @type force: bool
+        @param force: limpia aunque no haya pasado el intervalo minimo desde la ultima limpieza
+        '''
+        if not self.timeout or not force and time()-self.__last_cleanup<=self.__cleanup_min_interval:
+            return
+
+        with self.access:
+            self.__last_cleanup = now = time()
+            expired_now = now-self.timeout
+            while self.__data:
+                key = next(iter(self.__data))
+                entry = self.__data[key]
+                if entry[1]>=expired_now:
+                    break
+                del self.__data[key]
+                if key in self.__pinned:
+                    # sigue en uso: pasa al final como si se acabase de usar
+                    entry[1] = now
+                    self.__data[key] = entry
+                else:
+                    self.expired += 1
+
+    def pin(self, key):
+        '''
+        Evita que se descarte la clave mientras haya alguien esperandola.
+        '''
+        with self.access:
+            self.__pinned[key] = self.__pinned.get(key, 0)+1
+
+    def unpin(self, key):
+        '''
+        Deshace una llamada a pin.
+        '''
+        with self.access:
+            count = self.__pinned.get(key, 0)
+            if count>1:
+                self.__pinned[key] = count-1
+            elif count:
+                del self.__pinned[key]
+                self.__evict()
+
+    @contextmanager
+    def waiting(self, key):
+        '''
+        Marca la clave mientras se ejecuta el bloque.
+        '''
+        self.pin(key)
+        try:
+            yield
+        finally:
+            self.unpin(key)
+
+    def __getitem__(self, key):
+        with self.access:
+            now = time()
+            entry = self.__data.pop(key)
+            if self.__expired(key, entry, now):
+                self.expired += 1
+                raise KeyError(key)
+            entry[1] = now
+            self.__data[key] = entry
+            return entry[0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_or_set(self, key, default=None):
+        '''
+        Obtiene el valor de la clave o le asigna el valor por defecto, en una sola operacion.
+
+        @rtype tuple
+        @return si la clave existia y su valor
+        '''
+        with self.access:
+            now = time()
+            entry = self.__data.pop(key, None)
+            exists = entry is not None and not self.__expired(key, entry, now)
+            if exists:
+                entry[1] = now
+            else:
+                entry = [default, now]
+            self.__data[key] = entry
+            if not exists:
+                self.__evict()
+            return exists, entry[0]
 
     def __setitem__(self, key, value):
         with self.access:
-            if not key in self:
-                if self.__full:
-                    dict.__delitem__(self, self.__order[0][0])
-                elif self.__max_size and len(self.__order)+1==self.__max_size:
-                    self.__full = True
-                self.__order.append((key, time()))
-            dict.__setitem__(self, key, value)
+            self.__data.pop(key, None)
+            self.__data[key] = [value, time()]
+            self.__evict()
 
     def __delitem__(self, key):
-        raise NotImplemented("You can't delete from this dictionary.")
+        with self.access:
+            del self.__data[key]
+
+    def pop(self, key, *default):
+        with self.access:
+            entry = self.__data.pop(key, None)
+            if entry is None:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            return entry[0]
+
+    def __contains__(self, key):
+        entry = self.__data.get(key)
+        return entry is not None and not self.__expired(key, entry, time())
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __iter__(self):
+        return iter(self.__data.keys())
+
+    def keys(self):
+        return self.__data.keys()
+
+    def items(self):
+        return [(key, entry[0]) for key, entry in self.__data.items()]
+
+    def __repr__(self):
+        return "LimitedDict(%r)" % self.items()
 
 if __name__ == "__main__":
+    # Pruebas de LimitedDict: orden por ultimo uso, caducidad, borrado,
+    # coste constante por operacion y peticiones con alguien esperando
+    # durante rafagas de peticiones nuevas.
+    # Uso: python -m sphinxservice.common
+    from threading import Thread, Condition, Event
     from time import sleep
+    import random
+
+    def check(label, condition):
+        print "%-68s %s" % (label, "ok" if condition else "FAILED")
+        if not condition:
+            raise SystemExit(1)
 
-    a=LimitedDict(5, timeout=1)
+    # orden por ultimo uso
+    a = LimitedDict(5)
+    for i in xrange(5):
+        a[i] = i
+    a[0], a.get(1)
+    a[5] = a[6] = 5
+    check("size limit discards the least recently used keys", sorted(a.keys())==[0, 1, 4, 5, 6])
+    a[4] = "again"
+    a[7] = 7
+    check("assigning a key again refreshes it", 4 in a and 0 not in a)
+    del a[4]
+    check("keys can be deleted", 4 not in a and len(a)==4 and a.pop(5)==5 and a.pop(5, None) is None)
+
+    # caducidad por ultimo uso, no por fecha de insercion
+    a = LimitedDict(100, timeout=0.3)
     for i in xrange(10):
-        a[i]="tam"
-    a.cleanup()
-    print "5 maximo", repr(a)
-    for i in xrange(3):
-        a["n"+str(i)]="caducan"
+        a[i] = i
     sleep(0.2)
-    for i in xrange(3):
-        a["c"+str(i)]="no caducan"
+    a[0], a.get(1)
+    a[2] = "again"
+    sleep(0.15)
     a.cleanup()
-    print "0.2 segundo", repr(a)
-    sleep(0.9)
+    check("expiry counts from the last use", sorted(a.keys())==[0, 1, 2] and a.expired==7)
+    sleep(0.2)
+    check("expired keys are not returned before cleanup", 0 not in a and a.get(1) is None)
     a.cleanup()
-    print "0.9 segundo", repr(a)
+    check("cleanup discards the rest", len(a)==0)
+
+    # coste constante: el tiempo por operacion no depende del tamaño
+    timings = []
+    for size in (1000, 100000):
+        a = LimitedDict(size, timeout=3600)
+        start = time()
+        for i in xrange(200000):
+            a[i] = i
+            a.get(i-size/2)
+        a.cleanup(True)
+        timings.append((time()-start)/200000)
+    check("cost per operation with 1k and 100k keys: %.2f and %.2f us" % (timings[0]*1e6, timings[1]*1e6),
+          timings[1]<timings[0]*3)
+
+    # esperas durante rafagas: como en el cliente de busquedas, cada peticion
+    # guarda (Condition, partes, info), quien la consulta espera en la condicion
+    # marcando la peticion y el thread de avisos la busca para despertarle
+    SIZE, WAITERS, BURST_THREADS, BURST = 200, 50, 4, 20000
+    a = LimitedDict(SIZE, timeout=0.5, cleanup_min_interval=0.01)
+    rnd = random.Random(0)
+    waiting = Event()
+    stop = Event()
+    woken, timed_out, max_len = [], [], [0]
+
+    def waiter(number):
+        exists, request = a.get_or_set("w%d"%number, (Condition(), set(), []))
+        with a.waiting("w%d"%number):
+            with request[0]:
+                waiting.set()
+                if not request[1]:
+                    request[0].wait(10)
+                (woken if request[1] else timed_out).append(number)
+
+    def burst():
+        for i in xrange(BURST):
+            a.get_or_set("b%d"%rnd.randint(0, BURST), (Condition(), set(), []))
+            max_len[0] = max(max_len[0], len(a))
+
+    def cleaner():
+        while not stop.is_set():
+            a.cleanup()
+            sleep(0.01)
+
+    threads = [Thread(target=waiter, args=(number,)) for number in xrange(WAITERS)]
+    for thread in threads:
+        thread.start()
+    waiting.wait()
+    sleep(0.1)
+    cleaning = Thread(target=cleaner)
+    cleaning.start()
+    bursts = [Thread(target=burst) for i in xrange(BURST_THREADS)]
+    for thread in bursts:
+        thread.start()
+    for thread in bursts:
+        thread.join()
+    sleep(0.8) # mas que la caducidad de las peticiones
+
+    # avisos de resultados para todas las peticiones con alguien esperando
+    missing = 0
+    for number in xrange(WAITERS):
+        request = a.get("w%d"%number)
+        if request is None:
+            missing += 1
+            continue
+        with request[0]:
+            request[1].add(0)
+            request[0].notifyAll()
+    for thread in threads:
+        thread.join()
+    check("waited requests survive %d inserts and expiry (%d lost)" % (BURST_THREADS*BURST, missing),
+          missing==0 and len(woken)==WAITERS and not timed_out)
+    check("size stays bounded (max %d, limit %d + %d waiting)" % (max_len[0], SIZE, WAITERS),
+          max_len[0]<=SIZE+WAITERS)
+    sleep(0.6)
+    stop.set()
+    cleaning.join()
+    check("requests expire once nobody waits for them (%d left)" % len(a), len(a)==0)
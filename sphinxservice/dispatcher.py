@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from gevent import spawn, sleep
+from gevent.event import Event
+from collections import deque
+from time import time
+
+__all__ = ["Dispatcher", "LANE_SEARCH", "LANE_LOCATION", "LANE_SUBGROUPS", "LANE_BOTS", "LANE_NAMES"]
+
+# colas de peticiones por orden de prioridad
+LANE_SEARCH = 0      # busquedas de usuarios
+LANE_LOCATION = 1    # servidor de un fichero (pagina de descarga)
+LANE_SUBGROUPS = 2   # paginas de subgrupos
+LANE_BOTS = 3        # busquedas de robots
+LANE_NAMES = ("search", "location", "subgroups", "bots")
+
+# tamaño maximo de cada cola y edad maxima de sus peticiones, segun lo que espera la web
+DEFAULT_LANES = {LANE_SEARCH: (200, 3.),
+                 LANE_LOCATION: (100, 1.),
+                 LANE_SUBGROUPS: (200, 3.),
+                 LANE_BOTS: (100, 10.)}
+
+# diferencia maxima entre la fecha de envio de una peticion y su llegada para fiarse de ella:
+# mas alla puede deberse a desajustes de reloj entre la web y el servicio
+SENT_TOLERANCE = 0.5
+
+class Dispatcher:
+    '''
+    Reparte peticiones entre un numero fijo de workers por orden de prioridad.
+
+    Cada tipo de peticion tiene una cola acotada: si esta llena se descarta la
+    peticion mas antigua, y las peticiones que superan la edad maxima de su
+    cola se descartan sin procesar, porque nadie espera ya su respuesta.
+    Encolar nunca bloquea, de modo que el bucle de lectura de pubsub puede
+    seguir atendiendo mensajes de control.
+    '''
+    def __init__(self, workers, lanes=DEFAULT_LANES, sent_tolerance=SENT_TOLERANCE):
+        self.lanes = [deque() for lane in xrange(len(lanes))]
+        self.limits = [lanes[lane] for lane in xrange(len(lanes))]
+        self.shed_full = [0]*len(lanes)
+        self.shed_old = [0]*len(lanes)
+        self.processed = [0]*len(lanes)
+        self.workers = workers
+        self.sent_tolerance = sent_tolerance
+        self.busy = 0
+        self.ready = Event()
+        self.greenlets = []
+
+    def start(self):
+        self.greenlets = [spawn(self._worker) for i in xrange(self.workers)]
+
+    def stop(self):
+        for greenlet in self.greenlets:
+            greenlet.kill(block=False)
+        self.greenlets = []
+
+    def put(self, lane, sent, function, *args):
+        '''
+        Encola una peticion en la cola dada.
+
+        @type sent: float o None
+        @param sent: fecha en que el cliente envió la peticion, con el reloj de la web, para contar
+                     en su edad el tiempo que ha esperado en redis. Solo se usa si se aleja de la
+                     llegada menos de sent_tolerance; si no, o sin fecha, se cuenta desde la llegada.
+        '''
+        queue = self.lanes[lane]
+        if len(queue)>=self.limits[lane][0]:
+            queue.popleft()
+            self.shed_full[lane] += 1
+        now = time()
+        queue.append((min(sent, now) if sent and abs(now-sent)<=self.sent_tolerance else now, function, args))
+        self.ready.set()
+
+    def _next(self):
+        '''
+        Obtiene la siguiente peticion a procesar, descartando las caducadas.
+        '''
+        now = time()
+        for lane, queue in enumerate(self.lanes):
+            max_age = self.limits[lane][1]
+            while queue:
+                queued, function, args = queue.popleft()
+                if now-queued<=max_age:
+                    return lane, function, args
+                self.shed_old[lane] += 1
+        return None
+
+    def _worker(self):
+        while True:
+            task = self._next()
+            if task is None:
+                self.ready.clear()
+                self.ready.wait()
+                continue
+
+            lane, function, args = task
+            self.busy += 1
+            try:
+                function(*args)
+            except BaseException as e:
+                print "Dispatcher error on %s lane: %s"%(LANE_NAMES[lane], repr(e))
+            finally:
+                self.busy -= 1
+                self.processed[lane] += 1
+
+    def stats(self):
+        '''
+        Devuelve profundidad de las colas y contadores de peticiones procesadas y descartadas.
+        '''
+        stats = {"busy": self.busy}
+        for lane, name in enumerate(LANE_NAMES):
+            stats[name+"_depth"] = len(self.lanes[lane])
+            stats[name+"_processed"] = self.processed[lane]
+            stats[name+"_shed_full"] = self.shed_full[lane]
+            stats[name+"_shed_old"] = self.shed_old[lane]
+        return stats
+
+if __name__ == "__main__":
+    # Prueba de carga: un redis falso publica rafagas de busquedas de usuarios,
+    # robots, subgrupos y ubicaciones, intercaladas con mensajes de control,
+    # a un ritmo mayor del que pueden atender los workers. Los mensajes de
+    # busqueda llevan su fecha de envio y algunos llegan tras esperar en el
+    # buffer de pubsub, tiempo que cuenta para descartarlos. Parte de las webs
+    # tienen el reloj atrasado, lo que no debe hacer que se descarten.
+    import random
+    from common import format_data, parse_data, EXECUTE_CHANNEL, CONTROL_CHANNEL, QUERY_KEY, LOCATION_KEY
+
+    WORKERS = 15
+    SEARCH_TIME = 0.05
+    DURATION = 5
+    RATE = 600 # mensajes por segundo, los workers atienden 300
+    BUFFER_LAG = 0.4 # segundos que puede llegar a esperar un mensaje en el buffer de pubsub
+    CLOCK_SKEW = 3. # retraso del reloj de las webs desajustadas
+
+    class FakePubSub:
+        def __init__(self):
+            self.rnd = random.Random(0)
+
+        def listen(self):
+            end = time()+DURATION
+            while time()<end:
+                sleep(1./RATE)
+                if self.rnd.random()<0.02:
+                    yield {"type":"message", "channel":CONTROL_CHANNEL+"\x01", "data":"lr", "sent":time()}
+                    continue
+                kind = self.rnd.random()
+                if kind<0.1:
+                    info, bot = "text", False
+                    request_id = LOCATION_KEY+"file"
+                else:
+                    request_id = QUERY_KEY+"query"
+                    info = ({"t":"text"}, {"1":1} if kind<0.3 else None)
+                    bot = kind>0.8
+                sent = time()-(self.rnd.random()*BUFFER_LAG if self.rnd.random()<0.2 else 0)
+                data = format_data((request_id, info, bot, None, sent-(CLOCK_SKEW if self.rnd.random()<0.2 else 0)))
+                yield {"type":"message", "channel":EXECUTE_CHANNEL, "data":data, "sent":sent}
+
+    latencies = {name:[] for name in LANE_NAMES+("control",)}
+    def fake_request(name, sent):
+        latencies[name].append(time()-sent)
+        sleep(SEARCH_TIME)
+
+    dispatcher = Dispatcher(WORKERS)
+    dispatcher.start()
+    for msg in FakePubSub().listen():
+        if msg["channel"][0]==CONTROL_CHANNEL:
+            spawn(latencies["control"].append, time()-msg["sent"])
+            continue
+        message = parse_data(msg["data"])
+        request_id, info = message[0], message[1]
+        if request_id[0]==LOCATION_KEY:
+            lane = LANE_LOCATION
+        elif len(message)>2 and message[2]:
+            lane = LANE_BOTS
+        else:
+            lane = LANE_SUBGROUPS if info[1] else LANE_SEARCH
+        dispatcher.put(lane, message[4] if len(message)>4 else None, fake_request, LANE_NAMES[lane], msg["sent"])
+    sleep(1)
+    dispatcher.stop()
+
+    stats = dispatcher.stats()
+    for name, values in sorted(latencies.iteritems()):
+        values.sort()
+        p99 = values[int(len(values)*0.99)] if values else 0
+        print "%-10s processed %5d, shed full %5d, shed old %5d, p99 wait %.3f s" % (name, len(values), stats.get(name+"_shed_full", 0), stats.get(name+"_shed_old", 0), p99)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+from time import time
+
+__all__ = ["Histogram", "Metrics"]
+
+SUB_BUCKET_BITS = 5 # 32 divisiones por potencia de 2, error relativo maximo ~3%
+SUB_BUCKETS = 1<<SUB_BUCKET_BITS
+
+class Histogram:
+    '''
+    Histograma de latencias con cubos logarítmicos-lineales, al estilo HDR.
+
+    Los valores se guardan en microsegundos. Cada potencia de 2 se divide en
+    SUB_BUCKETS cubos iguales, de forma que el error relativo de los
+    percentiles es constante y la memoria crece con el logaritmo del rango.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @staticmethod
+    def _index(value):
+        if value<SUB_BUCKETS:
+            return value
+        shift = value.bit_length()-SUB_BUCKET_BITS-1
+        return ((shift+1)<<SUB_BUCKET_BITS) + (value>>shift) - SUB_BUCKETS
+
+    @staticmethod
+    def _value(index):
+        # limite superior del cubo
+        if index<SUB_BUCKETS:
+            return index
+        shift = (index>>SUB_BUCKET_BITS)-1
+        return (((index&(SUB_BUCKETS-1))+SUB_BUCKETS+1)<<shift)-1
+
+    def record(self, seconds):
+        '''
+        Registra una duración.
+
+        @type seconds: float
+        @param seconds: duración en segundos
+        '''
+        value = max(0, int(seconds*1000000))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0)+1
+        self.count += 1
+        self.total += value
+        if self.min is None or value<self.min:
+            self.min = value
+        if value>self.max:
+            self.max = value
+
+    def merge(self, other):
+        '''
+        Añade los valores de otro histograma.
+        '''
+        for index, count in other.counts.iteritems():
+            self.counts[index] = self.counts.get(index, 0)+count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min<self.min):
+            self.min = other.min
+        if other.max>self.max:
+            self.max = other.max
+
+    def percentiles(self, *percents):
+        '''
+        Calcula percentiles en segundos.
+        '''
+        results = []
+        if not self.count:
+            return [0.]*len(percents)
+        buckets = sorted(self.counts.iteritems())
+        position = 0
+        accumulated = buckets[0][1]
+        for percent in percents:
+            target = max(1, percent*self.count/100.)
+            while accumulated<target and position+1<len(buckets):
+                position += 1
+                accumulated += buckets[position][1]
+            results.append(min(self._value(buckets[position][0]), self.max)/1000000.)
+        return results
+
+    def summary(self):
+        p50, p90, p99, p999 = self.percentiles(50, 90, 99, 99.9)
+        return {"count": self.count, "mean": self.total/1000000./self.count if self.count else 0.,
+                "min": (self.min or 0)/1000000., "max": self.max/1000000.,
+                "p50": p50, "p90": p90, "p99": p99, "p999": p999}
+
+class Metrics:
+    '''
+    Registro de contadores e histogramas del proceso. Se exporta por intervalos:
+    cada exportación devuelve los datos acumulados desde la anterior.
+    '''
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.since = time()
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0)+value
+
+    def timing(self, name, seconds):
+        histogram = self.histograms.get(name, None)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.record(seconds)
+
+    def snapshot(self, reset=False):
+        '''
+        Obtiene los datos del intervalo actual.
+
+        @type reset: bool
+        @param reset: empieza un nuevo intervalo
+        '''
+        now = time()
+        data = {"start": self.since, "end": now,
+                "counters": dict(self.counters),
+                "timings": {name: histogram.summary() for name, histogram in self.histograms.iteritems()}}
+        if reset:
+            self.counters = {}
+            self.histograms = {}
+            self.since = now
+        return data
+
+if __name__ == "__main__":
+    import random
+    rnd = random.Random(0)
+    values = sorted(rnd.expovariate(1/0.05) for i in xrange(100000))
+    h = Histogram()
+    for value in values:
+        h.record(value)
+    for percent, estimated in zip((50, 90, 99, 99.9), h.percentiles(50, 90, 99, 99.9)):
+        exact = values[int(len(values)*percent/100.)-1]
+        print "p%s exact %.5f estimated %.5f (error %+.2f%%), buckets used %d" % (percent, exact, estimated, (estimated-exact)*100/exact, len(h.counts))
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import argparse, redis
 from common import *
+from shards import get_shards_config, CONTROL_SHARD
 from time import time
 
 # parsea argumentos
@@ -12,7 +13,7 @@ params = parser.parse_args()
 from os import environ
 environ["FOOFIND_NOAPP"] = "1"
 config = __import__("production").settings.__dict__
-redis_servers = config["SPHINX_REDIS_SERVER"]
+redis_servers = get_shards_config(config)[CONTROL_SHARD]
 
 # conecta a redis y envia mensaje
 for redis_server in redis_servers:
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import sys, os, socket
+from time import time, sleep
+from threading import Thread, Lock, Event
+from thread import get_ident
+
+__all__ = ["Sampler"]
+
+# funciones en las que un hilo está esperando y no gasta CPU: (fichero, función) del último frame
+IDLE_FRAMES = set([("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"),
+                   ("Queue.py", "get"), ("socket.py", "accept"), ("socket.py", "readline"),
+                   ("socket.py", "read"), ("SocketServer.py", "_eintr_retry"),
+                   ("hub.py", "switch"), ("hub.py", "run")])
+
+OTHER_STACK = "[other]"
+
+class Sampler(object):
+    '''
+    Profiler estadístico. Un hilo toma muestras de las pilas de todos los
+    hilos del proceso con sys._current_frames y cuenta cuántas veces aparece
+    cada pila, en el formato de pilas colapsadas de flamegraph.pl
+    ("modulo.py:funcion;modulo.py:funcion N").
+
+    Para contar solo donde se gasta CPU se descartan los hilos en espera: los
+    que están en una de las funciones de IDLE_FRAMES y los que siguen en la
+    misma instrucción que en la muestra anterior, que solo puede ocurrir si
+    están bloqueados en una llamada que ha liberado el GIL.
+
+    El hilo mide lo que tarda en tomar cada muestra y alarga el intervalo si
+    el tiempo dedicado a muestrear supera la fracción max_overhead.
+    '''
+    def __init__(self, interval=0.01, max_overhead=0.02, max_depth=64, max_stacks=5000):
+        '''
+        @type interval: float
+        @param interval: segundos entre muestras
+
+        @type max_overhead: float
+        @param max_overhead: fracción máxima del tiempo dedicada a muestrear
+
+        @type max_depth: int
+        @param max_depth: frames de cada pila que se guardan, desde el más interno
+
+        @type max_stacks: int
+        @param max_stacks: pilas distintas que se guardan; las demás se cuentan juntas
+        '''
+        self.configure(interval, max_overhead, max_depth, max_stacks)
+        self.lock = Lock()
+        self.thread = None
+        self.stopping = Event()
+        self.names = {}
+        self.reset()
+
+    def configure(self, interval=0.01, max_overhead=0.02, max_depth=64, max_stacks=5000):
+        '''
+        Cambia la configuración, se aplica en el siguiente muestreo.
+        '''
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+
+    def reset(self):
+        self.stacks = {}
+        self.samples = self.idle = 0
+        self.busy = 0.
+        self.started = self.stopped = None
+
+    @property
+    def running(self):
+        return bool(self.thread and self.thread.is_alive())
+
+    def start(self, duration=None, callback=None):
+        '''
+        Empieza a tomar muestras en este proceso, descartando las anteriores.
+
+        @type duration: float
+        @param duration: segundos que se muestrea, sin límite por defecto
+
+        @type callback: callable
+        @param callback: función que recibe el informe al terminar el muestreo
+
+        @rtype bool
+        @return si ha empezado, o ya estaba muestreando
+        '''
+        with self.lock:
+            if self.running:
+                return False
+            self.reset()
+            self.stopping.clear()
+            self.thread = Thread(target=self._run, args=(duration, callback), name="sampler")
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+
+    def stop(self, wait=True):
+        '''
+        Termina el muestreo de este proceso.
+
+        @type wait: bool
+        @param wait: espera a que termine la última muestra
+
+        @rtype dict
+        @return informe del muestreo
+        '''
+        self.stopping.set()
+        thread = self.thread
+        if wait and thread and thread.is_alive():
+            thread.join()
+        return self.report()
+
+    def _name(self, code):
+        '''
+        Nombre de un frame en la pila colapsada; se guarda por cada objeto de
+        código, así que calcularlo no cuesta nada tras la primera muestra.
+        '''
+        name = self.names.get(code)
+        if name is None:
+            filename = code.co_filename
+            for path in sys.path:
+                path = path or os.getcwd()
+                if filename.startswith(path+os.sep):
+                    filename = filename[len(path)+1:]
+                    break
+            name = self.names[code] = "%s:%s" % (filename.replace(";", ":"), code.co_name)
+        return name
+
+    def _run(self, duration, callback):
+        own = get_ident()
+        self.started = start = time()
+        deadline = start+duration if duration else None
+        stacks = self.stacks
+        max_depth = self.max_depth
+        interval = self.interval
+        positions = {}
+
+        while not self.stopping.is_set() and (deadline is None or time()<deadline):
+            sample_start = time()
+            frames = sys._current_frames()
+            last_positions, positions = positions, {}
+            for ident, frame in frames.iteritems():
+                if ident==own:
+                    continue
+                code = frame.f_code
+                position = positions[ident] = (id(frame), code, frame.f_lasti)
+                if last_positions.get(ident)==position or (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    self.idle += 1
+                    continue
+
+                names = []
+                while frame is not None and len(names)<max_depth:
+                    names.append(self._name(frame.f_code))
+                    frame = frame.f_back
+                names.reverse()
+                stack = ";".join(names)
+
+                if stack in stacks:
+                    stacks[stack] += 1
+                elif len(stacks)<self.max_stacks:
+                    stacks[stack] = 1
+                else:
+                    stacks[OTHER_STACK] = stacks.get(OTHER_STACK, 0)+1
+                self.samples += 1
+            del frames, frame, last_positions
+
+            # ajusta el intervalo para no superar el tiempo maximo de muestreo
+            cost = time()-sample_start
+            self.busy += cost
+            interval = max(self.interval, cost/self.max_overhead)
+            # Event.wait con tiempo límite sondea con esperas cortas: basta con dormir
+            sleep(max(0, interval-cost))
+
+        self.stopped = time()
+        if callback:
+            try:
+                callback(self.report())
+            except BaseException as e:
+                print >>sys.stderr, "Error saving sampler report: %r" % e
+
+    def collapsed(self):
+        '''
+        Pilas colapsadas, una por línea con su número de muestras, para flamegraph.pl.
+        '''
+        return "".join("%s %d\n" % (stack, count) for stack, count in sorted(self.stacks.iteritems()))
+
+    def report(self):
+        '''
+        Informe del muestreo actual o del último.
+        '''
+        end = self.stopped or time()
+        elapsed = end-self.started if self.started else 0.
+        return {"_worker": "%s:%d" % (socket.gethostname(), os.getpid()),
+                "_date": end, "start": self.started, "elapsed": elapsed,
+                "samples": self.samples, "idle": self.idle, "stacks_count": len(self.stacks),
+                "overhead": self.busy/elapsed if elapsed else 0.,
+                "stacks": self.collapsed()}
+
+if __name__ == "__main__":
+    # Pruebas del sampler: formato de las pilas, hilos en espera, límite de
+    # pilas, límite del tiempo de muestreo con muchos hilos, y coste sobre
+    # un trabajo de CPU, alternando pasadas con y sin muestreo.
+    # Uso: python -m sphinxservice.sampler
+    def check(label, condition):
+        print "%-72s %s" % (label, "ok" if condition else "FAILED")
+        if not condition:
+            raise SystemExit(1)
+
+    def deep(depth, loops):
+        if depth:
+            return deep(depth-1, loops)
+        total = 0
+        for i in xrange(loops):
+            total += i*i
+        return total
+
+    def work(repeat=200):
+        start = time()
+        for i in xrange(repeat):
+            deep(40, 20000)
+        return time()-start
+
+    waiting = Event()
+    sleepers = [Thread(target=waiting.wait) for i in xrange(10)]+[Thread(target=sleep, args=(5,)) for i in xrange(10)]
+    for thread in sleepers:
+        thread.daemon = True
+        thread.start()
+
+    sampler = Sampler(0.005)
+    sampler.start()
+    work()
+    report = sampler.stop()
+    lines = report["stacks"].splitlines()
+    check("collapsed format: 'frame;frame count' per line",
+          lines and all(line.rsplit(" ", 1)[1].isdigit() and ";" in line.rsplit(" ", 1)[0] for line in lines))
+    hot = max(lines, key=lambda line: int(line.rsplit(" ", 1)[1]))
+    check("hottest stack is the work loop (%d frames)" % hot.count(";"), hot.split(" ")[0].endswith("sampler.py:deep") and hot.count(";")>=40)
+    check("waiting threads are not counted (%d samples, %d idle)" % (report["samples"], report["idle"]),
+          report["idle"]>report["samples"]*10 and not any("sleep" in line or "wait" in line for line in lines))
+
+    sampler = Sampler(0.001, max_stacks=10)
+    sampler.start()
+    for depth in xrange(100):
+        deep(depth, 20000)
+    report = sampler.stop()
+    check("distinct stacks are limited (%d stacks, %d in %s)" % (report["stacks_count"], sampler.stacks.get(OTHER_STACK, 0), OTHER_STACK),
+          report["stacks_count"]<=11 and sampler.stacks.get(OTHER_STACK))
+
+    # muchos hilos con pilas profundas: cada muestra es cara y el intervalo se alarga
+    stop = Event()
+    def busy():
+        while not stop.is_set():
+            deep(60, 2000)
+    workers = [Thread(target=busy) for i in xrange(50)]
+    for thread in workers:
+        thread.start()
+    sampler = Sampler(0.001, max_overhead=0.02)
+    sampler.start(2)
+    sampler.thread.join()
+    stop.set()
+    for thread in workers:
+        thread.join()
+    report = sampler.report()
+    check("sampling time stays within the budget with 50 busy threads (%.2f%%)" % (report["overhead"]*100), report["overhead"]<0.025)
+
+    # coste: pasadas alternas, se compara el mínimo de cada serie
+    for interval in (0.01, 0.001):
+        sampler = Sampler(interval, max_overhead=0.02)
+        plain, sampled, overheads = [], [], []
+        for i in xrange(10):
+            plain.append(work(500))
+            sampler.start()
+            sampled.append(work(500))
+            overheads.append(sampler.stop()["overhead"])
+        print "interval %2d ms: %.3f s without sampling, %.3f s sampling (%+.1f%%), sampling time %.2f%%" % (
+               interval*1000, min(plain), min(sampled), (min(sampled)/min(plain)-1)*100, max(overheads)*100)
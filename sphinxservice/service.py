@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from geventconnpool import ConnectionPool, retry
-from gevent import signal, sleep, socket, monkey; monkey.patch_socket()
+from gevent import signal, sleep, spawn, joinall, socket, monkey; monkey.patch_socket()
 from gevent.pool import Pool
 from time import time
 from struct import Struct
@@ -14,6 +14,10 @@ from raven.handlers.logging import SentryHandler
 from raven.conf import setup_logging
 
 from common import *
+from shards import get_shards_config, CONTROL_SHARD
+from dispatcher import *
+from metrics import Metrics
+from sampler import Sampler
 
 # configuracion
 DEFAULT_WORKERS = 15
@@ -21,6 +25,10 @@ LOCK_EXPIRATION = 10 # segundos
 INDEX_NAME = "idx_files"
 SPHINX_SOCKET_TIMEOUT = 120.
 REDIS_TIMEOUT = 300.
+METRICS_INTERVAL = 10 # segundos
+METRICS_EXPIRATION = 600 # segundos
+SAMPLER_DURATION = 60 # segundos
+SAMPLER_EXPIRATION = 3600 # segundos
 
 DEFAULT_ORDER = "e DESC, ok DESC, r2 DESC, fs DESC, uri1 DESC"
 DEFAULT_ORDER_KEY = "@weight*(r+10)" # suma 10 a r, si r es 0, evita anular el peso de la coincidencia, si es -1, mantiene el peso positivo
@@ -40,6 +48,9 @@ PART_ID_STRUCT = Struct(">Q")
     Información almacenada en cache para cada busqueda:
     * [query][part]ACTIVE
         Si existe, ya hay alguien buscando en esta parte
+    * [query][part]WAITERS
+        Canales de respuesta de los clientes que han pedido la busqueda mientras
+        otro la realizaba, se les avisa al terminar
     * [query]
         - INFO = (canonical_query)
             Información genérica de la búsqueda.
@@ -121,13 +132,15 @@ class SphinxPool(ConnectionPool):
             print "["+datetime.now().isoformat(" ")+"]", repr(status[:4] if status else None)
 
 class SphinxService:
-    def __init__(self, redis_server, sphinx_server, part, workers):
+    def __init__(self, redis_servers, sphinx_server, part, workers, log_requests=False):
         '''
-        Inicializa el servidor, creando el pool de conexiones a Sphinx y las conexiones a Redis
+        Inicializa el servidor, creando el pool de conexiones a Sphinx y las conexiones a Redis.
+        redis_servers es la lista de servidores de redis de cada particion de la cache, o un solo servidor.
         '''
 
         # configuraciones
-        self.redis_server = redis_server
+        self.redis_servers = [redis_servers] if isinstance(redis_servers[0], basestring) else list(redis_servers)
+        self.redis_server = self.redis_servers[CONTROL_SHARD]
         self.sphinx_server = sphinx_server
         self.part = chr(part)
 
@@ -144,19 +157,32 @@ class SphinxService:
         self.default_max_query_time = DEFAULT_MAX_QUERY_TIME
         self.max_max_query_time = MAX_MAX_QUERY_TIME
 
-        # pool de gevent
+        # pool de gevent para tareas de control
         self.gevent_pool = Pool(self.workers_pool_size)
 
+        # reparto de peticiones por prioridades
+        self.dispatcher = Dispatcher(self.workers_pool_size)
+
+        # metricas de rendimiento y log opcional de cada peticion
+        self.metrics = Metrics()
+        self.log_requests = log_requests
+
+        # profiler estadistico, se activa por el canal de control
+        self.sampler = Sampler()
+        self.sampler_report = None
+
         # pool conexiones sphinx
         self.sphinx_conns = SphinxPool(self.sphinx_pool_size, self.sphinx_server, self.max_max_query_time, SPHINX_SOCKET_TIMEOUT)
 
-        # conexion a redis normal
-        self.redis_conns = RedisPool(self.redis_pool_size, self.redis_server, self.version, REDIS_TIMEOUT)
+        # conexiones a redis normales, una por particion; la de control se usa para las claves de control
+        self.redis_pools = [RedisPool(self.redis_pool_size, server, self.version, REDIS_TIMEOUT) for server in self.redis_servers]
+        self.redis_conns = self.redis_pools[CONTROL_SHARD]
 
         # inicializa variables de control
         self.last_reindex = -1.
         self.stop = False
-        self.pubsub_used = True
+        self.redis_pubsubs = [None]*len(self.redis_servers)
+        self.pubsub_used = [True]*len(self.redis_servers)
 
     def update_last_reindex(self):
         ''' Averigua cuando se realizó la última reindexación de este servidor. '''
@@ -173,63 +199,148 @@ class SphinxService:
             redisc.used = True
             print "["+datetime.now().isoformat(" ")+"]", "Blocked sources updated."
 
-    def keepalive_pubsub(self, timeout):
+    def keepalive_pubsub(self, shard, timeout):
         '''
-        Mantiene viva la conexion pubsub si no llegan mensajes.
+        Mantiene viva la conexion pubsub de una particion si no llegan mensajes.
         '''
         while not self.stop:
             # espera un rato
             sleep(timeout)
 
             # comprueba que la conexion se haya utilizado o hace un ping
-            if self.pubsub_used:
-                self.pubsub_used = False
+            if self.pubsub_used[shard]:
+                self.pubsub_used[shard] = False
             else:
-                with self.redis_conns.get() as redisc:
+                with self.redis_pools[shard].get() as redisc:
                     redisc.publish(RESULTS_CHANNEL, "pn")
                     redisc.publish(CONTROL_CHANNEL+self.part, "pn")
                     redisc.used = True
 
+    def export_metrics(self, reset=True):
+        '''
+        Guarda en redis las metricas del ultimo intervalo y el estado de las colas de peticiones.
+        '''
+        data = self.metrics.snapshot(reset)
+        data["dispatcher"] = self.dispatcher.stats()
+        with self.redis_conns.get() as redisc:
+            redisc.setex(CONTROL_KEY+"m_%d"%ord(self.part), METRICS_EXPIRATION, format_data(data))
+            redisc.used = True
+        return data
+
+    def export_metrics_forever(self, interval):
+        '''
+        Exporta las metricas periodicamente.
+        '''
+        while not self.stop:
+            sleep(interval)
+            try:
+                data = self.export_metrics()
+                if self.log_requests:
+                    print "["+datetime.now().isoformat(" ")+"]", "Metrics:", repr(data)
+                self.export_sampler_report()
+            except BaseException as e:
+                print "["+datetime.now().isoformat(" ")+"] ERROR", "export_metrics", repr(e)
+
+    def start_sampler(self):
+        '''
+        Empieza a tomar muestras de las pilas del proceso durante SAMPLER_DURATION segundos.
+        '''
+        if self.sampler.start(SAMPLER_DURATION, self.set_sampler_report):
+            print "["+datetime.now().isoformat(" ")+"]", "Sampler started."
+
+    def set_sampler_report(self, report):
+        '''
+        Recibe el informe al terminar el muestreo. Se llama desde el hilo del
+        sampler, que no puede usar las conexiones de gevent: el informe se
+        exporta junto con las metricas.
+        '''
+        self.sampler_report = report
+
+    def export_sampler_report(self):
+        '''
+        Guarda en redis el informe del ultimo muestreo, si hay uno pendiente.
+        '''
+        report, self.sampler_report = self.sampler_report, None
+        if report:
+            with self.redis_conns.get() as redisc:
+                redisc.setex(CONTROL_KEY+"ps_%d"%ord(self.part), SAMPLER_EXPIRATION, format_data(report))
+                redisc.used = True
+            print "["+datetime.now().isoformat(" ")+"]", "Sampler report exported: %d samples, %.2f%% overhead."%(report["samples"], report["overhead"]*100)
+
     def stop_server(self):
         print "["+datetime.now().isoformat(" ")+"]", "Stop command received."
 
         # deja de atender peticiones
+        self.close_pubsubs()
+
+    def close_pubsubs(self):
+        '''
+        Deja de atender peticiones en todas las particiones.
+        '''
         self.stop = True
-        self.redis_pubsub.close()
-        self.redis_pubsub.connection_pool.disconnect()
+        for pubsub in self.redis_pubsubs:
+            if pubsub:
+                pubsub.close()
+                pubsub.connection_pool.disconnect()
 
     def serve_forever(self):
         '''
         Recibe y procesa peticiones de busqueda.
         '''
 
-        print "\n\n["+datetime.now().isoformat(" ")+"]", "Server started: %s, %d, %s, %d, %d"%(repr(self.redis_server), self.version, repr(self.sphinx_server), ord(self.part), self.workers_pool_size)
+        print "\n\n["+datetime.now().isoformat(" ")+"]", "Server started: %s, %d, %s, %d, %d"%(repr(self.redis_servers), self.version, repr(self.sphinx_server), ord(self.part), self.workers_pool_size)
+
+        # inicia los workers y la exportacion de metricas
+        self.dispatcher.start()
+        spawn(self.export_metrics_forever, METRICS_INTERVAL)
+
+        # atiende las peticiones de cada particion de la cache
+        self.failed = False
+        joinall([spawn(self.listen, shard) for shard in xrange(len(self.redis_servers))])
+
+        # espera los procesos que esten respondiendo
+        self.dispatcher.stop()
+        self.gevent_pool.join(2)
+
+        # si alguno no acabado en 2 segundos, lo mata
+        self.gevent_pool.kill(timeout=1)
+
+        if not self.failed:
+            print "["+datetime.now().isoformat(" ")+"]", "Server stopped normally."
+
+    def listen(self, shard):
+        '''
+        Recibe las peticiones de una particion de la cache y las encola para que las procesen los workers.
+        '''
+        redis_server = self.redis_servers[shard]
 
         # Inicializa intervalo de reintento en la conexion
         retry = 1
 
         while not self.stop:
+            keepalive = None
             try:
                 # actualiza variables globales
-                self.update_last_reindex()
-                self.update_blocked_sources()
+                if shard==CONTROL_SHARD:
+                    self.update_last_reindex()
+                    self.update_blocked_sources()
 
                 # conexion a redis para pubsub
-                self.redis_pubsub = redis.StrictRedis(host=self.redis_server[0], port=self.redis_server[1], db=self.version).pubsub()
-                self.redis_pubsub.subscribe(EXECUTE_CHANNEL)
-                self.redis_pubsub.subscribe(EXECUTE_CHANNEL+self.part)
-                self.redis_pubsub.subscribe(CONTROL_CHANNEL+self.part)
+                pubsub = self.redis_pubsubs[shard] = redis.StrictRedis(host=redis_server[0], port=redis_server[1], db=self.version).pubsub()
+                pubsub.subscribe(EXECUTE_CHANNEL)
+                pubsub.subscribe(EXECUTE_CHANNEL+self.part)
+                pubsub.subscribe(CONTROL_CHANNEL+self.part)
 
                 # Reinicia intervalo de reintento en la conexion
                 retry = 1
 
                 # inicia el proceso de keepalive de la conexion pubsub
-                self.gevent_pool.spawn(self.keepalive_pubsub, REDIS_TIMEOUT/5)
+                keepalive = spawn(self.keepalive_pubsub, shard, REDIS_TIMEOUT/5)
 
                 # espera mensajes
-                for msg in self.redis_pubsub.listen():
+                for msg in pubsub.listen():
                     # marca que se ha usado la conexion
-                    self.pubsub_used = True
+                    self.pubsub_used[shard] = True
 
                     # ignora los mensajes que no son mensajes
                     if msg["type"]!="message":
@@ -241,19 +352,34 @@ class SphinxService:
 
                     if channel==EXECUTE_CHANNEL:    # busqueda
                         # comprueba si es una busqueda general o es para este servidor
-                        request_id, info = parse_data(data)
+                        message = parse_data(data)
+                        request_id, info = message[0], message[1]
+                        reply = message[3] if len(message)>3 else None
+                        sent = message[4] if len(message)>4 else None
 
-                        # procesa la peticion
+                        # encola la peticion segun su prioridad, sin bloquear la lectura de mensajes
                         if request_id[0]==QUERY_KEY:
-                            self.gevent_pool.spawn(self.process_search_request, request_id, info)
+                            if len(message)>2 and message[2]: # robots
+                                lane = LANE_BOTS
+                            elif info[1]:
+                                lane = LANE_SUBGROUPS
+                            else:
+                                lane = LANE_SEARCH
+                            self.dispatcher.put(lane, sent, self.process_search_request, request_id, info, reply, shard)
                         elif request_id[0]==LOCATION_KEY:
-                            self.gevent_pool.spawn(self.process_get_id_server_request, request_id, info)
+                            self.dispatcher.put(LANE_LOCATION, sent, self.process_get_id_server_request, request_id, info, reply, shard)
 
                     elif channel==CONTROL_CHANNEL:  # control
                         if data == "lr":    # actualiza fecha de reindexado
                             self.gevent_pool.spawn(self.update_last_reindex)
                         elif data == "bs":  # actualiza lista de origenes bloqueados
                             self.gevent_pool.spawn(self.update_blocked_sources)
+                        elif data == "st":  # exporta las metricas actuales sin esperar al intervalo
+                            self.gevent_pool.spawn(self.export_metrics, False)
+                        elif data == "ps":  # empieza a muestrear las pilas del proceso
+                            self.start_sampler()
+                        elif data == "pe":  # termina el muestreo, el informe se exporta con las metricas
+                            self.sampler.stop(False)
                         elif data == "pn":  # ping del keepalive
                             pass
 
@@ -264,10 +390,11 @@ class SphinxService:
                     break
                 else:
                     # Espera y elimina procesos pendientes
-                    self.gevent_pool.join(timeout=2)
-                    self.gevent_pool.kill(timeout=1)
+                    if shard==CONTROL_SHARD:
+                        self.gevent_pool.join(timeout=2)
+                        self.gevent_pool.kill(timeout=1)
 
-                    print "["+datetime.now().isoformat(" ")+"]", "Server connection error %s:'%s'. Will reconnect in %d seconds." % (repr(e), e.message, retry)
+                    print "["+datetime.now().isoformat(" ")+"]", "Server connection error on shard %d %s:'%s'. Will reconnect in %d seconds." % (shard, repr(e), e.message, retry)
 
                     # Espera tiempo de reintento e incrementa tiempo de reintento para la próxima vez (hasta 64 segundos)
                     sleep(retry)
@@ -277,30 +404,64 @@ class SphinxService:
                 if self.stop:
                     break
                 else:
+                    # detiene el servidor completo, tambien las demas particiones
                     print "["+datetime.now().isoformat(" ")+"]", "Server stopped with error %s:'%s'."%(repr(e), e.message)
                     logging.exception("Error on main loop on service %d."%ord(self.part))
-                    return
-
-        # espera los procesos que esten respondiendo
-        self.gevent_pool.join(2)
+                    self.failed = True
+                    self.close_pubsubs()
+                    break
+            finally:
+                if keepalive:
+                    keepalive.kill(block=False)
 
-        # si alguno no acabado en 2 segundos, lo mata
-        self.gevent_pool.kill(timeout=1)
+    def notify(self, redisc, request_id, reply, info=None):
+        '''
+        Avisa al cliente que ha hecho la peticion de que esta parte ha respondido.
+        Los clientes que no indican canal de respuesta reciben el aviso por el canal comun.
+        '''
+        redisc.publish(RESULTS_CHANNEL+reply if reply else RESULTS_CHANNEL, format_data((request_id, self.part, info)))
 
-        print "["+datetime.now().isoformat(" ")+"]", "Server stopped normally."
+    def wait_for(self, redisc, request_id, reply):
+        '''
+        Apunta a un cliente para que se le avise cuando termine quien esta procesando la peticion.
+        '''
+        waiters_key = request_id+self.part+WAITERS_KEY
+        redisc.pipeline().sadd(waiters_key, reply).expire(waiters_key, LOCK_EXPIRATION).execute()
 
-    def process_get_id_server_request(self, request_id, info):
+    def notify_waiters(self, redisc, request_id, info=None):
+        '''
+        Avisa a los clientes que esperaban a que terminase esta peticion.
+        '''
+        waiters_key = request_id+self.part+WAITERS_KEY
+        waiters = redisc.pipeline().smembers(waiters_key).delete(waiters_key).execute()[0]
+        if waiters:
+            data = format_data((request_id, self.part, info))
+            pipe = redisc.pipeline()
+            for reply in waiters:
+                pipe.publish(RESULTS_CHANNEL+reply, data)
+            pipe.execute()
+            self.metrics.incr("waiters_notified", len(waiters))
+
+    def process_get_id_server_request(self, request_id, info, reply=None, shard=CONTROL_SHARD):
         try:
             # extrae parametros de la llamada
             bin_file_id = request_id[1:]
             query = info.decode("utf-8")
 
-            # obtiene el cliente de redis
-            with self.redis_conns.get() as redisc:
+            # obtiene el cliente de redis de la particion de la peticion
+            with self.redis_pools[shard].get() as redisc:
 
                 # bloquea acceso si hace falta procesar esta peticion (nadie la esta haciendo o ha hecho ya)
                 start_time = time()
-                if redisc.hsetnx(request_id, self.part, "P"):
+                processing = redisc.hsetnx(request_id, self.part, "P")
+                if not processing and reply:
+                    # otro servicio la esta procesando, se apunta para que le avise o se avisa si ya ha terminado
+                    self.wait_for(redisc, request_id, reply)
+                    has_it = redisc.hget(request_id, self.part)
+                    if has_it in ("H", "N"):
+                        self.notify(redisc, request_id, reply, self.part if has_it=="H" else None)
+
+                if processing:
                     try:
                         block_time = time()
                         with self.sphinx_conns.get() as sphinx:
@@ -317,18 +478,25 @@ class SphinxService:
 
                             # comprueba resultados obtenidos
                             has_it = results and "matches" in results and results["matches"]
-                            if has_it:
-                                redisc.pipeline().hset(request_id, self.part, "H").publish(RESULTS_CHANNEL, format_data((request_id, self.part, self.part))).execute()
-                            else:
-                                redisc.pipeline().hset(request_id, self.part, "N").publish(RESULTS_CHANNEL, format_data((request_id, self.part, None))).execute()
+                            pipe = redisc.pipeline().hset(request_id, self.part, "H" if has_it else "N")
+                            self.notify(pipe, request_id, reply, self.part if has_it else None)
+                            pipe.execute()
+                            self.notify_waiters(redisc, request_id, self.part if has_it else None)
                             end_time = time()
 
-                            print "["+datetime.fromtimestamp(start_time).isoformat(" ")+"]", self.gevent_pool.free_count(), ("*" if has_it else " ")+bin_file_id.encode("hex"), " %.2f (%.4f %.4f %.4f)"%(end_time-start_time, block_time-start_time, search_time-block_time, end_time-search_time), repr(query)
+                            self.metrics.timing("location.sphinx", search_time-block_time)
+                            self.metrics.timing("location.store", end_time-search_time)
+                            self.metrics.timing("location.total", end_time-start_time)
+                            self.metrics.incr("location_found" if has_it else "location_not_found")
+
+                            if self.log_requests:
+                                print "["+datetime.fromtimestamp(start_time).isoformat(" ")+"]", self.dispatcher.workers-self.dispatcher.busy, ("*" if has_it else " ")+bin_file_id.encode("hex"), " %.2f (%.4f %.4f %.4f)"%(end_time-start_time, block_time-start_time, search_time-block_time, end_time-search_time), repr(query)
 
 
                     except BaseException as e:
+                        self.metrics.incr("location_errors")
                         redisc.hdel(request_id, self.part)
-                        print "["+datetime.now().isoformat(" ")+"] ERROR", self.gevent_pool.free_count(), "process_get_id_server_request inner", repr(e), e.message
+                        print "["+datetime.now().isoformat(" ")+"] ERROR", self.dispatcher.workers-self.dispatcher.busy, "process_get_id_server_request inner", repr(e), e.message
                         logging.exception("Error on searching for id %s on service %d."%(bin_file_id.encode("hex"), ord(self.part)))
 
                 redisc.used = True
@@ -336,23 +504,32 @@ class SphinxService:
             print "["+datetime.now().isoformat(" ")+"] ERROR", "process_get_id_server_request outer", repr(e), e.message
             logging.exception("Error on process_get_id_server_request on service %d."%ord(self.part))
 
-    def process_search_request(self, request_id, info):
+    def process_search_request(self, request_id, info, reply=None, shard=CONTROL_SHARD):
         # extrae parametros de la llamada
         query = info[0]
         subgroups = info[1]
 
         try:
-            # analiza la peticion para ver qué hay que buscar
-            with self.redis_conns.get() as redisc:
+            # analiza la peticion para ver qué hay que buscar, en la particion de la peticion
+            with self.redis_pools[shard].get() as redisc:
                 start_time = prep_time = search_time = time()
+                must_search = False
 
                 query_key = QUERY_KEY+hash_dict(query)
                 # genera informacion de la peticion
-                search_info = {"query_key":query_key, "query":query, "subgroups":subgroups, "generate_info":False, "version":0, "tries":0}
+                search_info = {"query_key":query_key, "query":query, "subgroups":subgroups, "generate_info":False, "version":0, "tries":0, "reply":reply}
 
-                # intenta bloquear o ignora la peticion porque ya hay alguien trabajando en ellau
+                # intenta bloquear o ignora la peticion porque ya hay alguien trabajando en ella
                 lock = redisc.lock(query_key+self.part+ACTIVE_KEY, LOCK_EXPIRATION)
-                if lock.acquire(False):
+                locked = lock.acquire(False)
+
+                # si hay alguien trabajando en ella, se apunta para que le avise al terminar,
+                # y lo vuelve a intentar por si ha terminado antes de apuntarse
+                if not locked and reply and not subgroups:
+                    self.wait_for(redisc, query_key, reply)
+                    locked = lock.acquire(False)
+
+                if locked:
                     try:
                         must_search = self.prepare_search(redisc, search_info)
                         prep_time = search_time = time()
@@ -365,24 +542,54 @@ class SphinxService:
                             # almacena los resultados y avisa a quien ha hecho la peticion
                             self.store_results(redisc, search_info, results)
                     except BaseException as e:
-                        print "["+datetime.now().isoformat(" ")+"] ERROR", self.gevent_pool.free_count(), "process_search_request inner", repr(e), e.message
+                        self.metrics.incr("search_errors")
+                        print "["+datetime.now().isoformat(" ")+"] ERROR", self.dispatcher.workers-self.dispatcher.busy, "process_search_request inner", repr(e), e.message
                     finally:
                         lock.release()
+
+                    # avisa a quienes han pedido la busqueda mientras se realizaba, despues de liberar
+                    # el bloqueo para no perder a los que se apunten justo antes
+                    self.notify_waiters(redisc, query_key)
                 else:
                     must_search = None
                     prep_time = search_time = time()
 
                 redisc.used = True
 
-            # prepara info de la consulta para loguear
             end_time = time()
+
+            # metricas por etapa y tipo de consulta
+            query_type = "subgroups" if subgroups else "main"
+            metrics = self.metrics
+            if must_search is None:
+                metrics.incr("lock_busy")
+            else:
+                metrics.timing("prepare."+query_type, prep_time-start_time)
+                if must_search:
+                    metrics.timing("sphinx."+query_type, search_time-prep_time)
+                    metrics.timing("store."+query_type, end_time-search_time)
+                    metrics.incr("searches."+query_type)
+                else:
+                    metrics.incr("cached."+query_type)
+            metrics.timing("total."+query_type, end_time-start_time)
+            if search_info["tries"]>0:
+                metrics.incr("retries")
+            if "early_response" in search_info:
+                metrics.incr("early_responses")
+            if "delete_subgroups" in search_info:
+                metrics.incr("reindexed")
+
+            if not self.log_requests:
+                return
+
+            # prepara info de la consulta para loguear
             query_sum = query["t"]
             if subgroups:
                 subgroups_sum = sorted(subgroups.iteritems())
                 query_sum += " %d/%d %s"%(len(search_info["subgroups"]), len(subgroups_sum), repr(subgroups_sum[:4]))
 
             # imprime información de la busqueda
-            print "["+datetime.fromtimestamp(start_time).isoformat(" ")+"]", self.gevent_pool.free_count() ,"".join(name if flag else " " for name, flag in izip("BSEDW", (must_search==None, must_search, "early_response" in search_info, "delete_subgroups" in search_info, search_info["tries"]>0))), search_info["tries"], " %.2f (%.4f %.4f %.4f) "%(end_time-start_time, prep_time-start_time, search_time-prep_time, end_time-search_time), query_key.encode("hex")[-10:], query_sum
+            print "["+datetime.fromtimestamp(start_time).isoformat(" ")+"]", self.dispatcher.workers-self.dispatcher.busy ,"".join(name if flag else " " for name, flag in izip("BSEDW", (must_search==None, must_search, "early_response" in search_info, "delete_subgroups" in search_info, search_info["tries"]>0))), search_info["tries"], " %.2f (%.4f %.4f %.4f) "%(end_time-start_time, prep_time-start_time, search_time-prep_time, end_time-search_time), query_key.encode("hex")[-10:], query_sum
         except BaseException as e:
             print  "["+datetime.now().isoformat(" ")+"] ERROR", "process_search_request outer", repr(e), e.message
             logging.exception("Error on process_search_request on service %d."%ord(self.part))
@@ -449,7 +656,7 @@ class SphinxService:
         # avisa, si hay datos disponibles aunque haya que buscar
         if not subgroups and early_response:
             search_info["early_response"] = True
-            redisc.publish(RESULTS_CHANNEL, format_data((query_key, self.part, None)))
+            self.notify(redisc, query_key, search_info["reply"])
 
         # si no tiene que buscar, libera el bloqueo
         if not must_search:
@@ -610,7 +817,7 @@ class SphinxService:
 
         # avisa que estan disponibles los resultados principales
         if not subgroups:
-            redisc.publish(RESULTS_CHANNEL, format_data((query_key, self.part, None)))
+            self.notify(redisc, query_key, search_info["reply"])
 
 from os import environ
 environ["FOOFIND_NOAPP"] = "1"
@@ -621,16 +828,17 @@ if __name__ == '__main__':
     parser.add_argument('port', type=int, help='Sphinx server port')
     parser.add_argument('part', type=int, help='Server number.')
     parser.add_argument('--workers', type=int, help='Number of microthread workers.', default=DEFAULT_WORKERS)
-    parser.add_argument('--redis', type=int, default=0, help='Redis server index.')
+    parser.add_argument('--redis', type=int, default=0, help='Redis server index on each cache shard.')
+    parser.add_argument('--log-requests', action='store_true', help='Print a line for every request.')
 
     params = parser.parse_args()
 
     config = __import__("production").settings.__dict__
-    redis_server = config["SPHINX_REDIS_SERVER"][params.redis]
+    redis_servers = [servers[params.redis] for servers in get_shards_config(config)]
 
     setup_logging(SentryHandler(Client(config["SENTRY_SPHINX_SERVICE_DNS"])))
 
-    server = SphinxService(redis_server, (params.host, params.port), params.part, params.workers)
+    server = SphinxService(redis_servers, (params.host, params.port), params.part, params.workers, params.log_requests)
 
     # captura sigint
     def stop_server():
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+'''
+    Reparto de la cache de busquedas entre varios servidores de redis.
+
+    La configuracion SPHINX_REDIS_SHARDS es una lista de particiones, cada
+    una con la lista de servidores (host, port) que pueden atenderla. Todas
+    las claves y mensajes de una peticion van a la particion que le
+    corresponde por hash consistente de su identificador, y dentro de cada
+    particion se usa el servidor que mejor responde. La primera particion
+    guarda ademas las claves y canales de control.
+
+    Sin SPHINX_REDIS_SHARDS hay una sola particion con los servidores de
+    SPHINX_REDIS_SERVER, que es el funcionamiento anterior.
+'''
+from bisect import bisect
+from hashlib import md5
+from struct import Struct
+from time import time, sleep
+import redis, logging, timeit
+
+__all__ = ["HashRing", "RedisShard", "get_shards_config", "CONTROL_SHARD"]
+
+INFINITY            = float('inf')
+
+PING_INTERVAL       = 10  # Segundos
+PING_SWITCH_STEPS   =  6  # Cantidad de pings desfavorables al servidor actual para cambiar de servidor
+
+RING_POINTS = 160 # puntos de cada particion en el anillo
+CONTROL_SHARD = 0
+
+HASH_STRUCT = Struct(">I")
+
+def get_shards_config(config):
+    '''
+    Obtiene la lista de particiones de la configuracion.
+
+    @type config: dict
+    @param config: configuracion de la aplicacion
+
+    @rtype list
+    @return lista de particiones, cada una con la lista de servidores (host, port) que la atienden
+    '''
+    shards = config.get("SPHINX_REDIS_SHARDS", None) or [config["SPHINX_REDIS_SERVER"]]
+    return [[servers] if isinstance(servers[0], basestring) else list(servers) for servers in shards]
+
+def safe_ping(conn):
+    try:
+        return timeit.timeit(conn.ping, number=1)
+    except:
+        return INFINITY
+
+class HashRing(object):
+    '''
+    Hash consistente de identificadores de peticiones entre particiones.
+
+    Cada particion ocupa varios puntos del anillo, calculados a partir de su
+    numero, de modo que añadir una particion al final de la lista solo mueve
+    las claves que le tocan a ella.
+    '''
+    def __init__(self, shards, points=RING_POINTS):
+        self.shards = shards
+        ring = sorted((HASH_STRUCT.unpack(md5("%d-%d"%(shard, point)).digest()[:4])[0], shard)
+                        for shard in xrange(shards) for point in xrange(points))
+        self.hashes = [value for value, shard in ring]
+        self.owners = [shard for value, shard in ring]
+
+    def get(self, key):
+        '''
+        Obtiene la particion de una clave.
+
+        @type key: str
+        @param key: identificador de la peticion
+
+        @rtype int
+        @return numero de particion
+        '''
+        if self.shards==1:
+            return 0
+        index = bisect(self.hashes, HASH_STRUCT.unpack(md5(key).digest()[:4])[0])
+        return self.owners[index if index<len(self.owners) else 0]
+
+class RedisShard(object):
+    '''
+    Servidores alternativos de una particion. Usa el de menor ping y cambia
+    cuando el actual deja de responder, o cuando otro responde mejor durante
+    varias comprobaciones seguidas.
+    '''
+    def __init__(self, servers, db):
+        self.servers = servers
+        self.conns = [redis.StrictRedis(host=server[0], port=server[1], db=db) for server in servers]
+        self.pubsubs = [redis.StrictRedis(host=server[0], port=server[1], db=db).pubsub() for server in servers]
+        self.conn = self.pubsub = None
+        self.index = -1
+        self.last_try = self.confidence = 0
+        self.pings = []
+
+    def update(self, force=False):
+        '''
+        Comprueba los servidores de la particion y cambia de servidor si hace falta.
+
+        @type force: bool
+        @param force: comprueba aunque no haya pasado el intervalo entre comprobaciones
+
+        @rtype bool
+        @return si ha cambiado de servidor
+        '''
+        try:
+            # evita ejecutar la funcion si no se ha cumplido el intervalo
+            if not force and time()-self.last_try<PING_INTERVAL:
+                return False
+
+            # calcula pings a conexiones
+            self.last_try = time()
+            self.pings = [safe_ping(conn) for conn in self.conns]
+            ping, new_index = min((ping, index) for index, ping in enumerate(self.pings))
+
+            # evalua confianza de la conexion actual
+            if self.pings[self.index]==INFINITY:    # conexión actual caída, se debe cambiar ya de conexion
+                self.confidence = 0
+            elif new_index==self.index:             # mantiene confianza, esta conexion es la mejor
+                self.confidence = PING_SWITCH_STEPS
+            elif new_index!=self.index:             # conexión alternativa mejor, disminuye la confianza
+                self.confidence -= 1
+
+            # si ha perdido la confianza cambia de servidor
+            if self.confidence<=0:
+                if self.index == new_index: # si no hay alternativa, espera
+                    sleep(PING_INTERVAL/2)
+                else:
+                    self.index = new_index
+                    self.confidence = PING_SWITCH_STEPS
+                    self.conn = self.conns[self.index]
+                    self.pubsub = self.pubsubs[self.index]
+                    return True
+        except BaseException as e:
+            logging.exception("Error updating redis connections.")
+        return False
+
+if __name__ == "__main__":
+    # Prueba con varios redis en memoria: reparto de claves entre particiones,
+    # claves movidas al añadir una particion, peticiones del cliente enviadas
+    # a la particion correcta y cambio de servidor dentro de una particion.
+    # Uso: python -m sphinxservice.shards
+    from collections import defaultdict, Counter
+    from .common import QUERY_KEY, LOCATION_KEY, EXECUTE_CHANNEL, parse_data, hash_dict, LimitedDict
+
+    class FakeServer(object):
+        '''
+        Redis en memoria que registra los comandos recibidos.
+        '''
+        def __init__(self, name, latency):
+            self.name = name
+            self.latency = latency
+            self.up = True
+            self.data = {}
+            self.published = []
+            self.reads = []
+
+    servers = {}
+    class FakeRedis(object):
+        def __init__(self, host=None, port=None, db=0):
+            self.server = servers[(host, port)]
+
+        def _check(self):
+            if not self.server.up:
+                raise redis.ConnectionError("Server %s is down." % self.server.name)
+
+        def ping(self):
+            self._check()
+            sleep(self.server.latency)
+            return True
+
+        def hgetall(self, name):
+            self._check()
+            self.server.reads.append(name)
+            return dict(self.server.data.get(name, {}))
+
+        def hmget(self, name, *keys):
+            self._check()
+            self.server.reads.append(name)
+            return [self.server.data.get(name, {}).get(key) for key in keys]
+
+        def mget(self, keys):
+            self._check()
+            return [self.server.data.get(key) for key in keys]
+
+        def publish(self, channel, message):
+            self._check()
+            self.server.published.append((channel, message))
+            return 1
+
+        def pipeline(self):
+            client = self
+            class Pipeline(object):
+                def __init__(self):
+                    self.commands = []
+                def publish(self, *args):
+                    self.commands.append(lambda: client.publish(*args))
+                    return self
+                def execute(self):
+                    return [command() for command in self.commands]
+            return Pipeline()
+
+        def pubsub(self):
+            return None
+
+    redis.StrictRedis = FakeRedis
+    from .client import Sphinx
+
+    def check(label, condition):
+        print "%-68s %s" % (label, "ok" if condition else "FAILED")
+        if not condition:
+            raise SystemExit(1)
+
+    # reparto entre particiones y estabilidad al añadir una particion
+    keys = [QUERY_KEY+md5(str(i)).digest() for i in xrange(30000)]
+    ring3, ring4 = HashRing(3), HashRing(4)
+    counts = Counter(ring3.get(key) for key in keys)
+    check("keys spread over 3 shards (%s)" % ", ".join("%.1f%%" % (counts[shard]*100./len(keys)) for shard in xrange(3)),
+          all(abs(counts[shard]*3./len(keys)-1)<0.1 for shard in xrange(3)))
+    moved = [key for key in keys if ring3.get(key)!=ring4.get(key)]
+    check("adding a 4th shard moves %.1f%% of keys, all to the new one" % (len(moved)*100./len(keys)),
+          abs(len(moved)*4./len(keys)-1)<0.15 and all(ring4.get(key)==3 for key in moved))
+
+    # cliente con 3 particiones de 2 servidores cada una, el segundo mas lento
+    shards = [[("redis%d%s" % (shard, replica), 6379) for replica in "ab"] for shard in xrange(3)]
+    for servers_list in shards:
+        for server, latency in zip(servers_list, (0.001, 0.005)):
+            servers[server] = FakeServer(server[0], latency)
+
+    class FakeApp:
+        config = {"SPHINX_CLIENT_REQUESTS_CACHE_SIZE": 100, "SPHINX_CLIENT_REQUESTS_CACHE_TIMEOUT": 60,
+                  "SEARCH_CONTENT_TYPE_WEIGHTS": {}, "SPHINX_REDIS_SERVER": None, "SPHINX_REDIS_SHARDS": shards}
+    client = Sphinx(None, None)
+    client.init_app(FakeApp())
+    client.last_parts_request = [0]
+    client.active_parts = {1: 0}
+
+    check("control shard uses its first server", client.redis_conn.server.name=="redis0a")
+
+    queries = [{"t": u"query %d" % i, "f": {}} for i in xrange(60)]
+    for query in queries:
+        client.start_search(query)
+    owners = defaultdict(set)
+    for query in queries:
+        owners[client.ring.get(QUERY_KEY+hash_dict(query))].add(QUERY_KEY+hash_dict(query))
+    published = {name: set(parse_data(message)[0] for channel, message in server.published if channel==EXECUTE_CHANNEL)
+                 for name, server in ((server.name, server) for server in servers.itervalues())}
+    check("each search is published only on its shard (%s)" % ", ".join(str(len(owners[shard])) for shard in xrange(3)),
+          all(published["redis%da" % shard]==owners[shard] and not published["redis%db" % shard] for shard in xrange(3)))
+    check("cache reads go to the owner shard",
+          all(set(servers[shards[shard][0]].reads)==owners[shard] for shard in xrange(3)))
+
+    location_id = LOCATION_KEY+"\x01"*12
+    client.get_id_server_from_search("\x01"*12, u"file", 1)
+    check("location requests use the owner shard of the file",
+          any(parse_data(message)[0]==location_id for channel, message in servers[shards[client.ring.get(location_id)][0]].published))
+
+    # caida de un servidor: la particion pasa a su alternativo y las demas no cambian
+    servers[shards[1][0]].up = False
+    for server in servers.itervalues():
+        server.published = []
+    client.update_redis_connections(True)
+    check("failed server is replaced by its replica",
+          client.shards[1].conn.server.name=="redis1b" and client.shards[0].conn.server.name=="redis0a" and client.shards[2].conn.server.name=="redis2a")
+    for query in queries:
+        client.requests = LimitedDict(100, 60) # olvida las peticiones para volver a publicarlas
+        client.start_search(query)
+    check("searches of the failed shard go to the replica, the rest unchanged",
+          set(parse_data(message)[0] for channel, message in servers[shards[1][1]].published)==owners[1] and
+          all(set(parse_data(message)[0] for channel, message in servers[shards[shard][0]].published)==owners[shard] for shard in (0, 2)))
+
+    # vuelta del servidor y caida del alternativo: vuelve al primero
+    servers[shards[1][0]].up = True
+    servers[shards[1][1]].up = False
+    client.update_redis_connections(True)
+    check("shard switches back when the replica fails", client.shards[1].conn.server.name=="redis1a")